@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+""" AmqpAlerter throughput on kombu's in-memory transport, pooled per-match publishing
+versus the persistent publisher in each batch mode and serializer.
+
+Usage: python benchmarks/bench_amqp.py [num_matches]
+"""
+from __future__ import print_function
+from datetime import datetime, timedelta
+import sys
+import timeit
+
+from kombu import Connection, Exchange, Queue
+from kombu.pools import producers
+
+from elastalert_extensions.alerts import AmqpAlerter
+
+
+def make_matches(num_matches):
+    t0 = datetime(2018, 1, 1)
+    return [{
+        '@timestamp': (t0 + timedelta(seconds=i)).isoformat(),
+        'device': 'device%d' % (i % 1000),
+        'value': ['fault', 'offline'],
+        'start_time': (t0 + timedelta(seconds=i - 600)).isoformat(),
+        'duration': 600.0,
+        'num_hits': i,
+    } for i in range(num_matches)]
+
+
+def pooled(url, exchange, name, matches):
+    """ The publishing loop AmqpAlerter.alert had before batching. """
+    with producers[Connection(url)].acquire(block=True) as producer:
+        for match in matches:
+            producer.publish({'rule': name, 'match': match},
+                             serializer='json',
+                             exchange=exchange,
+                             routing_key='alert')
+
+
+def main(num_matches=20000):
+    matches = make_matches(num_matches)
+    exchange = Exchange('alert', type='fanout')
+    conn = Connection('memory://')
+    queue = Queue('alerts', exchange=exchange)(conn.channel())
+    queue.declare()
+
+    def run(func):
+        def once():
+            func(matches)
+            queue.purge()
+        return num_matches / min(timeit.repeat(once, number=1, repeat=5))
+
+    print('pooled, one message per match:  %9.0f matches/s' %
+          run(lambda m: pooled('memory://', exchange, 'bench', m)))
+    for mode in ('match', 'message'):
+        for serializer in ('json', 'msgpack'):
+            alerter = AmqpAlerter({'name': 'bench', 'amqp_url': 'memory://', 'amqp_password': 'x',
+                                   'amqp_batch_mode': mode, 'amqp_serializer': serializer})
+            print('batch mode %-7s %-7s:        %9.0f matches/s' % (mode, serializer, run(alerter.alert)))
+    conn.release()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+""" Per-event cost of lookup_es_key versus the precompiled field getters on nested documents.
+
+Usage: python benchmarks/bench_fields.py [num_events]
+"""
+from __future__ import print_function
+from datetime import datetime, timedelta
+import sys
+import timeit
+
+from dateutil.tz import tzutc
+from elastalert.util import lookup_es_key
+
+from elastalert_extensions import ruletypes
+from elastalert_extensions.fields import field_getter
+from elastalert_extensions.fields import fields_getter
+
+
+QUERY_KEY = 'host.device.id'
+COMPARE_KEYS = ['status.inverter.code', 'status.inverter.state', 'status.grid']
+
+
+def make_docs(num_events):
+    t0 = datetime(2018, 1, 1, tzinfo=tzutc())
+    return [{
+        '@timestamp': t0 + timedelta(seconds=i),
+        'host': {'name': 'gw%d' % (i % 10), 'device': {'id': 'device%d' % (i % 1000)}},
+        'status': {'inverter': {'code': i % 7, 'state': 'ok'}, 'grid': 'on'},
+    } for i in range(num_events)]
+
+
+def per_event(func, docs):
+    return min(timeit.repeat(lambda: func(docs), number=1, repeat=5)) / len(docs)
+
+
+def main(num_events=100000):
+    docs = make_docs(num_events)
+
+    def generic(docs):
+        for doc in docs:
+            lookup_es_key(doc, QUERY_KEY)
+            [lookup_es_key(doc, term) for term in COMPARE_KEYS]
+
+    get_key = field_getter(QUERY_KEY)
+    get_values = fields_getter(COMPARE_KEYS)
+
+    def compiled(docs):
+        for doc in docs:
+            get_key(doc)
+            get_values(doc)
+
+    before = per_event(generic, docs)
+    after = per_event(compiled, docs)
+    print('lookup_es_key, 4 nested fields:    %6.2f us/event' % (before * 1e6))
+    print('compiled getters, 4 nested fields: %6.2f us/event' % (after * 1e6))
+    print('saved:                             %6.2f us/event (%.1fx)' % ((before - after) * 1e6,
+                                                                         before / after))
+
+    def add_data(docs):
+        ruletypes.ProfiledFrequencyRule({
+            'num_events': 1000000,
+            'timeframe': timedelta(minutes=30),
+            'query_key': QUERY_KEY,
+            'timestamp_field': '@timestamp',
+            'window_type': 'compact',
+        }).add_data(docs)
+
+    print('ProfiledFrequencyRule.add_data:    %6.2f us/event' % (per_event(add_data, docs) * 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
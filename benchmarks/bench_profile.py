@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+""" Per-event overhead of resolving the profile on every timeframe() call versus once per batch.
+
+Usage: python benchmarks/bench_profile.py [num_keys] [num_events]
+"""
+from __future__ import print_function
+from datetime import datetime, timedelta
+import json
+import os
+import sys
+import tempfile
+import timeit
+
+from dateutil.tz import tzutc
+
+from elastalert_extensions import ruletypes
+
+
+def make_rule(profile_path, **extra):
+    rules = {
+        'num_events': 1000000,
+        'timeframe': timedelta(minutes=30),
+        'query_key': 'device',
+        'timestamp_field': '@timestamp',
+        'profile': profile_path,
+    }
+    rules.update(extra)
+    return ruletypes.ProfiledFrequencyRule(rules)
+
+
+def main(num_keys=1000, num_events=100000):
+    fd, profile_path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as profile_file:
+        json.dump({'device%d' % i: 600 + i for i in range(num_keys)}, profile_file)
+
+    try:
+        rule = make_rule(profile_path)
+        rule._begin_batch()
+        keys = ['device%d' % (i % (num_keys * 2)) for i in range(num_events)]
+        default = rule.rules['timeframe']
+
+        def per_event():
+            # The hot path before profile snapshots
+            for key in keys:
+                rule.profile.get(key, default)
+
+        def per_batch():
+            rule._begin_batch()
+            for key in keys:
+                rule.timeframe(key)
+
+        before = min(timeit.repeat(per_event, number=1, repeat=5)) / num_events
+        after = min(timeit.repeat(per_batch, number=1, repeat=5)) / num_events
+        print('timeframe lookup, property per event:  %8.1f ns/event' % (before * 1e9))
+        print('timeframe lookup, snapshot per batch:  %8.1f ns/event' % (after * 1e9))
+        print('speedup:                               %8.1fx' % (before / after))
+
+        t0 = datetime(2018, 1, 1, tzinfo=tzutc())
+        data = [{'@timestamp': t0 + timedelta(seconds=i), 'device': key} for i, key in enumerate(keys)]
+
+        def add_data():
+            make_rule(profile_path).add_data(data)
+
+        elapsed = min(timeit.repeat(add_data, number=1, repeat=3)) / num_events
+        print('add_data:                              %8.1f us/event' % (elapsed * 1e6))
+    finally:
+        os.unlink(profile_path)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
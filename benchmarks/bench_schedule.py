@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+""" Per-match cost of InTimeframe, dateutil parsing versus the ISO fast path and cached offsets.
+
+Usage: python benchmarks/bench_schedule.py [num_matches]
+"""
+from __future__ import print_function
+from datetime import datetime, timedelta
+import sys
+import timeit
+
+from dateutil import parser
+from pytz import timezone
+
+from elastalert_extensions.alerts import InTimeframe
+from elastalert_extensions.schedule import parse_time
+
+
+SCHEDULE = {'timezone': 'Asia/Taipei', 'from': '08:00', 'to': '18:00'}
+
+
+class DateutilInTimeframe(object):
+    """ InTimeframe before the fast path. """
+    utc = timezone('UTC')
+
+    def __init__(self, timestamp_field, schedule):
+        self.timestamp_field = timestamp_field
+        self.tz = timezone(schedule.get('timezone', 'UTC'))
+        self.from_ = parse_time(schedule.get('from', None))
+        self.to = parse_time(schedule.get('to', None))
+
+    def __call__(self, entry):
+        dt = parser.parse(entry[self.timestamp_field])
+        if not dt.tzinfo:
+            dt = self.utc.localize(dt)
+        t = dt.astimezone(self.tz).time()
+        if self.from_ and t < self.from_:
+            return False
+        if self.to and t > self.to:
+            return False
+        return True
+
+
+def make_matches(num_matches):
+    t0 = datetime(2018, 1, 1)
+    return [{'@timestamp': (t0 + timedelta(seconds=37 * i)).isoformat() + 'Z'} for i in range(num_matches)]
+
+
+def per_match(in_timeframe, matches):
+    return min(timeit.repeat(lambda: [in_timeframe(m) for m in matches], number=1, repeat=5)) / len(matches)
+
+
+def main(num_matches=50000):
+    matches = make_matches(num_matches)
+    before = per_match(DateutilInTimeframe('@timestamp', SCHEDULE), matches)
+    after = per_match(InTimeframe('@timestamp', SCHEDULE), matches)
+    windows = per_match(InTimeframe('@timestamp', {
+        'timezone': 'Asia/Taipei',
+        'windows': [{'from': '08:00', 'to': '12:00', 'days': 'mon-fri'},
+                    {'from': '13:00', 'to': '18:00', 'days': 'mon-fri'},
+                    {'from': '10:00', 'to': '14:00', 'days': 'sat,sun'}],
+    }), matches)
+    print('dateutil:                %6.2f us/match' % (before * 1e6))
+    print('fast path:               %6.2f us/match (%.1fx)' % (after * 1e6, before / after))
+    print('fast path, 3 windows:    %6.2f us/match' % (windows * 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
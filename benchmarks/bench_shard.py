@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+""" Throughput of the profiled rules in one process versus sharded over 1, 2, 4 and 8
+worker processes, for terms data and documents.
+
+Usage: python benchmarks/bench_shard.py [num_keys]
+"""
+from __future__ import print_function
+from datetime import datetime, timedelta
+import multiprocessing
+import sys
+import timeit
+
+from dateutil.tz import tzutc
+
+from elastalert_extensions import ruletypes
+
+
+WARMUP = 3
+RUNS = 5
+SHARDS = (1, 2, 4, 8)
+T0 = datetime(2018, 1, 1, tzinfo=tzutc())
+
+
+def make_rule(rule_class, **options):
+    rules = {
+        'name': 'bench',
+        'num_events': 50,
+        'threshold': 20,
+        'timeframe': timedelta(minutes=30),
+        'query_key': 'device',
+        'timestamp_field': '@timestamp',
+        'window_type': 'compact',
+        'batch_terms': True,
+    }
+    rules.update(options)
+    return rule_class(rules)
+
+
+def make_terms(num_keys, run):
+    ts = T0 + timedelta(minutes=run)
+    return {ts: [{'key': 'device%d' % i, 'doc_count': (i + run) % 7} for i in range(num_keys)]}
+
+
+def make_docs(num_keys, run):
+    ts = T0 + timedelta(minutes=run)
+    return [{'@timestamp': ts + timedelta(microseconds=i), 'device': 'device%d' % (i % num_keys), 'value': i}
+            for i in range(num_keys * 2)]
+
+
+def bench(rule, batches, add):
+    for data in batches[:WARMUP]:
+        add(rule, data)
+
+    def run():
+        for run, data in enumerate(batches[WARMUP:], WARMUP):
+            add(rule, data)
+            rule.garbage_collect(T0 + timedelta(minutes=run, seconds=59))
+            rule.matches = []
+
+    return timeit.timeit(run, number=1)
+
+
+def main(num_keys=20000):
+    print('cpus: %d' % multiprocessing.cpu_count())
+    for data_name, make, add in (
+            ('terms', make_terms, lambda rule, data: rule.add_terms_data(data)),
+            ('docs', make_docs, lambda rule, data: rule.add_data(data))):
+        batches = [make(num_keys, run) for run in range(WARMUP + RUNS)]
+        num_items = sum(len(b) if isinstance(b, list) else len(b.values()[0]) for b in batches[WARMUP:])
+        for rule_class, sharded_class in (
+                (ruletypes.ProfiledFrequencyRule, ruletypes.ShardedProfiledFrequencyRule),
+                (ruletypes.ProfiledThresholdRule, ruletypes.ShardedProfiledThresholdRule)):
+            name = '%s %s' % (rule_class.__name__, data_name)
+            elapsed = bench(make_rule(rule_class), batches, add)
+            print('%-32s single process: %9.0f items/s' % (name, num_items / elapsed))
+            for shards in SHARDS:
+                rule = make_rule(sharded_class, shards=shards)
+                elapsed = bench(rule, batches, add)
+                rule._pool.close()
+                print('%-32s %d shards:       %9.0f items/s' % (name, shards, num_items / elapsed))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+""" Time to save and restore the windows of a ProfiledFrequencyRule per window type.
+
+Usage: python benchmarks/bench_snapshot.py [num_keys] [buckets_per_key]
+"""
+from __future__ import print_function
+from datetime import datetime, timedelta
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from dateutil.tz import tzutc
+
+from elastalert_extensions.ruletypes import ProfiledFrequencyRule
+
+
+def make_rules(path, window_type):
+    return {
+        'name': 'bench',
+        'num_events': 10 ** 9,
+        'timeframe': timedelta(hours=1),
+        'query_key': 'device',
+        'timestamp_field': '@timestamp',
+        'window_type': window_type,
+        'snapshot_path': path,
+    }
+
+
+def fill(rule, num_keys, buckets_per_key):
+    t0 = datetime(2018, 1, 1, tzinfo=tzutc())
+    for step in range(buckets_per_key):
+        buckets = [{'key': 'device%d' % key, 'doc_count': 1 + key % 5} for key in range(num_keys)]
+        rule.add_terms_data({t0 + timedelta(minutes=step): buckets})
+
+
+def main(num_keys=100000, buckets_per_key=10):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for window_type in ('events', 'compact', 'buckets'):
+            path = os.path.join(tmpdir, window_type + '.snapshot')
+            rule = ProfiledFrequencyRule(make_rules(path, window_type))
+            fill(rule, num_keys, buckets_per_key)
+            start = time.time()
+            rule.save_snapshot()
+            saved = time.time() - start
+            start = time.time()
+            restored = ProfiledFrequencyRule(make_rules(path, window_type))
+            restored._begin_batch()
+            loaded = time.time() - start
+            assert len(restored.occurrences) == num_keys
+            print('%-8s save %6.2fs, restore %6.2fs, %6.1f MB' % (
+                window_type, saved, loaded, os.path.getsize(path) / 1e6))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
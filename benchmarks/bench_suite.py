@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+""" Throughput, per-batch latency and peak RSS of every rule type and alerter on
+synthetic load from loadgen, each scenario running in a process of its own.
+
+Usage: python benchmarks/bench_suite.py [--cardinality N] [--rate N] [--depth N]
+           [--batches N] [--output results.json] [--compare baseline.json] [scenario ...]
+"""
+from __future__ import print_function
+import argparse
+from datetime import timedelta
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+from timeit import default_timer
+
+from loadgen import LoadGenerator
+
+
+BLACKLIST = ['fault', 'offline', 'E00*']
+SCHEDULE = {'timezone': 'UTC', 'from': '08:00', 'to': '18:00'}
+
+
+def blacklist_duration(gen, data):
+    from elastalert_extensions.ruletypes import BlacklistDurationRule
+    return BlacklistDurationRule({
+        'name': 'bench', 'timestamp_field': '@timestamp', 'query_key': gen.key_field,
+        'compound_compare_key': [gen.status_field], 'ignore_null': True,
+        'blacklist': BLACKLIST, 'blacklist_wildcards': True, 'timeframe': timedelta(hours=1),
+        'max_tracked_keys': gen.cardinality})
+
+
+def compound_blacklist(gen, data):
+    from elastalert_extensions.ruletypes import CompoundBlacklistRule
+    return CompoundBlacklistRule({
+        'name': 'bench', 'timestamp_field': '@timestamp', 'compare_key': 'alarm',
+        'blacklist': BLACKLIST, 'blacklist_wildcards': True})
+
+
+def profiled_rule(rule_class):
+    def make(gen, data):
+        from elastalert_extensions import ruletypes
+        rules = {
+            'name': 'bench', 'timestamp_field': '@timestamp', 'timeframe': timedelta(minutes=10),
+            'num_events': 10 * gen.rate * gen.batch_seconds // gen.cardinality + 1,
+            'threshold': gen.rate * gen.batch_seconds // gen.cardinality + 1,
+            'window_type': 'compact', 'batch_terms': True,
+        }
+        if data != 'count':
+            rules['query_key'] = gen.key_field
+        return getattr(ruletypes, rule_class)(rules)
+    return make
+
+
+def amqp_alerter(batch_mode, scheduled=False, rate_limit=None, sketch=False):
+    def make(gen, data):
+        from elastalert_extensions.alerts import AmqpAlerter, ScheduledAlerter
+        rule = {'name': 'bench', 'timestamp_field': '@timestamp', 'query_key': 'device',
+                'amqp_url': 'memory://', 'amqp_password': 'bench', 'amqp_batch_mode': batch_mode}
+        if rate_limit:
+            rule.update(amqp_rate_limit=rate_limit, amqp_dedup_sketch=sketch)
+        if scheduled:
+            rule['schedule'] = SCHEDULE
+
+            class ScheduledAmqpAlerter(ScheduledAlerter, AmqpAlerter):
+                pass
+            return ScheduledAmqpAlerter(rule)
+        return AmqpAlerter(rule)
+    return make
+
+
+# name: (factory, kind of data)
+SCENARIOS = {
+    'blacklist_duration_docs': (blacklist_duration, 'docs'),
+    'compound_blacklist_docs': (compound_blacklist, 'docs'),
+    'frequency_docs': (profiled_rule('ProfiledFrequencyRule'), 'docs'),
+    'frequency_terms': (profiled_rule('ProfiledFrequencyRule'), 'terms'),
+    'frequency_count': (profiled_rule('ProfiledFrequencyRule'), 'count'),
+    'threshold_docs': (profiled_rule('ProfiledThresholdRule'), 'docs'),
+    'threshold_terms': (profiled_rule('ProfiledThresholdRule'), 'terms'),
+    'threshold_count': (profiled_rule('ProfiledThresholdRule'), 'count'),
+    'amqp_match': (amqp_alerter('match'), 'matches'),
+    'amqp_message': (amqp_alerter('message'), 'matches'),
+    'scheduled_amqp_message': (amqp_alerter('message', scheduled=True), 'matches'),
+    'amqp_rate_limited': (amqp_alerter('match', rate_limit=1), 'matches'),
+    'amqp_rate_limited_sketch': (amqp_alerter('match', rate_limit=1, sketch=True), 'matches'),
+}
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def run_scenario(name, params):
+    """ Feed params['batches'] batches to a new instance of the scenario, timing the
+    calls elastalert would make for each, including garbage_collect for rules. """
+    factory, data = SCENARIOS[name]
+    gen = LoadGenerator(**dict((k, params[k]) for k in ('cardinality', 'rate', 'depth', 'batch_seconds', 'seed')))
+    target = factory(gen, data)
+    latencies = []
+    events = matches = 0
+    for batch in range(params['batches']):
+        if data == 'docs':
+            payload = gen.docs(batch)
+            call, count = target.add_data, len(payload)
+        elif data == 'terms':
+            payload = gen.terms(batch)
+            call, count = target.add_terms_data, sum(b['doc_count'] for b in payload.values()[0])
+        elif data == 'count':
+            payload = gen.counts(batch)
+            call, count = target.add_count_data, payload.values()[0]
+        else:
+            payload = gen.matches(batch, gen.events_per_batch())
+            call, count = target.alert, len(payload)
+        start = default_timer()
+        call(payload)
+        if data != 'matches':
+            target.garbage_collect(gen.batch_end(batch))
+            matches += len(target.matches)
+            target.matches = []
+        latencies.append(default_timer() - start)
+        events += count
+    seconds = sum(latencies)
+    latencies.sort()
+    return {
+        'events': events,
+        'matches': matches,
+        'seconds': seconds,
+        'events_per_sec': events / seconds if seconds else None,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        # Kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+
+
+def _child(name, params, conn):
+    try:
+        conn.send(('ok', run_scenario(name, params)))
+    except Exception as e:
+        conn.send(('error', '%s: %s' % (type(e).__name__, e)))
+
+
+def run_isolated(name, params):
+    """ run_scenario in a new process, so peak RSS is that of the scenario. """
+    conn, child_conn = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=_child, args=(name, params, child_conn))
+    proc.start()
+    status, result = conn.recv()
+    proc.join()
+    if status == 'error':
+        raise RuntimeError('Scenario %s failed: %s' % (name, result))
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run, all by default: %s' %
+                        ', '.join(sorted(SCENARIOS)))
+    parser.add_argument('--cardinality', type=int, default=1000)
+    parser.add_argument('--rate', type=int, default=200, help='events per second of event time')
+    parser.add_argument('--depth', type=int, default=1, help='nesting depth of the document fields')
+    parser.add_argument('--batch-seconds', type=int, default=60)
+    parser.add_argument('--batches', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='a previous output to compare events/sec with')
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios %s' % ', '.join(sorted(unknown)))
+
+    params = dict((k, getattr(args, k)) for k in
+                  ('cardinality', 'rate', 'depth', 'batch_seconds', 'batches', 'seed'))
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    results = {}
+    print('%-24s %12s %10s %10s %9s' % ('scenario', 'events/s', 'p50 ms', 'p99 ms', 'RSS MB'))
+    for name in args.scenarios or sorted(SCENARIOS):
+        result = results[name] = run_isolated(name, params)
+        line = '%-24s %12.0f %10.2f %10.2f %9.1f' % (
+            name, result['events_per_sec'] or 0, result['p50_ms'], result['p99_ms'], result['peak_rss_mb'])
+        previous = baseline.get(name, {}).get('events_per_sec')
+        if previous and result['events_per_sec']:
+            line += ' %+6.1f%%' % (100.0 * (result['events_per_sec'] / previous - 1))
+        print(line)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'time': time.time(), 'python': platform.python_version(),
+                       'platform': platform.platform(), 'params': params, 'results': results},
+                      f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
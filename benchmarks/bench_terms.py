@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+""" add_terms_data throughput of the per-bucket loop versus batch_terms.
+
+Usage: python benchmarks/bench_terms.py [num_buckets ...]
+"""
+from __future__ import print_function
+from datetime import datetime, timedelta
+import sys
+import timeit
+
+from dateutil.tz import tzutc
+
+from elastalert_extensions import batch
+from elastalert_extensions import ruletypes
+
+
+WARMUP = 10
+RUNS = 5
+
+
+def make_rule(rule_class, batch_terms):
+    return rule_class({
+        'num_events': 50,
+        'threshold': 20,
+        'timeframe': timedelta(minutes=30),
+        'query_key': 'device',
+        'timestamp_field': '@timestamp',
+        'window_type': 'compact',
+        'batch_terms': batch_terms,
+    })
+
+
+def make_terms(num_buckets, run):
+    ts = datetime(2018, 1, 1, tzinfo=tzutc()) + timedelta(minutes=run)
+    return {ts: [{'key': 'device%d' % i, 'doc_count': (i + run) % 7} for i in range(num_buckets)]}
+
+
+def bench(rule_class, batch_terms, num_buckets):
+    terms = [make_terms(num_buckets, run) for run in range(WARMUP + RUNS)]
+    rule = make_rule(rule_class, batch_terms)
+    # Time the steady state, once every key has a window and a settled status
+    for data in terms[:WARMUP]:
+        rule.add_terms_data(data)
+    terms = terms[WARMUP:]
+
+    def run():
+        for data in terms:
+            rule.add_terms_data(data)
+
+    elapsed = timeit.timeit(run, number=1)
+    return elapsed / (RUNS * num_buckets), rule.matches
+
+
+def main(sizes):
+    print('numpy: %s' % ('yes' if batch.numpy is not None else 'no'))
+    for rule_class in (ruletypes.ProfiledFrequencyRule, ruletypes.ProfiledThresholdRule):
+        for num_buckets in sizes:
+            before, expected = bench(rule_class, False, num_buckets)
+            after, matches = bench(rule_class, True, num_buckets)
+            assert matches == expected
+            print('%-22s %7d buckets: per-bucket %6.2f us, batched %6.2f us, %.1fx' % (
+                rule_class.__name__, num_buckets, before * 1e6, after * 1e6, before / after))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000])
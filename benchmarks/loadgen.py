@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+""" Synthetic load shaped like what elastalert hands to rule types: documents for
+add_data, terms aggregation buckets for add_terms_data and counts for add_count_data.
+
+Every batch is generated from its own seed, so a batch is the same whatever was
+generated before it, and runs with the same parameters are comparable.
+"""
+from __future__ import print_function
+from datetime import datetime, timedelta
+import random
+
+from dateutil.tz import tzutc
+
+
+START = datetime(2018, 1, 1, tzinfo=tzutc())
+STATUSES = ('ok', 'ok', 'ok', 'ok', 'fault', 'offline')
+ALARMS = ('E001', 'E002', 'W100', 'W200', 'I300')
+
+
+class LoadGenerator(object):
+    """ Batches of batch_seconds of data over cardinality query keys at rate events per
+    second, the key of a document being nested depth levels deep.
+
+    :param cardinality: The number of distinct query keys.
+    :param rate: Events per second over all keys.
+    :param depth: The nesting depth of the query key and status fields, 1 for top level.
+    :param batch_seconds: The time covered by a batch.
+    :param seed: The seed the batch seeds derive from.
+    """
+
+    def __init__(self, cardinality=1000, rate=100, depth=1, batch_seconds=60, seed=0, start=START):
+        self.cardinality = cardinality
+        self.rate = rate
+        self.depth = depth
+        self.batch_seconds = batch_seconds
+        self.seed = seed
+        self.start = start
+        prefix = '.'.join(['meta'] * (depth - 1))
+        self.key_field = prefix + '.device' if prefix else 'device'
+        self.status_field = prefix + '.status' if prefix else 'status'
+
+    def _random(self, batch):
+        return random.Random(self.seed * 1000003 + batch)
+
+    def batch_start(self, batch):
+        return self.start + timedelta(seconds=batch * self.batch_seconds)
+
+    def batch_end(self, batch):
+        return self.batch_start(batch + 1)
+
+    def events_per_batch(self):
+        return int(self.rate * self.batch_seconds)
+
+    def _nest(self, fields):
+        for _ in range(self.depth - 1):
+            fields = {'meta': fields}
+        return fields
+
+    def docs(self, batch):
+        """ Documents of a batch in timestamp order, the timestamps being datetimes as
+        elastalert gives them to rules. """
+        rand = self._random(batch)
+        start = self.batch_start(batch)
+        num_events = self.events_per_batch()
+        step = float(self.batch_seconds) / max(num_events, 1)
+        docs = []
+        for i in range(num_events):
+            doc = self._nest({'device': 'device%d' % rand.randrange(self.cardinality),
+                              'status': rand.choice(STATUSES)})
+            doc['@timestamp'] = start + timedelta(seconds=i * step)
+            doc['alarm'] = rand.sample(ALARMS, rand.randint(0, 2))
+            docs.append(doc)
+        return docs
+
+    def terms(self, batch):
+        """ {endtime: buckets} of the doc_count per key of a batch, for add_terms_data. """
+        rand = self._random(batch)
+        counts = {}
+        for _ in range(self.events_per_batch()):
+            key = 'device%d' % rand.randrange(self.cardinality)
+            counts[key] = counts.get(key, 0) + 1
+        buckets = [{'key': key, 'doc_count': count} for key, count in sorted(counts.items())]
+        return {self.batch_end(batch): buckets}
+
+    def counts(self, batch):
+        """ {endtime: count} of a batch, for add_count_data. """
+        rand = self._random(batch)
+        mean = self.events_per_batch()
+        return {self.batch_end(batch): max(0, int(rand.gauss(mean, mean ** 0.5)))}
+
+    def matches(self, batch, num_matches):
+        """ Matches like those of BlacklistDurationRule, for the alerters. """
+        rand = self._random(batch)
+        end = self.batch_end(batch)
+        return [{
+            '@timestamp': end.isoformat(),
+            'device': 'device%d' % rand.randrange(self.cardinality),
+            'value': [rand.choice(STATUSES)],
+            'start_time': (end - timedelta(seconds=600)).isoformat(),
+            'duration': 600.0,
+        } for _ in range(num_matches)]
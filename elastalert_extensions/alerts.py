@@ -1,43 +1,117 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
-from datetime import time
-from dateutil import parser
+import threading
+import time
+
 from elastalert import alerts
-from kombu import Connection, Exchange
-from kombu.pools import producers
+from elastalert.util import EAException
+from elastalert.util import elastalert_logger
+from elastalert.util import hashable
+from kombu import Exchange
 from os import environ, path
-from pytz import timezone
+
+from elastalert_extensions.blacklist import string_types
+from elastalert_extensions.dedup import AlertLimiter
+from elastalert_extensions.dedup import DIGEST_KEYS
+from elastalert_extensions.dedup import MAX_KEYS
+from elastalert_extensions.dedup import SKETCH_DEPTH
+from elastalert_extensions.dedup import SKETCH_WIDTH
+from elastalert_extensions.dispatch import BACKOFF
+from elastalert_extensions.dispatch import Dispatcher
+from elastalert_extensions.dispatch import MAX_RETRIES
+from elastalert_extensions.dispatch import QUEUE_SIZE
+from elastalert_extensions.fields import field_getter
+from elastalert_extensions.lifecycle import at_exit
+from elastalert_extensions.lifecycle import cancel_at_exit
+from elastalert_extensions.lifecycle import replace
+from elastalert_extensions.metrics import REGISTRY
+from elastalert_extensions.metrics import start_exporters
+from elastalert_extensions.publisher import BATCH_MODES
+from elastalert_extensions.publisher import BATCH_SIZE
+from elastalert_extensions.publisher import chunks
+from elastalert_extensions.publisher import HEARTBEAT
+from elastalert_extensions.publisher import Publisher
+from elastalert_extensions.schedule import parse_time  # noqa: F401
+from elastalert_extensions.schedule import Schedule
+from elastalert_extensions.schedule import ts_to_us
+from elastalert_extensions.spool import Spool
+from elastalert_extensions.spool import SPOOL_SIZE
 
 
-utc = timezone('UTC')
+FLUSH_INTERVAL = 60.0
+RATE_PERIOD = 60.0
+DIGEST_INTERVAL = 300.0
 
 
-def parse_time(s):
-    if not s:
-        return None
-    return time(*tuple(map(int, s.split(':'))))
+def parse_bool(value):
+    """ Options may come from the environment as strings. """
+    if isinstance(value, string_types):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
 
 
 class InTimeframe(object):
+    """ Whether an entry's timestamp falls in a Schedule. """
     def __init__(self, timestamp_field, schedule):
         self.timestamp_field = timestamp_field
-        self.tz = timezone(schedule.get('timezone', 'UTC'))
-        self.from_ = parse_time(schedule.get('from', None))
-        self.to = parse_time(schedule.get('to', None))
+        self.schedule = Schedule(schedule)
+        self.tz = self.schedule.tz
 
     def __call__(self, entry):
-        dt = parser.parse(entry[self.timestamp_field])
-        if not dt.tzinfo:
-            dt = utc.localize(dt)
-        t = dt.astimezone(self.tz).time()
-        if self.from_ and t < self.from_:
-            return False
-        if self.to and t > self.to:
-            return False
-        return True
+        if self.schedule.always:
+            return True
+        return ts_to_us(entry[self.timestamp_field]) in self.schedule
+
+
+class SpoolFlusher(threading.Thread):
+    """ A daemon thread calling flush_spool() of a ScheduledAlerter every interval seconds. """
+
+    def __init__(self, alerter, interval=FLUSH_INTERVAL):
+        super(SpoolFlusher, self).__init__(name='SpoolFlusher(%s)' % alerter.spool.path)
+        self.daemon = True
+        self.alerter = alerter
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.alerter.flush_spool()
+            except Exception as e:
+                elastalert_logger.error('Cannot flush spool %s: %s', self.alerter.spool.path, e)
+
+    def stop(self):
+        self._stopped.set()
+
+
+class DigestFlusher(threading.Thread):
+    """ A daemon thread calling flush_digest() of an AmqpAlerter every interval seconds. """
+
+    def __init__(self, alerter, interval=DIGEST_INTERVAL):
+        super(DigestFlusher, self).__init__(name='DigestFlusher(%s)' % alerter.rule.get('name'))
+        self.daemon = True
+        self.alerter = alerter
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.alerter.flush_digest()
+            except Exception as e:
+                elastalert_logger.error('Cannot send digest of rule %s: %s', self.alerter.rule.get('name'), e)
+
+    def stop(self):
+        self._stopped.set()
 
 
 class ScheduledAlerter(object):
+    """ Sends only the matches in the schedule, see Schedule.
+
+    With defer set in the schedule, the other matches are kept in a Spool at
+    spool_path instead of being dropped, one per query key, and sent together in a
+    single alert once the schedule is open, checked every flush_interval seconds.
+    """
     def __init__(self, rule):
         self.alerter = next((x for x in self.__class__.__bases__
                              if issubclass(x, alerts.Alerter)),
@@ -45,18 +119,62 @@ class ScheduledAlerter(object):
         if self.alerter:
             self.alerter.__init__(self, rule)
 
+        schedule = rule.get('schedule', {})
         self.in_timeframe = InTimeframe(
             timestamp_field=rule['timestamp_field'],
-            schedule=rule.get('schedule', {}))
+            schedule=schedule)
+        self.spool = None
+        if schedule.get('defer'):
+            if not schedule.get('spool_path'):
+                raise EAException('Deferring out of schedule matches requires schedule.spool_path')
+            self.spool = Spool(schedule['spool_path'], max_entries=schedule.get('spool_size', SPOOL_SIZE))
+            self.get_key = field_getter(rule['query_key']) if rule.get('query_key') else None
+            self._spool_lock = threading.Lock()
+            self._flusher = SpoolFlusher(self, interval=schedule.get('flush_interval', FLUSH_INTERVAL))
+            self._flusher.start()
+
+    def close(self):
+        """ Stop flushing the spool, once elastalert replaced the alerter. """
+        if self.spool is not None:
+            self._flusher.stop()
+            with self._spool_lock:
+                self.spool.close()
+        if self.alerter and hasattr(self.alerter, 'close'):
+            self.alerter.close(self)
 
     def alert(self, matches):
-        matches = filter(self.in_timeframe, matches)
-        if matches:
+        replace('scheduled alerter', self.rule, self)
+        if self.spool is None:
+            matches = filter(self.in_timeframe, matches)
+            if matches:
+                self.alerter.alert(self, matches)
+            return
+
+        with self._spool_lock:
+            in_schedule = []
+            for match in matches:
+                if self.in_timeframe(match):
+                    in_schedule.append(match)
+                else:
+                    self.spool.add(self.get_key and hashable(self.get_key(match)), match)
+            self._flush_spool(in_schedule)
+
+    def flush_spool(self):
+        """ Send the spooled matches if the schedule is open now. """
+        with self._spool_lock:
+            self._flush_spool([])
+
+    def _flush_spool(self, matches):
+        if len(self.spool) and int(time.time() * 1000000) in self.in_timeframe.schedule:
+            self.alerter.alert(self, self.spool.matches() + matches)
+            # Only once they were sent
+            self.spool.clear()
+        elif matches:
             self.alerter.alert(self, matches)
 
     def get_info(self):
         if self.alerter:
-            info = self.alert.get_info(self)
+            info = self.alerter.get_info(self)
         else:
             info = {'type': ''}
         info['type'] = 'scheduled_{}'.format(info['type'])
@@ -68,7 +186,21 @@ class ScheduledDebugAlerter(ScheduledAlerter, alerts.DebugAlerter):
 
 
 class AmqpAlerter(alerts.Alerter):
-    """ The amqp alerter publishes alerts via amqp to a broker. """
+    """ The amqp alerter publishes alerts via amqp to a broker.
+
+    With amqp_batch_mode match, every match is a message of its own, with message
+    up to amqp_batch_size matches go in one message. Publisher confirms, if
+    amqp_confirm is set, are awaited once per batch of amqp_batch_size matches.
+
+    With amqp_async, alert() only queues the batches, and a Dispatcher thread
+    publishes them, so a slow broker does not hold up the rule loop.
+
+    With amqp_rate_limit set, at most that many matches per query key and status,
+    or amqp_dedup_fields, are sent every amqp_rate_period seconds, see AlertLimiter.
+    The others are counted in a digest sent as one message every
+    amqp_digest_interval seconds. amqp_dedup_sketch keeps the counts in a fixed size
+    sketch rather than the amqp_dedup_max_keys most recent keys.
+    """
     def __init__(self, rule):
         super(AmqpAlerter, self).__init__(rule)
         params = {
@@ -81,40 +213,121 @@ class AmqpAlerter(alerts.Alerter):
         if not params['password']:
             with open(path.join('/', 'config', params['username']), 'r') as pwd_file:
                 params['password'] = pwd_file.read().strip()
-        self._url = (
+        self._url = self.get_param('amqp_url', None) or (
             'amqp://{username}:{password}@{host}:{port}/{vhost}'
             .format(**params)
         )
         exchange = self.get_param('amqp_exchange', 'alert')
         self._exchange = Exchange(exchange, type='fanout')
         self._routing_key = self.get_param('amqp_routing_key', 'alert')
-        self._conn = None
+        self._batch_mode = self.get_param('amqp_batch_mode', 'match')
+        if self._batch_mode not in BATCH_MODES:
+            raise EAException('Unknown amqp_batch_mode %s' % self._batch_mode)
+        self._batch_size = int(self.get_param('amqp_batch_size', BATCH_SIZE))
+        self._publisher = Publisher(
+            self._url, self._exchange, self._routing_key,
+            serializer=self.get_param('amqp_serializer', 'json'),
+            heartbeat=int(self.get_param('amqp_heartbeat', HEARTBEAT)),
+            confirm=parse_bool(self.get_param('amqp_confirm', False)))
+        # Without a dispatcher, alert() and the digests publish from different threads
+        self._publish_lock = threading.Lock()
+        self._dispatcher = None
+        if parse_bool(self.get_param('amqp_async', False)):
+            max_retries = self.get_param('amqp_max_retries', MAX_RETRIES)
+            self._dispatcher = Dispatcher(
+                self._publisher,
+                maxsize=int(self.get_param('amqp_queue_size', QUEUE_SIZE)),
+                backpressure=self.get_param('amqp_backpressure', 'block'),
+                spill_path=self.get_param('amqp_spill_path', None),
+                max_retries=None if max_retries is None else int(max_retries),
+                backoff=float(self.get_param('amqp_retry_backoff', BACKOFF)))
+            self._dispatcher.start()
+            at_exit(self._dispatcher.stop)
+        self._limiter = None
+        rate_limit = self.get_param('amqp_rate_limit', None)
+        if rate_limit is not None:
+            self._limiter = AlertLimiter(
+                self.get_param('amqp_dedup_fields', None) or
+                ([self.rule['query_key']] if self.rule.get('query_key') else []) + ['status'],
+                int(rate_limit), float(self.get_param('amqp_rate_period', RATE_PERIOD)),
+                timestamp_field=self.rule.get('timestamp_field', '@timestamp'),
+                sketch=parse_bool(self.get_param('amqp_dedup_sketch', False)),
+                max_keys=int(self.get_param('amqp_dedup_max_keys', MAX_KEYS)),
+                width=int(self.get_param('amqp_sketch_width', SKETCH_WIDTH)),
+                depth=int(self.get_param('amqp_sketch_depth', SKETCH_DEPTH)),
+                digest_keys=int(self.get_param('amqp_digest_keys', DIGEST_KEYS)))
+            self._limiter_lock = threading.Lock()
+            self._digest_flusher = DigestFlusher(
+                self, interval=float(self.get_param('amqp_digest_interval', DIGEST_INTERVAL)))
+            self._digest_flusher.start()
+            # Registered after the dispatcher is, so run before it stops
+            at_exit(self.flush_digest)
+        if self.rule.get('metrics'):
+            REGISTRY.instrument(self._publisher, ['publish'], 'elastalert_amqp_publish_seconds',
+                                {'rule': self.rule.get('name')})
+            REGISTRY.register(self, AmqpAlerter._gauges)
+            start_exporters(self.rule)
+
+    def close(self):
+        """ Send the digest and what is queued and disconnect, once elastalert replaced the alerter. """
+        if self._limiter is not None:
+            self._digest_flusher.stop()
+            cancel_at_exit(self.flush_digest)
+            self.flush_digest()
+        if self._dispatcher is not None:
+            cancel_at_exit(self._dispatcher.stop)
+            self._dispatcher.stop()
+        with self._publish_lock:
+            self._publisher.close()
 
     def get_param(self, name, default):
         environ_name = name.upper()
         return self.rule.get(name, environ.get(environ_name, default))
 
     def alert(self, matches):
-        body = {
-            'rule': self.rule['name'],
-            'matches': matches,
-        }
+        replace('amqp alerter', self.rule, self)
+        if self._limiter is not None:
+            with self._limiter_lock:
+                matches = self._limiter.filter(matches, time.time())
+        for batch in chunks(matches, self._batch_size):
+            if self._batch_mode == 'message':
+                bodies = [{'rule': self.rule['name'], 'matches': batch}]
+            else:
+                bodies = [{'rule': self.rule['name'], 'match': match} for match in batch]
+            self._send(bodies)
 
-        with producers[self.conn()].acquire(block=True) as producer:
-            for match in matches:
-                body = {
-                    'rule': self.rule['name'],
-                    'match': match,
-                }
-                producer.publish(body,
-                                 serializer='json',
-                                 exchange=self._exchange,
-                                 routing_key=self._routing_key)
-
-    def conn(self):
-        if not self._conn:
-            self._conn = Connection(self._url)
-        return self._conn
+    def flush_digest(self):
+        """ Send the digest of the matches suppressed since the last one, if any. """
+        with self._limiter_lock:
+            digest = self._limiter.pop_digest()
+        if digest is not None:
+            self._send([{'rule': self.rule['name'], 'digest': digest}])
+
+    def _send(self, bodies):
+        if self._dispatcher is not None:
+            self._dispatcher.put(bodies)
+        else:
+            with self._publish_lock:
+                self._publisher.publish(bodies)
+
+    def get_metrics(self):
+        """ The dispatch queue metrics, if alerts are published asynchronously. """
+        if self._dispatcher is None:
+            return {}
+        return self._dispatcher.metrics()
+
+    def get_limiter_stats(self):
+        """ The matches admitted and suppressed and the digests sent, if alerts are rate limited. """
+        if self._limiter is None:
+            return {}
+        return dict(self._limiter.stats)
+
+    def _gauges(self):
+        labels = {'rule': self.rule.get('name')}
+        return ([('elastalert_amqp_dispatch_' + name, labels, value)
+                 for name, value in sorted(self.get_metrics().items())] +
+                [('elastalert_amqp_alerts_' + name, labels, value)
+                 for name, value in sorted(self.get_limiter_stats().items())])
 
     def get_info(self):
         return {'type': 'amqp'}
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+class TermsBatch(namedtuple('TermsBatch', ['keys', 'key_index', 'timestamps', 'counts'])):
+    """ A terms query response in columnar form, one row per bucket in response order.
+
+    :param keys: The distinct bucket keys.
+    :param key_index: For each bucket, the index of its key in keys.
+    :param timestamps: For each bucket, the timestamp of the query it came from.
+    :param counts: For each bucket, its doc_count.
+    """
+    __slots__ = ()
+
+    def __len__(self):
+        return len(self.key_index)
+
+    def repeated(self):
+        """ Positions of the buckets whose key has more than one bucket in the batch. """
+        if numpy is not None:
+            key_index = numpy.asarray(self.key_index, dtype=numpy.int64)
+            repeated = (numpy.bincount(key_index, minlength=len(self.keys)) > 1)[key_index]
+            return numpy.flatnonzero(repeated).tolist()
+        seen = [0] * len(self.keys)
+        for idx in self.key_index:
+            seen[idx] += 1
+        return [pos for pos, idx in enumerate(self.key_index) if seen[idx] > 1]
+
+
+def columnarize_terms(terms):
+    """ Convert the {timestamp: [bucket, ...]} terms data of elastalert into a TermsBatch. """
+    keys = []
+    index = {}
+    key_index = []
+    timestamps = []
+    counts = []
+    for timestamp, buckets in terms.items():
+        for bucket in buckets:
+            key = bucket['key']
+            idx = index.get(key)
+            if idx is None:
+                idx = index[key] = len(keys)
+                keys.append(key)
+            key_index.append(idx)
+            timestamps.append(timestamp)
+            counts.append(bucket['doc_count'])
+    return TermsBatch(keys, key_index, timestamps, counts)
+
+
+def at_least(values, minimum):
+    """ Positions i where values[i] >= minimum, or minimum[i] given a list of minimums. """
+    if numpy is not None:
+        return numpy.flatnonzero(numpy.asarray(values, dtype=numpy.float64) >=
+                                 numpy.asarray(minimum, dtype=numpy.float64)).tolist()
+    if isinstance(minimum, list):
+        return [idx for idx, (value, least) in enumerate(zip(values, minimum)) if value >= least]
+    return [idx for idx, value in enumerate(values) if value >= minimum]
+
+
+def at_least_mask(values, minimum):
+    """ For each value, whether it is >= minimum, or its own minimum given a list of them. """
+    if numpy is not None:
+        return (numpy.asarray(values, dtype=numpy.float64) >=
+                numpy.asarray(minimum, dtype=numpy.float64)).tolist()
+    if isinstance(minimum, list):
+        return [value >= least for value, least in zip(values, minimum)]
+    return [value >= minimum for value in values]
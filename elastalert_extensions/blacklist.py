@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import fnmatch
+import os.path
+import re
+import time
+
+from elastalert.util import elastalert_logger
+
+try:
+    string_types = basestring
+    text_type = unicode
+except NameError:  # pragma: no cover
+    string_types = str
+    text_type = str
+
+
+CHECK_INTERVAL = 60.0
+WILDCARDS = re.compile(r'[*?\[]')
+# Marks the end of a prefix in the trie, no term character can collide with it
+END = None
+
+
+class BlacklistMatcher(object):
+    """ A compiled blacklist supporting `term in matcher`.
+
+    Entries are expanded like CompareRule.expand_entries does, `!file /path/to/list`
+    adding every line of the file. Exact entries go to a frozenset. With wildcards
+    set, `prefix*` entries go to a character trie and other glob patterns to a single
+    compiled regex. The files are checked for changes by refresh() at most every
+    check_interval seconds, and the matcher is rebuilt only when one of them changed.
+    version counts the rebuilds, for the users of a shared matcher to notice them.
+    """
+
+    def __init__(self, entries, wildcards=False, check_interval=CHECK_INTERVAL):
+        self.entries = list(entries)
+        self.wildcards = wildcards
+        self.check_interval = check_interval
+        self._files = {}
+        self._check_ts = time.time()
+        # (exact, trie, pattern), read at once by a lookup
+        self._compiled = (frozenset(), {}, None)
+        self.version = 0
+        self.build()
+
+    def build(self):
+        exact = set()
+        prefixes = []
+        patterns = []
+        files = {}
+
+        def add(entry):
+            if not self.wildcards or not isinstance(entry, string_types) or not WILDCARDS.search(entry):
+                exact.add(entry)
+            elif entry.endswith('*') and not WILDCARDS.search(entry[:-1]):
+                prefixes.append(entry[:-1])
+            else:
+                patterns.append(fnmatch.translate(entry))
+
+        for entry in self.entries:
+            if isinstance(entry, string_types) and entry.startswith('!file'):
+                filename = entry.split()[1]
+                files[filename] = os.path.getmtime(filename)
+                with open(filename, 'r') as f:
+                    for line in f:
+                        add(line.rstrip())
+            else:
+                add(entry)
+
+        trie = {}
+        for prefix in prefixes:
+            node = trie
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node[END] = True
+
+        # Swapped in with a single assignment, a lookup running meanwhile in another
+        # rule sharing the matcher sees either all of the previous build or all of this one
+        self._compiled = (frozenset(exact), trie, re.compile('|'.join(patterns)) if patterns else None)
+        self._files = files
+        self.version += 1
+
+    def refresh(self):
+        """ Rebuild the matcher if a blacklist file changed. Returns whether it was rebuilt. """
+        if not self._files:
+            return False
+        now = time.time()
+        if now < self._check_ts + self.check_interval:
+            return False
+        self._check_ts = now
+
+        try:
+            if all(os.path.getmtime(filename) == mtime for filename, mtime in self._files.items()):
+                return False
+            elastalert_logger.info('Reloading blacklist %s', ', '.join(sorted(self._files)))
+            self.build()
+        except (OSError, IOError) as e:
+            elastalert_logger.error('Cannot reload blacklist: %s', e)
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._compiled[0])
+
+    @property
+    def exact(self):
+        """ The exact entries, with those of the files. """
+        return self._compiled[0]
+
+    def __contains__(self, term):
+        exact, trie, pattern = self._compiled
+        if term in exact:
+            return True
+        if not isinstance(term, string_types):
+            return False
+        if trie:
+            node = trie
+            for char in term:
+                if END in node:
+                    return True
+                node = node.get(char)
+                if node is None:
+                    break
+            else:
+                if END in node:
+                    return True
+        return pattern is not None and pattern.match(term) is not None
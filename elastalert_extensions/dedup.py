@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+""" Rate limiting of the alerts of a rule per fingerprint, the values of some fields of
+a match such as its query key and status, with the suppressed matches summarized. """
+from __future__ import absolute_import
+from array import array
+from collections import OrderedDict
+
+from elastalert_extensions.fields import fields_getter
+
+
+MAX_KEYS = 10000
+SKETCH_WIDTH = 4096
+SKETCH_DEPTH = 4
+DIGEST_KEYS = 100
+
+
+class TokenBuckets(object):
+    """ A token bucket per fingerprint holding up to limit tokens, refilled with limit
+    tokens per period seconds, an alert taking one.
+
+    Only the max_keys most recently used buckets are kept, so a fingerprint not seen
+    for long gets a full bucket again. Buckets full again are dropped on the way, being
+    no different from new ones.
+    """
+
+    def __init__(self, limit, period, max_keys=MAX_KEYS):
+        self.limit = limit
+        self.rate = float(limit) / period
+        self.max_keys = max_keys
+        # Fingerprints to (tokens, time), least recently updated first
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def admit(self, fingerprint, now):
+        buckets = self._buckets
+        state = buckets.pop(fingerprint, None)
+        if state is None:
+            tokens = self.limit
+        else:
+            tokens = min(self.limit, state[0] + (now - state[1]) * self.rate)
+        admitted = tokens >= 1
+        buckets[fingerprint] = (tokens - 1 if admitted else tokens, now)
+        self._expire(now)
+        return admitted
+
+    def _expire(self, now):
+        buckets = self._buckets
+        while buckets:
+            oldest = next(iter(buckets))
+            tokens, ts = buckets[oldest]
+            if len(buckets) <= self.max_keys and tokens + (now - ts) * self.rate < self.limit:
+                return
+            del buckets[oldest]
+
+
+class SketchLimiter(object):
+    """ At most limit alerts per fingerprint over the last period seconds, for more
+    fingerprints than TokenBuckets can keep.
+
+    The alerts of the current and the previous period are counted in two count-min
+    sketches of depth rows of width counters, the previous one weighing what is left of
+    it in the sliding window. Memory does not grow with the fingerprints. Counts are
+    never underestimated, so a fingerprint colliding with busy ones may be limited
+    early, never late.
+    """
+
+    def __init__(self, limit, period, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        self.limit = limit
+        self.period = float(period)
+        self.width = width
+        self.depth = depth
+        self._current = self._new()
+        self._previous = self._new()
+        self._window = None
+
+    def __len__(self):
+        return self.width * self.depth
+
+    def _new(self):
+        return array('l', [0]) * (self.width * self.depth)
+
+    def _cells(self, fingerprint):
+        # Double hashing, one cell per row
+        first = hash(fingerprint)
+        second = hash((first, fingerprint)) | 1
+        width = self.width
+        return [row * width + (first + row * second) % width for row in range(self.depth)]
+
+    def admit(self, fingerprint, now):
+        window = int(now // self.period)
+        if window != self._window:
+            if self._window is not None and window == self._window + 1:
+                self._previous = self._current
+            else:
+                self._previous = self._new()
+            self._current = self._new()
+            self._window = window
+        current, previous = self._current, self._previous
+        cells = self._cells(fingerprint)
+        count = min(current[cell] for cell in cells)
+        left = 1.0 - (now / self.period - window)
+        if count + min(previous[cell] for cell in cells) * left >= self.limit:
+            return False
+        # Conservative update, only the cells at the minimum
+        for cell in cells:
+            if current[cell] == count:
+                current[cell] = count + 1
+        return True
+
+
+class Digest(object):
+    """ The suppressed matches per fingerprint, their count and first and last
+    timestamps, for at most max_keys fingerprints, the others being only counted. """
+
+    def __init__(self, max_keys=DIGEST_KEYS):
+        self.max_keys = max_keys
+        self.total = 0
+        self.other = 0
+        self._keys = OrderedDict()
+
+    def __len__(self):
+        return self.total
+
+    def add(self, fingerprint, timestamp):
+        self.total += 1
+        entry = self._keys.get(fingerprint)
+        if entry is not None:
+            entry[0] += 1
+            entry[2] = timestamp
+        elif len(self._keys) < self.max_keys:
+            self._keys[fingerprint] = [1, timestamp, timestamp]
+        else:
+            self.other += 1
+
+    def summary(self, fields):
+        """ The digest as a message body part, fields naming the values of the fingerprints. """
+        keys = []
+        for fingerprint, (count, first, last) in self._keys.items():
+            key = dict(zip(fields, fingerprint))
+            key.update(count=count, first=first, last=last)
+            keys.append(key)
+        return {'suppressed': self.total, 'keys': keys, 'other': self.other}
+
+
+class AlertLimiter(object):
+    """ Lets through at most limit matches per fingerprint, the values of fields, every
+    period seconds, with TokenBuckets or, with sketch set, a SketchLimiter. The others
+    go to a Digest taken with pop_digest.
+
+    :param fields: The fields of a match making its fingerprint.
+    :param limit: The matches let through per fingerprint and period.
+    :param period: The period in seconds.
+    :param timestamp_field: The field of the timestamp of a match, for the digest.
+    """
+
+    def __init__(self, fields, limit, period, timestamp_field='@timestamp', sketch=False,
+                 max_keys=MAX_KEYS, width=SKETCH_WIDTH, depth=SKETCH_DEPTH, digest_keys=DIGEST_KEYS):
+        self.fields = list(fields)
+        self.get_fingerprint = fields_getter(self.fields)
+        self.timestamp_field = timestamp_field
+        if sketch:
+            self.limiter = SketchLimiter(limit, period, width=width, depth=depth)
+        else:
+            self.limiter = TokenBuckets(limit, period, max_keys=max_keys)
+        self.digest_keys = digest_keys
+        self.digest = Digest(digest_keys)
+        self.stats = {'admitted': 0, 'suppressed': 0, 'digests': 0}
+
+    def filter(self, matches, now):
+        """ The matches let through at now, in order. """
+        admitted = []
+        admit = self.limiter.admit
+        for match in matches:
+            fingerprint = self.get_fingerprint(match)
+            try:
+                passed = admit(fingerprint, now)
+            except TypeError:
+                # Unhashable values are not limited
+                passed = True
+            if passed:
+                admitted.append(match)
+            else:
+                self.digest.add(fingerprint, match.get(self.timestamp_field))
+        self.stats['admitted'] += len(admitted)
+        self.stats['suppressed'] += len(matches) - len(admitted)
+        return admitted
+
+    def pop_digest(self):
+        """ The summary of the matches suppressed since the last call, None if none were. """
+        if not len(self.digest):
+            return None
+        summary = self.digest.summary(self.fields)
+        self.digest = Digest(self.digest_keys)
+        self.stats['digests'] += 1
+        return summary
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from collections import deque
+import io
+import json
+import os
+import threading
+import time
+
+from elastalert.util import EAException, elastalert_logger
+from kombu.utils import json as kombu_json
+
+from elastalert_extensions.status import atomic_write
+
+
+QUEUE_SIZE = 1000
+MAX_RETRIES = 5
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+IDLE_INTERVAL = 1.0
+STOP_TIMEOUT = 10.0
+BACKPRESSURE_MODES = ('block', 'drop_oldest', 'spill')
+
+
+class Dispatcher(threading.Thread):
+    """ A daemon thread publishing batches of message bodies queued by put().
+
+    The queue holds at most maxsize batches. When it is full, put() waits with
+    backpressure block, discards the oldest batch with drop_oldest, and with spill
+    appends the batch to spill_path, after which batches keep going to the file
+    until the worker has replayed it, so they are published in order. A spill file
+    left by a previous process is replayed on start. A failed publish is retried
+    max_retries times, None for no limit, backing off exponentially from backoff to
+    max_backoff seconds. While idle, the worker services the publisher heartbeats.
+    Delivery is at least once, a replay interrupted by a crash starts over.
+
+    :param publisher: An object with publish(bodies) and heartbeat_check().
+    """
+
+    def __init__(self, publisher, maxsize=QUEUE_SIZE, backpressure='block', spill_path=None,
+                 max_retries=MAX_RETRIES, backoff=BACKOFF, max_backoff=MAX_BACKOFF,
+                 idle_interval=IDLE_INTERVAL):
+        super(Dispatcher, self).__init__(name='Dispatcher')
+        if backpressure not in BACKPRESSURE_MODES:
+            raise EAException('Unknown backpressure mode %s' % backpressure)
+        if backpressure == 'spill' and not spill_path:
+            raise EAException('Backpressure mode spill requires a spill path')
+        self.daemon = True
+        self.publisher = publisher
+        self.maxsize = maxsize
+        self.backpressure = backpressure
+        self.spill_path = spill_path
+        self.draining_path = spill_path and spill_path + '.draining'
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.idle_interval = idle_interval
+        self.stats = {'enqueued': 0, 'published': 0, 'dropped': 0, 'spilled': 0,
+                      'retries': 0, 'failed': 0}
+        self.publish_latency = self.publish_latency_max = 0.0
+        self.queue_latency = self.queue_latency_max = 0.0
+        self._queue = deque()
+        # The batch the worker is publishing, spilled by stop() if the worker is stuck with it
+        self._in_flight = None
+        self._cond = threading.Condition()
+        self._stopped = threading.Event()
+        self._aborted = threading.Event()
+        self._spill_pending = bool(spill_path) and (os.path.exists(spill_path) or
+                                                    os.path.exists(self.draining_path))
+
+    def put(self, bodies):
+        """ Queue a batch of bodies for publishing, unless stopped. """
+        with self._cond:
+            if self._stopped.is_set():
+                # Nothing would publish it
+                raise EAException('Dispatcher stopped')
+            while len(self._queue) >= self.maxsize or (self._spill_pending and
+                                                       self.backpressure == 'spill'):
+                if self.backpressure == 'spill':
+                    self._spill([(time.time(), bodies)])
+                    self.stats['spilled'] += 1
+                    self._cond.notify_all()
+                    return
+                if self.backpressure == 'drop_oldest':
+                    self._queue.popleft()
+                    self.stats['dropped'] += 1
+                elif self._stopped.is_set():
+                    raise EAException('Dispatcher stopped')
+                else:
+                    self._cond.wait()
+            self._queue.append((time.time(), bodies))
+            self.stats['enqueued'] += 1
+            self._cond.notify_all()
+
+    def metrics(self):
+        with self._cond:
+            metrics = dict(self.stats)
+            metrics.update(depth=len(self._queue),
+                           spill_pending=self._spill_pending,
+                           publish_latency=self.publish_latency,
+                           publish_latency_max=self.publish_latency_max,
+                           queue_latency=self.queue_latency,
+                           queue_latency_max=self.queue_latency_max)
+        return metrics
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """ Publish what is queued within timeout seconds, spilling the rest if we can. """
+        self._stopped.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self.is_alive():
+            self.join(timeout)
+            self._aborted.set()
+            self.join(self.idle_interval)
+        with self._cond:
+            items = list(self._queue)
+            if self._in_flight is not None:
+                # Still being published, delivered again if that ever completes
+                items.insert(0, self._in_flight)
+            if items and self.spill_path:
+                # Ahead of anything spilled before, which is newer
+                self._queue.clear()
+                self._in_flight = None
+                spilled = b''
+                if os.path.exists(self.spill_path):
+                    with io.open(self.spill_path, 'rb') as spill:
+                        spilled = spill.read()
+                atomic_write(self.spill_path,
+                             lambda f: f.write(b''.join(self._dump(item) for item in items) + spilled),
+                             mode='wb')
+                self._spill_pending = True
+                self.stats['spilled'] += len(items)
+
+    def run(self):
+        while True:
+            with self._cond:
+                if not self._queue and not self._spill_pending and not self._stopped.is_set():
+                    self._cond.wait(self.idle_interval)
+                item = spill = None
+                if self._queue:
+                    item = self._in_flight = self._queue.popleft()
+                    self._cond.notify_all()
+                elif self._spill_pending:
+                    spill = True
+                elif self._stopped.is_set():
+                    return
+            if item is not None:
+                published = self._publish(*item)
+                with self._cond:
+                    if self._in_flight is not item:
+                        # Spilled by stop() meanwhile
+                        return
+                    self._in_flight = None
+                    if published is None:
+                        self._queue.appendleft(item)
+                        return
+            elif spill:
+                if not self._replay_spill():
+                    return
+            else:
+                self.publisher.heartbeat_check()
+
+    def _publish(self, enqueued, bodies):
+        """ Returns whether bodies were published, or None if stop() gave up on them. """
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                self.publisher.publish(bodies)
+            except Exception as e:
+                if self._aborted.is_set():
+                    return None
+                attempt += 1
+                if self.max_retries is not None and attempt > self.max_retries:
+                    elastalert_logger.error('Dropping %d alert messages after %d attempts: %s',
+                                            len(bodies), attempt, e)
+                    with self._cond:
+                        self.stats['failed'] += 1
+                    return False
+                delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+                elastalert_logger.warning('Cannot publish alert messages, retrying in %.1fs: %s',
+                                          delay, e)
+                with self._cond:
+                    self.stats['retries'] += 1
+                self._aborted.wait(delay)
+                continue
+            end = time.time()
+            with self._cond:
+                self.stats['published'] += 1
+                self.publish_latency = end - start
+                self.publish_latency_max = max(self.publish_latency_max, self.publish_latency)
+                self.queue_latency = end - enqueued
+                self.queue_latency_max = max(self.queue_latency_max, self.queue_latency)
+            return True
+
+    @staticmethod
+    def _dump(item):
+        enqueued, bodies = item
+        return kombu_json.dumps({'enqueued': enqueued, 'bodies': bodies}).encode('utf-8') + b'\n'
+
+    def _spill(self, items):
+        with io.open(self.spill_path, 'ab') as spill:
+            for item in items:
+                spill.write(self._dump(item))
+        self._spill_pending = True
+
+    def _replay_spill(self):
+        """ Publish the spilled batches, taking over the spill file first. Returns False if
+        stop() gave up on them. """
+        with self._cond:
+            if not os.path.exists(self.draining_path):
+                if os.path.exists(self.spill_path):
+                    os.rename(self.spill_path, self.draining_path)
+                else:
+                    self._spill_pending = False
+                    return True
+        with io.open(self.draining_path, 'rb') as draining:
+            for line in draining:
+                try:
+                    item = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # Torn by a crash while spilling
+                    continue
+                if self._publish(item['enqueued'], item['bodies']) is None:
+                    # Replayed again from the start by the next process
+                    return False
+        os.unlink(self.draining_path)
+        with self._cond:
+            self._spill_pending = os.path.exists(self.spill_path)
+            self._cond.notify_all()
+        return True
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import heapq
+import itertools
+
+
+class ExpiryIndex(object):
+    """ A min-heap of per-key deadlines used to find the keys that need attention.
+
+    Every key has at most one effective deadline. Postponing a deadline is O(1): the earlier
+    heap entry is kept and re-queued with the new deadline once it fires, so keys that
+    receive events all the time do not churn the heap.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}
+        self._due = set()
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self._deadlines) + len(self._due)
+
+    def __contains__(self, key):
+        return key in self._deadlines or key in self._due
+
+    def schedule(self, key, deadline):
+        """ Set the deadline of key, replacing any previous one. """
+        self._due.discard(key)
+        current = self._deadlines.get(key)
+        self._deadlines[key] = deadline
+        if current is None or deadline < current:
+            heapq.heappush(self._heap, (deadline, next(self._seq), key))
+
+    def schedule_now(self, key):
+        """ Make key due on the next call to expired(), whatever its deadline. """
+        self._due.add(key)
+
+    def schedule_all_now(self, keys):
+        self._due.update(keys)
+
+    def discard(self, key):
+        self._due.discard(key)
+        self._deadlines.pop(key, None)
+
+    def clear(self):
+        self._heap = []
+        self._deadlines = {}
+        self._due = set()
+
+    def expired(self, now):
+        """ Remove and return the keys whose deadline is not later than now. """
+        keys = list(self._due)
+        self._due = set()
+        for key in keys:
+            self._deadlines.pop(key, None)
+
+        heap = self._heap
+        while heap and not heap[0][0] > now:
+            deadline, _, key = heapq.heappop(heap)
+            current = self._deadlines.get(key)
+            if current is None:
+                # Discarded, or already returned through another entry
+                continue
+            if current > now:
+                # Postponed since this entry was queued
+                heapq.heappush(heap, (current, next(self._seq), key))
+                continue
+            del self._deadlines[key]
+            keys.append(key)
+        return keys
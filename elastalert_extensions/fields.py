@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from elastalert.util import lookup_es_key
+
+
+def field_getter(term):
+    """ Compile term into a callable returning the same value as lookup_es_key(doc, term).
+
+    The term is split once. Documents where the plain nested path does not resolve,
+    e.g. with dotted keys at an inner level, are handed to lookup_es_key.
+    """
+    if '.' not in term:
+        def get_field(doc):
+            return doc.get(term)
+        return get_field
+
+    path = tuple(term.split('.'))
+    if len(path) == 2:
+        first, second = path
+
+        def walk(doc):
+            return doc[first][second]
+    elif len(path) == 3:
+        first, second, third = path
+
+        def walk(doc):
+            return doc[first][second][third]
+    else:
+        def walk(doc):
+            for part in path:
+                doc = doc[part]
+            return doc
+
+    def get_nested_field(doc):
+        if term in doc:
+            return doc[term]
+        try:
+            return walk(doc)
+        except (KeyError, TypeError, IndexError):
+            return lookup_es_key(doc, term)
+    return get_nested_field
+
+
+def fields_getter(terms):
+    """ Compile terms into a callable returning the tuple of their values in a document. """
+    getters = tuple(field_getter(term) for term in terms)
+    if len(getters) == 1:
+        get_first, = getters
+        return lambda doc: (get_first(doc),)
+    if len(getters) == 2:
+        get_first, get_second = getters
+        return lambda doc: (get_first(doc), get_second(doc))
+    return lambda doc: tuple([get_field(doc) for get_field in getters])
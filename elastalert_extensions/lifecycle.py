@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+""" Shutting down what rules and alerters leave behind: final flushes at exit, and
+the threads and files of a rule or alerter elastalert replaced.
+
+atexit cannot unregister a hook on Python 2, so the hooks are kept here and run by
+a single atexit hook, most recently registered first, and cancel_at_exit drops one
+whose object was closed before.
+
+elastalert builds a new rules dict, rule and alerters when a rule file changes and
+drops the previous ones without telling them, so they call replace() when used,
+which closes the objects of the same kind and rule name of a previous rules dict.
+Not when built: elastalert may still reject a new rule, e.g. one reusing the name
+of another, and keep running the previous one.
+"""
+from __future__ import absolute_import
+import atexit
+import threading
+import weakref
+
+from elastalert.util import elastalert_logger
+
+
+_lock = threading.Lock()
+_exit_hooks = []
+# (kind, rule name) to the current rules dict and weak references to its objects
+_current = {}
+
+
+def at_exit(hook):
+    """ Call hook() at interpreter exit, unless cancel_at_exit(hook) is called first. """
+    with _lock:
+        _exit_hooks.append(hook)
+
+
+def cancel_at_exit(hook):
+    with _lock:
+        _exit_hooks[:] = [registered for registered in _exit_hooks if registered != hook]
+
+
+def run_exit_hooks():
+    with _lock:
+        hooks = _exit_hooks[::-1]
+        del _exit_hooks[:]
+    for hook in hooks:
+        try:
+            hook()
+        except Exception as e:
+            elastalert_logger.error('Error in exit hook %r: %s', hook, e)
+
+
+def forget():
+    """ Drop the exit hooks and the objects registered, in a forked process whose copies
+    of them belong to its parent. """
+    with _lock:
+        del _exit_hooks[:]
+        _current.clear()
+
+
+def replace(kind, rules, obj):
+    """ Register obj, in use, as a kind of object of the rule of the rules dict, calling
+    close() on those registered for a previous rules dict of the same name, still alive.
+    Returns whether one was closed. Objects of the same rules dict, e.g. two alerters of
+    a rule, are kept together. Objects of unnamed rules are left alone. Cheap once obj
+    is registered, so it may be called on every use. """
+    name = rules.get('name')
+    if name is None:
+        return False
+    with _lock:
+        current = _current.get((kind, name))
+        if current is not None and current[0] is rules:
+            if not any(ref() is obj for ref in current[1]):
+                current[1].append(weakref.ref(obj))
+            return False
+        _current[kind, name] = (rules, [weakref.ref(obj)])
+    closed = False
+    for ref in current[1] if current is not None else []:
+        previous = ref()
+        if previous is None:
+            continue
+        elastalert_logger.info('Closing the previous %s of rule %s', kind, name)
+        closed = True
+        try:
+            previous.close()
+        except Exception as e:
+            elastalert_logger.error('Error closing the previous %s of rule %s: %s', kind, name, e)
+    return closed
+
+
+atexit.register(run_exit_hooks)
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from bisect import bisect_left
+from collections import OrderedDict
+import functools
+import json
+import threading
+import time
+from timeit import default_timer
+import weakref
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # pragma: no cover
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from elastalert.util import elastalert_logger
+
+from elastalert_extensions.status import atomic_write
+
+
+# Upper bounds in seconds
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+DUMP_INTERVAL = 60.0
+RULE_METHODS = ('add_data', 'add_terms_data', 'add_count_data', 'check_for_match', 'garbage_collect')
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in labels)
+
+
+def _format_value(value):
+    return '%d' % value if float(value).is_integer() else repr(float(value))
+
+
+class Histogram(object):
+    """ Counts of observed values per bucket, with their count and sum. """
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # The last one is +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """ (upper bound, count of values up to it) pairs, the last bound being +Inf. """
+        total = 0
+        buckets = []
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+
+def timed(histogram, method):
+    """ method, observing the seconds each call takes in histogram. """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = default_timer()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            histogram.observe(default_timer() - start)
+    return wrapper
+
+
+class Registry(object):
+    """ The histograms and gauges of a process, keyed by name and labels.
+
+    Gauges are read at export time from collectors, functions of an object returning
+    (name, labels, value) tuples, which are dropped along with their object.
+    """
+
+    def __init__(self):
+        self._histograms = OrderedDict()
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def histogram(self, name, labels, bounds=LATENCY_BUCKETS):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(bounds)
+        return histogram
+
+    def instrument(self, obj, methods, name, labels):
+        """ Time the calls of the methods of obj, an object at a time. Calls made by a timed
+        method, e.g. check_for_match from add_data, are part of its time. """
+        for method in methods:
+            if hasattr(obj, method):
+                histogram = self.histogram(name, dict(labels, method=method))
+                setattr(obj, method, timed(histogram, getattr(obj, method)))
+
+    def register(self, obj, collector):
+        with self._lock:
+            self._collectors.append((weakref.ref(obj), collector))
+
+    def gauges(self):
+        gauges = []
+        with self._lock:
+            self._collectors = [(ref, collector) for ref, collector in self._collectors
+                                if ref() is not None]
+            collectors = list(self._collectors)
+        for ref, collector in collectors:
+            obj = ref()
+            if obj is None:
+                continue
+            try:
+                gauges.extend(collector(obj))
+            except Exception as e:
+                elastalert_logger.error('Cannot collect metrics of %s: %s', obj, e)
+        return gauges
+
+    def to_prometheus(self):
+        """ The metrics in the Prometheus text exposition format. """
+        lines = []
+        with self._lock:
+            histograms = list(self._histograms.items())
+        typed = set()
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            for bound, count in histogram.cumulative():
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', le),)), count))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels), repr(histogram.sum)))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels), histogram.count))
+        for name, labels, value in self.gauges():
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s gauge' % name)
+            lines.append('%s%s %s' % (name, _format_labels(_labels_key(labels)), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        with self._lock:
+            histograms = list(self._histograms.items())
+        return {
+            'time': time.time(),
+            'histograms': [{'name': name, 'labels': dict(labels), 'count': histogram.count,
+                            'sum': histogram.sum,
+                            'buckets': [[None if bound == float('inf') else bound, count]
+                                        for bound, count in histogram.cumulative()]}
+                           for (name, labels), histogram in histograms],
+            'gauges': [{'name': name, 'labels': labels, 'value': value}
+                       for name, labels, value in self.gauges()],
+        }
+
+
+REGISTRY = Registry()
+
+
+class MetricsServer(threading.Thread):
+    """ A daemon thread serving the metrics of registry in the Prometheus text format. """
+
+    def __init__(self, port, host='', registry=REGISTRY):
+        super(MetricsServer, self).__init__(name='MetricsServer(%s)' % port)
+        self.daemon = True
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer((host, port), Handler)
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsDumper(threading.Thread):
+    """ A daemon thread writing the metrics of registry as JSON to path every interval seconds. """
+
+    def __init__(self, path, interval=DUMP_INTERVAL, registry=REGISTRY):
+        super(MetricsDumper, self).__init__(name='MetricsDumper(%s)' % path)
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.dump()
+
+    def stop(self):
+        self._stopped.set()
+
+    def dump(self):
+        try:
+            metrics = json.dumps(self.registry.to_json())
+            atomic_write(self.path, lambda f: f.write(metrics))
+        except (IOError, OSError) as e:
+            elastalert_logger.error('Cannot dump metrics to %s: %s', self.path, e)
+
+
+_exporters = {}
+_exporters_lock = threading.Lock()
+
+
+def start_exporters(rules):
+    """ Start the exporters asked for by rules, metrics_port and metrics_path, once per
+    process whatever the number of rules asking for them. """
+    with _exporters_lock:
+        port = rules.get('metrics_port')
+        if port and ('port', port) not in _exporters:
+            try:
+                exporter = _exporters['port', port] = MetricsServer(int(port))
+                exporter.start()
+            except (IOError, OSError) as e:
+                elastalert_logger.error('Cannot serve metrics on port %s: %s', port, e)
+        path = rules.get('metrics_path')
+        if path and ('path', path) not in _exporters:
+            exporter = _exporters['path', path] = MetricsDumper(
+                path, interval=rules.get('metrics_interval', DUMP_INTERVAL))
+            exporter.start()
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+""" Profiles with per query key timeframe, threshold and num_events.
+
+The extended JSON profile is
+
+    {"default": {"timeframe": 600, "threshold": 3, "num_events": 10},
+     "groups": {"rooftop": {"timeframe": 1800}},
+     "keys": {"device1": 660, "device2": {"group": "rooftop", "threshold": 5}}}
+
+where a key is given its timeframe in seconds, or limits of its own and a group,
+the key overriding its group overriding the default overriding the rule. Every part
+and every limit is optional. The same profile as JSON lines, read line by line, is
+
+    {"default": {"timeframe": 600, "threshold": 3, "num_events": 10}}
+    {"group": "rooftop", "timeframe": 1800}
+    {"key": "device1", "timeframe": 660}
+    {"key": "device2", "group": "rooftop", "threshold": 5}
+
+with groups before the keys using them. write_binary_profile compiles a profile
+into a table sorted by key, which BinaryProfile looks keys up in through mmap.
+"""
+from __future__ import absolute_import, print_function
+from collections import namedtuple
+from datetime import timedelta
+import io
+import json
+import math
+import mmap
+import struct
+import sys
+
+from elastalert.util import EAException
+
+from elastalert_extensions.blacklist import string_types
+from elastalert_extensions.blacklist import text_type
+from elastalert_extensions.status import atomic_write
+from elastalert_extensions.windows import td_to_us
+
+
+LIMITS = ('timeframe', 'threshold', 'num_events')
+SPEC_FIELDS = frozenset(LIMITS + ('key', 'group'))
+BINARY_MAGIC = b'EAPB'
+BINARY_VERSION = 1
+# magic, version, number of keys, number of distinct limits
+BINARY_HEADER = struct.Struct('<4sHxxII')
+# timeframe in microseconds or -1, threshold and num_events or NaN
+BINARY_LIMITS = struct.Struct('<qdd')
+# key offset, key length, index of the limits
+BINARY_ENTRY = struct.Struct('<III')
+
+
+class Limits(namedtuple('Limits', LIMITS)):
+    """ The limits of a key, None where the profile leaves them to the rule. """
+    __slots__ = ()
+
+    def merge(self, other):
+        """ These limits overridden by those set in other. """
+        return Limits(*[mine if theirs is None else theirs for mine, theirs in zip(self, other)])
+
+
+NO_LIMITS = Limits(None, None, None)
+
+
+def is_extended(profile):
+    """ Whether a loaded JSON profile is in the extended format rather than a flat
+    map of keys to timeframes. """
+    return isinstance(profile, dict) and any(
+        isinstance(profile.get(part), dict) for part in ('default', 'groups', 'keys'))
+
+
+class _Interner(object):
+    """ Makes equal limits share one Limits and one timedelta, and caches merges. """
+
+    def __init__(self):
+        self._limits = {}
+        self._timeframes = {}
+        self._merged = {}
+
+    def limits(self, spec, where):
+        if not isinstance(spec, dict):
+            limits = self._timeframes.get(spec)
+            if limits is None:
+                limits = self._timeframes[spec] = self.limits({'timeframe': spec}, where)
+            return limits
+        if not SPEC_FIELDS.issuperset(spec):
+            raise EAException('Unknown limits %s in profile %s' % (
+                ', '.join(sorted(set(spec) - SPEC_FIELDS)), where))
+        seconds = spec.get('timeframe')
+        limits = Limits(None if seconds is None else timedelta(seconds=seconds),
+                        spec.get('threshold'), spec.get('num_events'))
+        return self._limits.setdefault(limits, limits)
+
+    def merge(self, *layers):
+        """ The interned merge of limits layers, later ones overriding earlier ones. """
+        merged = self._merged.get(layers)
+        if merged is None:
+            merged = layers[0]
+            for layer in layers[1:]:
+                merged = merged.merge(layer)
+            merged = self._merged[layers] = self._limits.setdefault(merged, merged)
+        return merged
+
+
+class Profile(object):
+    """ The limits of the keys of a profile, looked up with the get methods of
+    timeframes, thresholds and num_events, which only have the keys the profile
+    sets them for. default holds the limits of the other keys. """
+
+    def __init__(self, default=NO_LIMITS, limits=None):
+        self.default = default
+        self.timeframes = {}
+        self.thresholds = {}
+        self.num_events = {}
+        self._limits = {}
+        for key, key_limits in (limits or {}).items():
+            self.set(key, key_limits)
+
+    def set(self, key, limits):
+        """ Set the limits of key, already merged with the default and its group. """
+        self._limits[key] = limits
+        timeframe, threshold, num_events = limits
+        for column, value in ((self.timeframes, timeframe), (self.thresholds, threshold),
+                              (self.num_events, num_events)):
+            if value is None:
+                column.pop(key, None)
+            else:
+                column[key] = value
+
+    def limits(self, key):
+        return self._limits.get(key, self.default)
+
+    def __len__(self):
+        return len(self._limits)
+
+    @classmethod
+    def from_json(cls, profile):
+        """ A Profile from an extended JSON profile, see is_extended. """
+        return cls.from_entries(_json_entries(profile))
+
+    @classmethod
+    def from_entries(cls, entries):
+        """ A Profile from ('default', None, spec), ('group', name, spec) and ('key', key, spec)
+        entries, groups coming before the keys using them. """
+        interner = _Interner()
+        profile = cls()
+        groups = {}
+        for kind, name, spec in entries:
+            if kind == 'default':
+                profile.default = interner.limits(spec, 'default')
+                continue
+            limits = interner.limits(spec, name)
+            if kind == 'group':
+                groups[name] = limits
+                continue
+            group = spec.get('group') if isinstance(spec, dict) else None
+            if group is None:
+                profile.set(name, interner.merge(profile.default, limits))
+            elif group in groups:
+                profile.set(name, interner.merge(profile.default, groups[group], limits))
+            else:
+                raise EAException('Unknown group %s of key %s in profile' % (group, name))
+        return profile
+
+
+def changed_keys(old, new):
+    """ The keys whose limits may differ between old and new, dicts of timeframes or
+    Profiles, found from the keys they set. None when the defaults differ or the
+    profiles cannot be compared this way, so every key may have changed. """
+    if isinstance(old, dict) and isinstance(new, dict):
+        old_limits, new_limits = old, new
+    elif isinstance(old, Profile) and isinstance(new, Profile) and old.default == new.default:
+        old_limits, new_limits = old._limits, new._limits
+    else:
+        return None
+    changed = [key for key, limits in new_limits.items() if old_limits.get(key) != limits]
+    changed.extend(key for key in old_limits if key not in new_limits)
+    return changed
+
+
+def _json_entries(profile):
+    if 'default' in profile:
+        yield 'default', None, profile['default']
+    for name, spec in (profile.get('groups') or {}).items():
+        yield 'group', name, spec
+    for key, spec in (profile.get('keys') or {}).items():
+        yield 'key', key, spec
+
+
+def iter_profile_lines(lines):
+    """ The entries of a JSON lines profile, parsed one line at a time. """
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            spec = json.loads(line)
+        except ValueError as e:
+            raise ValueError('Line %d of profile: %s' % (number, e))
+        if 'default' in spec:
+            yield 'default', None, spec['default']
+        elif 'key' in spec:
+            yield 'key', spec['key'], spec
+        elif 'group' in spec:
+            yield 'group', spec['group'], spec
+        else:
+            raise ValueError('Line %d of profile has no key, group or default' % number)
+
+
+def load_profile_lines(path):
+    with io.open(path, 'r', encoding='utf-8') as lines:
+        return Profile.from_entries(iter_profile_lines(lines))
+
+
+def _key_bytes(key):
+    return key.encode('utf-8') if isinstance(key, text_type) else key
+
+
+class _Column(object):
+    """ One limit of a BinaryProfile, with the get of a dict. """
+    __slots__ = ('profile', 'index')
+
+    def __init__(self, profile, index):
+        self.profile = profile
+        self.index = index
+
+    def get(self, key, default=None):
+        value = self.profile.limits(key)[self.index]
+        return default if value is None else value
+
+
+class BinaryProfile(object):
+    """ A profile compiled by write_binary_profile, memory-mapped from path. Keys are
+    binary searched in the table and their limits cached once found. """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._num_keys, num_limits = BINARY_HEADER.unpack_from(self._mapped)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            self._mapped.close()
+            raise ValueError('Not a version %d binary profile' % BINARY_VERSION)
+        offset = BINARY_HEADER.size
+        limits = []
+        for _ in range(num_limits):
+            timeframe_us, threshold, num_events = BINARY_LIMITS.unpack_from(self._mapped, offset)
+            offset += BINARY_LIMITS.size
+            limits.append(Limits(None if timeframe_us < 0 else timedelta(microseconds=timeframe_us),
+                                 None if math.isnan(threshold) else _number(threshold),
+                                 None if math.isnan(num_events) else _number(num_events)))
+        self._table_limits = limits
+        self.default = limits[0]
+        self._entries_offset = offset
+        self._cache = {}
+        self.timeframes = _Column(self, 0)
+        self.thresholds = _Column(self, 1)
+        self.num_events = _Column(self, 2)
+
+    def __len__(self):
+        return self._num_keys
+
+    def limits(self, key):
+        limits = self._cache.get(key)
+        if limits is None:
+            limits = self._cache[key] = self._search(key)
+        return limits
+
+    def _search(self, key):
+        if not isinstance(key, string_types):
+            return self.default
+        wanted = _key_bytes(key)
+        mapped = self._mapped
+        unpack_from = BINARY_ENTRY.unpack_from
+        entries_offset = self._entries_offset
+        lo, hi = 0, self._num_keys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key_offset, key_length, index = unpack_from(mapped, entries_offset + mid * BINARY_ENTRY.size)
+            found = mapped[key_offset:key_offset + key_length]
+            if found < wanted:
+                lo = mid + 1
+            elif found > wanted:
+                hi = mid
+            else:
+                return self._table_limits[index]
+        return self.default
+
+    def close(self):
+        self._mapped.close()
+
+
+def _number(value):
+    return int(value) if value.is_integer() else value
+
+
+def write_binary_profile(path, profile):
+    """ Compile profile, a Profile, into a binary profile at path. """
+    table = [profile.default]
+    indexes = {profile.default: 0}
+    entries = []
+    for key, limits in profile._limits.items():
+        index = indexes.get(limits)
+        if index is None:
+            index = indexes[limits] = len(table)
+            table.append(limits)
+        entries.append((_key_bytes(key), index))
+    entries.sort()
+
+    def writer(f):
+        f.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(entries), len(table)))
+        for limits in table:
+            f.write(BINARY_LIMITS.pack(
+                -1 if limits.timeframe is None else td_to_us(limits.timeframe),
+                float('nan') if limits.threshold is None else limits.threshold,
+                float('nan') if limits.num_events is None else limits.num_events))
+        key_offset = BINARY_HEADER.size + len(table) * BINARY_LIMITS.size + len(entries) * BINARY_ENTRY.size
+        for key, index in entries:
+            f.write(BINARY_ENTRY.pack(key_offset, len(key), index))
+            key_offset += len(key)
+        for key, _ in entries:
+            f.write(key)
+    atomic_write(path, writer, mode='wb')
+
+
+def main(source, target):
+    """ Compile the JSON or JSON lines profile source into the binary profile target. """
+    if source.endswith('.jsonl'):
+        profile = load_profile_lines(source)
+    else:
+        with open(source, 'r') as f:
+            profile = json.load(f)
+        profile = Profile.from_json(profile if is_extended(profile) else {'keys': profile})
+    write_binary_profile(target, profile)
+    print('Wrote %d keys to %s' % (len(profile), target))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from datetime import date, datetime
+import socket
+
+from amqp import spec
+from elastalert.util import EAException, elastalert_logger
+from kombu import Connection, Producer
+from kombu.utils import json
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+HEARTBEAT = 60
+MAX_RETRIES = 3
+CONFIRM_TIMEOUT = 30.0
+BATCH_SIZE = 100
+BATCH_MODES = ('match', 'message')
+
+
+class PublishNacked(EAException):
+    """ The broker rejected messages of a batch with basic.nack. """
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError('Cannot serialize %r' % (obj,))
+
+
+def _dump_json(body):
+    return json.dumps(body)
+
+
+def _dump_msgpack(body):
+    return msgpack.packb(body, use_bin_type=True, default=_msgpack_default)
+
+
+# name: (content_type, content_encoding, dumps)
+SERIALIZERS = {
+    'json': ('application/json', 'utf-8', _dump_json),
+    'msgpack': ('application/x-msgpack', 'binary', _dump_msgpack),
+}
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class Publisher(object):
+    """ Publishes message bodies over one long lived connection.
+
+    The connection is opened on first use, with AMQP heartbeats, and kept across
+    calls to publish(). A batch that fails with a connection or channel error is
+    retried on a new connection up to max_retries times, so its messages are
+    delivered at least once. With confirm, the broker's publisher confirms are
+    awaited once per batch rather than once per message; transports without
+    confirms, e.g. memory://, publish without them. A batch the broker nacks, or
+    does not confirm within confirm_timeout, is retried the same way.
+
+    :param url: The broker url.
+    :param exchange: The kombu Exchange to publish to, declared on connect.
+    :param serializer: The name of a serializer in SERIALIZERS.
+    """
+
+    def __init__(self, url, exchange, routing_key, serializer='json', heartbeat=HEARTBEAT,
+                 confirm=False, max_retries=MAX_RETRIES, confirm_timeout=CONFIRM_TIMEOUT):
+        if serializer not in SERIALIZERS:
+            raise EAException('Unknown amqp serializer %s' % serializer)
+        if serializer == 'msgpack' and msgpack is None:
+            raise EAException('The msgpack amqp serializer requires the msgpack package')
+        self.url = url
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.content_type, self.content_encoding, self.dumps = SERIALIZERS[serializer]
+        self.heartbeat = heartbeat
+        self.confirm = confirm
+        self.max_retries = max_retries
+        self.confirm_timeout = confirm_timeout
+        self.connection = None
+        self._producer = None
+        self._confirms = False
+        self._published = 0
+        self._acked = 0
+        self._nacked = False
+
+    def connect(self):
+        if self._producer is not None:
+            return self._producer
+        if self.connection is None:
+            self.connection = Connection(self.url, heartbeat=self.heartbeat)
+        self.connection.ensure_connection(max_retries=self.max_retries)
+        channel = self.connection.channel()
+        self._confirms = self.confirm and hasattr(channel, 'confirm_select')
+        self._published = self._acked = 0
+        self._nacked = False
+        if self._confirms:
+            channel.events['basic_ack'].add(self._on_ack)
+            channel.events['basic_nack'].add(self._on_nack)
+            channel.confirm_select()
+        self._producer = Producer(channel, exchange=self.exchange, routing_key=self.routing_key)
+        return self._producer
+
+    def close(self):
+        self._producer = None
+        if self.connection is not None:
+            try:
+                self.connection.release()
+            except Exception as e:
+                elastalert_logger.warning('Error closing amqp connection: %s', e)
+            self.connection = None
+
+    def heartbeat_check(self):
+        """ Service the connection heartbeats, dropping the connection if they failed. """
+        if self._producer is None:
+            return
+        try:
+            self.connection.heartbeat_check()
+        except self.connection.connection_errors + self.connection.channel_errors as e:
+            elastalert_logger.warning('Lost amqp connection to %s: %s', self.connection.as_uri(), e)
+            self.close()
+
+    def publish(self, bodies):
+        """ Serialize and publish bodies as one batch. """
+        payloads = [self.dumps(body) for body in bodies]
+        for attempt in range(self.max_retries + 1):
+            self.heartbeat_check()
+            producer = self.connect()
+            try:
+                for payload in payloads:
+                    producer.publish(payload,
+                                     content_type=self.content_type,
+                                     content_encoding=self.content_encoding)
+                self._published += len(payloads)
+                if self._confirms:
+                    self._wait_confirms(producer.channel)
+                return
+            except (self.connection.connection_errors + self.connection.channel_errors +
+                    (PublishNacked, socket.timeout)) as e:
+                if attempt == self.max_retries:
+                    raise
+                elastalert_logger.warning('Error publishing to amqp, reconnecting: %s', e)
+                self.close()
+
+    def _on_ack(self, delivery_tag, multiple):
+        self._acked = max(self._acked, delivery_tag)
+
+    def _on_nack(self, delivery_tag, multiple):
+        self._nacked = True
+
+    def _wait_confirms(self, channel):
+        while self._acked < self._published and not self._nacked:
+            channel.wait([spec.Basic.Ack, spec.Basic.Nack], timeout=self.confirm_timeout)
+        if self._nacked:
+            raise PublishNacked('The broker nacked messages published to %s' % self.exchange.name)
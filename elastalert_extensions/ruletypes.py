@@ -1,104 +1,325 @@
 # -*- coding: utf-8 -*-
-import copy
+from collections import deque, OrderedDict
 from datetime import timedelta
+import functools
 import json
 import os.path
+import threading
 import time
 
+from dateutil.tz import tzutc
 from elastalert.util import dt_to_ts
 from elastalert.util import EAException
 from elastalert.util import elastalert_logger
 from elastalert.util import hashable
-from elastalert.util import lookup_es_key
 from elastalert.util import new_get_event_ts
 from elastalert.util import pretty_ts
 from elastalert.util import ts_to_dt
 from elastalert.ruletypes import BlacklistRule, CompareRule
-from elastalert.ruletypes import EventWindow
 from elastalert.ruletypes import FrequencyRule
 
+from elastalert_extensions.batch import at_least
+from elastalert_extensions.batch import at_least_mask
+from elastalert_extensions.batch import columnarize_terms
+from elastalert_extensions.blacklist import BlacklistMatcher
+from elastalert_extensions.expiry import ExpiryIndex
+from elastalert_extensions.fields import field_getter
+from elastalert_extensions.fields import fields_getter
+from elastalert_extensions.lifecycle import at_exit
+from elastalert_extensions.lifecycle import cancel_at_exit
+from elastalert_extensions.lifecycle import replace
+from elastalert_extensions.metrics import REGISTRY
+from elastalert_extensions.metrics import RULE_METHODS
+from elastalert_extensions.metrics import start_exporters
+from elastalert_extensions.metrics import timed
+from elastalert_extensions.profile import BinaryProfile
+from elastalert_extensions.profile import changed_keys
+from elastalert_extensions.profile import is_extended
+from elastalert_extensions.profile import Limits
+from elastalert_extensions.profile import load_profile_lines
+from elastalert_extensions.profile import Profile
+from elastalert_extensions.shard import ShardedRule
+from elastalert_extensions.shared import BLACKLISTS
+from elastalert_extensions.shared import PROFILES
+from elastalert_extensions.snapshot import read_snapshot
+from elastalert_extensions.snapshot import write_snapshot
+from elastalert_extensions.status import StatusStore
+from elastalert_extensions.trace import Tracer
+from elastalert_extensions.windows import dt_to_us
+from elastalert_extensions.windows import us_to_dt
+from elastalert_extensions.windows import WINDOW_TYPES
+
 
 UPDATE_INTERVAL = 60.0
+SNAPSHOT_INTERVAL = 300.0
 FORCE_UPDATE_INTERVAL = 86400.0
+TRANSITION_LOG_SIZE = 16
+MAX_CACHED_VALUES = 10000
+
+
+def load_profile(profile_path):
+    """ Load a profile file mapping query keys to timeframes in seconds, or a Profile
+    of per key limits from an extended, a JSON lines (.jsonl) or a binary (.bin) one. """
+    if profile_path.endswith('.bin'):
+        return BinaryProfile(profile_path)
+    if profile_path.endswith('.jsonl'):
+        return load_profile_lines(profile_path)
+    with open(profile_path, 'r') as profile_file:
+        profile = json.load(profile_file)
+        if is_extended(profile):
+            return Profile.from_json(profile)
+        return {k: timedelta(seconds=profile[k]) for k in profile}
+
+
+class ProfileWatcher(threading.Thread):
+    """ A daemon thread polling a profile file and passing every new version to callback. """
+
+    def __init__(self, profile_path, callback, interval=UPDATE_INTERVAL, loader=load_profile):
+        super(ProfileWatcher, self).__init__(name='ProfileWatcher(%s)' % profile_path)
+        self.daemon = True
+        self.profile_path = profile_path
+        self.callback = callback
+        self.interval = interval
+        self.loader = loader
+        self._mtime = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.poll()
+
+    def stop(self):
+        self._stopped.set()
+
+    def poll(self):
+        try:
+            mtime = os.path.getmtime(self.profile_path)
+            if mtime == self._mtime:
+                return
+            elastalert_logger.info('Reloading profile %s', self.profile_path)
+            profile = self.loader(self.profile_path)
+        except (OSError, IOError, ValueError) as e:
+            elastalert_logger.error('Cannot load profile %s: %s', self.profile_path, e)
+            return
+        self._mtime = mtime
+        self.callback(profile)
+
+
+def _blacklist_key(rules):
+    """ The key of the blacklist of rules in BLACKLISTS, None if it cannot be shared. """
+    key = (tuple(rules['blacklist']), rules.get('blacklist_wildcards', False),
+           rules.get('blacklist_check_interval', UPDATE_INTERVAL))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def blacklist_matcher(rules, owner):
+    """ The matcher of the blacklist of rules, shared with every rule of the same blacklist,
+    and its key in BLACKLISTS, None if it cannot be shared.
+
+    Like expand_entries, rules['blacklist'] is then set to the expanded exact entries,
+    which enhance_filter queries. Wildcard entries cannot be queried, rules using them
+    want filter_by_list off.
+    """
+    entries = rules['blacklist']
+    wildcards = rules.get('blacklist_wildcards', False)
+    check_interval = rules.get('blacklist_check_interval', UPDATE_INTERVAL)
+    key = _blacklist_key(rules)
+    if key is None:
+        matcher = BlacklistMatcher(entries, wildcards=wildcards, check_interval=check_interval)
+    else:
+        matcher = BLACKLISTS.get(key, lambda: BlacklistMatcher(entries, wildcards=wildcards,
+                                                               check_interval=check_interval), owner)
+    rules['blacklist'] = set(matcher.exact)
+    return matcher, key
 
 
 class BlacklistDurationRule(CompareRule):
+    """ Matches when the compound_compare_key values of a query key leave the blacklist
+    within timeframe of entering it.
+
+    change_map keeps, per key, the last max_transitions times the values left the
+    blacklist as (values, start_time, duration), whether or not they matched. A match
+    has the latest as value, start_time and duration, and all of them since the
+    previous match of the key as transitions.
+    """
     required_options = frozenset(['query_key', 'compound_compare_key',
                                   'ignore_null', 'blacklist', 'timeframe'])
-    change_map = {}
-    occurrence_time = {}
 
     def __init__(self, rules, args=None):
         super(BlacklistDurationRule, self).__init__(rules, args=None)
-        self.expand_entries('blacklist')
+        # Query keys to their transition logs
+        self.change_map = {}
+        self.max_transitions = self.rules.get('max_transitions', TRANSITION_LOG_SIZE)
+        # Values tuples to whether each value is blacklisted, as of _blacklist_version
+        self._blacklisted = {}
+        self._blacklist_version = None
+        self.occurrence_time = {}
+        # Query keys by the time their last event was compared, least recent first
+        self.last_seen = OrderedDict()
+        self.max_tracked_keys = self.rules.get('max_tracked_keys')
+        self.state_ttl_timeframes = self.rules.get('state_ttl_timeframes')
+        self.evictions = {'ttl': 0, 'lru': 0}
+        self.blacklist, self._shared_blacklist = blacklist_matcher(self.rules, self)
+        self.get_key = field_getter(self.rules['query_key'])
+        self.get_values = fields_getter(self.rules['compound_compare_key'])
+        self.tracer = Tracer.from_rules(self.rules)
+        if self.rules.get('metrics'):
+            labels = {'rule': self.rules.get('name')}
+            REGISTRY.instrument(self, RULE_METHODS, 'elastalert_rule_call_seconds', labels)
+            REGISTRY.register(self, lambda rule: [('elastalert_rule_' + name, labels, value)
+                                                  for name, value in rule.get_state_stats().items()])
+            start_exporters(self.rules)
+
+    def close(self):
+        """ Release the shared blacklist, once elastalert replaced the rule. """
+        if self._shared_blacklist is not None:
+            BLACKLISTS.release(self._shared_blacklist, self)
+
+    def add_data(self, data):
+        replace('rule', self.rules, self)
+        # Another rule sharing the blacklist may have rebuilt it
+        self.blacklist.refresh()
+        if self.blacklist.version != self._blacklist_version:
+            self._blacklist_version = self.blacklist.version
+            self._blacklisted.clear()
+        self.tracer.refresh()
+        super(BlacklistDurationRule, self).add_data(data)
+
+    def timeframe(self, key):
+        return self.rules['timeframe']
+
+    def blacklisted(self, values):
+        """ For each of the values, whether it is in the blacklist. """
+        try:
+            flags = self._blacklisted.get(values)
+        except TypeError:
+            # Unhashable values, e.g. lists
+            return tuple(value in self.blacklist for value in values)
+        if flags is None:
+            if len(self._blacklisted) >= MAX_CACHED_VALUES:
+                self._blacklisted.clear()
+            flags = self._blacklisted[values] = tuple(value in self.blacklist for value in values)
+        return flags
 
     def compare(self, event):
-        key = hashable(lookup_es_key(event, self.rules['query_key']))
-        values = []
-        elastalert_logger.debug(" Previous Values of compare keys  " + str(self.occurrences))
-        for val in self.rules['compound_compare_key']:
-            lookup_value = lookup_es_key(event, val)
-            values.append(lookup_value)
-        elastalert_logger.debug(" Current Values of compare keys   " + str(values))
-
-        start = changed = False
-        for val in values:
-            if not isinstance(val, bool) and not val and self.rules['ignore_null']:
-                return False
+        key = hashable(self.get_key(event))
+        values = tuple(self.get_values(event))
+        tracing = self.tracer.wants(key)
+
+        start = left = changed = False
+        if self.rules['ignore_null']:
+            for val in values:
+                if not isinstance(val, bool) and not val:
+                    if tracing:
+                        self.tracer.trace(key, 'ignore_null', values=values)
+                    return False
+        ts = event[self.rules['timestamp_field']]
+        self.last_seen.pop(key, None)
+        self.last_seen[key] = ts
+        previous = self.occurrences.get(key)
         # If we have seen this key before, compare it to the new value
-        if key in self.occurrences:
-            for idx, previous_values in enumerate(self.occurrences[key]):
-                elastalert_logger.debug(" " + str(previous_values) + " " + str(values[idx]))
-                start = (previous_values != values[idx] and
-                         values[idx] in self.rules['blacklist'])
-                changed = (previous_values != values[idx] and
-                           previous_values in self.rules['blacklist'])
-                if start or changed:
+        if previous is not None and previous != values:
+            # The first differing value entering or leaving the blacklist decides
+            for old, new, was, now in zip(previous, values, self.blacklisted(previous), self.blacklisted(values)):
+                if old != new and (was or now):
+                    start, left = now, was
                     break
-            if changed:
-                entry = [self.occurrences[key], None, None]
-                # If using timeframe, only return true if the time delta is < timeframe
-                if key in self.occurrence_time:
-                    changed = (event[self.rules['timestamp_field']] - self.occurrence_time[key] <=
-                               self.timeframe(key))
-                    old_time = self.occurrence_time[key]
-                    new_time = event[self.rules['timestamp_field']]
-                    duration = new_time - old_time
-                    entry[1], entry[2] = [old_time, duration.total_seconds()]
-                self.change_map[key] = tuple(entry)
-
-        if key not in self.occurrences or start or changed:
+            if left:
+                changed = True
+                old_time = self.occurrence_time.get(key)
+                duration = None
+                if old_time is not None:
+                    # Only a stay in the blacklist shorter than timeframe matches
+                    changed = ts - old_time <= self.timeframe(key)
+                    duration = (ts - old_time).total_seconds()
+                log = self.change_map.get(key)
+                if log is None:
+                    log = self.change_map[key] = deque(maxlen=self.max_transitions)
+                log.append((previous, old_time, duration))
+
+        if previous is None or start or left:
             # Update the current value and time
-            elastalert_logger.debug(" Setting current value of compare keys values " + str(values))
             self.occurrences[key] = values
-            self.occurrence_time[key] = event[self.rules['timestamp_field']]
-        elastalert_logger.debug("Final result of comparision between previous and current values " +
-                                str(changed))
+            self.occurrence_time[key] = ts
+        if tracing:
+            self.tracer.trace(key, 'compare', previous=previous, values=values,
+                              start=start, changed=changed)
         return changed
 
+    def garbage_collect(self, timestamp):
+        """ Forget the keys not seen for state_ttl_timeframes timeframes, then the least
+        recently seen keys beyond max_tracked_keys. """
+        replace('rule', self.rules, self)
+        if self.state_ttl_timeframes is not None:
+            cutoff = timestamp - self.state_ttl_timeframes * self.rules['timeframe']
+            # Keys are ordered by when they were seen, so stop at the first recent one
+            for key, ts in self.last_seen.items():
+                if ts >= cutoff:
+                    break
+                self._evict(key)
+                self.evictions['ttl'] += 1
+        if self.max_tracked_keys is not None:
+            excess = len(self.last_seen) - self.max_tracked_keys
+            for key in list(self.last_seen)[:max(excess, 0)]:
+                self._evict(key)
+                self.evictions['lru'] += 1
+
+    def _evict(self, key):
+        self.last_seen.pop(key, None)
+        self.occurrences.pop(key, None)
+        self.occurrence_time.pop(key, None)
+        self.change_map.pop(key, None)
+
+    def get_state_stats(self):
+        return {'tracked_keys': len(self.last_seen),
+                'evicted_ttl': self.evictions['ttl'],
+                'evicted_lru': self.evictions['lru']}
+
     def add_match(self, match):
-        # TODO this is not technically correct
-        # if the term changes multiple times before an alert is sent
-        # this data will be overwritten with the most recent change
-        change = self.change_map.get(hashable(lookup_es_key(match, self.rules['query_key'])))
+        key = hashable(self.get_key(match))
+        log = self.change_map.pop(key, None)
         extra = {}
-        if change:
-            extra = {'value': change[0],
-                     'start_time': change[1],
-                     'duration': change[2]}
-            elastalert_logger.debug("Description of the changed records  " +
-                                    str(dict(match.items() + extra.items())))
+        if log:
+            transitions = [{'value': list(values), 'start_time': start_time, 'duration': duration}
+                           for values, start_time, duration in log]
+            extra = dict(transitions[-1], transitions=transitions)
+            if self.tracer.wants(key):
+                self.tracer.trace(key, 'match', **extra)
         super(BlacklistDurationRule, self).add_match(dict(match.items() + extra.items()))
 
 
 class CompoundBlacklistRule(BlacklistRule):
     """ A CompareRule where the compare function checks a given key against a blacklist """
+    def __init__(self, rules, args=None):
+        # Skip BlacklistRule.__init__, the matcher expands the entries itself
+        CompareRule.__init__(self, rules, args=None)
+        self.blacklist, self._shared_blacklist = blacklist_matcher(self.rules, self)
+        self.get_terms = field_getter(self.rules['compare_key'])
+
+    def close(self):
+        """ Release the shared blacklist, once elastalert replaced the rule. """
+        if self._shared_blacklist is not None:
+            BLACKLISTS.release(self._shared_blacklist, self)
+
+    def add_data(self, data):
+        replace('rule', self.rules, self)
+        self.blacklist.refresh()
+        super(CompoundBlacklistRule, self).add_data(data)
+
+    def garbage_collect(self, timestamp):
+        replace('rule', self.rules, self)
+
     def compare(self, event):
-        terms = lookup_es_key(event, self.rules['compare_key'])
+        terms = self.get_terms(event)
         if not isinstance(terms, list):
             terms = [terms]
+        blacklist = self.blacklist
         for term in terms:
-            if term in self.rules['blacklist']:
+            if term in blacklist:
                 return True
         return False
 
@@ -106,42 +327,171 @@ class CompoundBlacklistRule(BlacklistRule):
 class ProfiledFrequencyRule(FrequencyRule):
     """ A rule that matches if num_events number of events occur within a timeframe """
     required_options = frozenset(['num_events', 'timeframe'])
+    # Whether batch_terms pays off with events windows, whose add costs the same either way
+    batch_events_windows = False
 
     def __init__(self, *args):
         super(ProfiledFrequencyRule, self).__init__(*args)
         self.ts_field = self.rules.get('timestamp_field', '@timestamp')
         self.get_ts = new_get_event_ts(self.ts_field)
+        self.get_event_ts = field_getter(self.ts_field)
+        self.get_key = field_getter(self.rules['query_key']) if 'query_key' in self.rules else None
         self.attach_related = self.rules.get('attach_related', False)
+        window_type = self.rules.get('window_type', 'events')
+        if window_type not in WINDOW_TYPES:
+            raise EAException('Unknown window_type %s, expected one of %s' % (
+                window_type, ', '.join(sorted(WINDOW_TYPES))))
+        self._window_class = WINDOW_TYPES[window_type]
+        if window_type == 'buckets':
+            self._window_class = functools.partial(
+                self._window_class, interval=timedelta(seconds=self.rules.get('bucket_interval', 60)))
+        self._batch_terms = self.rules.get('batch_terms') and (
+            window_type != 'events' or self.batch_events_windows)
         self._profile = {}
         self._profile_ts = 0.0
         self._update_ts = 0.0
+        # Deadlines of the keys garbage_collect has to look at
+        self._expiry = ExpiryIndex()
+        # The profile used by the current batch, it is never mutated
+        self._profile_in_use = None
+        self._use_profile(self._profile)
+        self._load_profile = load_profile
+        if self.rules.get('metrics'):
+            self._instrument()
+        self._watcher = None
+        if self.rules.get('profile') and self.rules.get('profile_watch_interval'):
+            self._watcher = ProfileWatcher(self.rules['profile'], self._swap_profile,
+                                           interval=self.rules['profile_watch_interval'],
+                                           loader=self._shared_profile)
+            self._watcher.poll()
+            self._watcher.start()
+        self._snapshot_path = self.rules.get('snapshot_path')
+        self._snapshot_interval = self.rules.get('snapshot_interval', SNAPSHOT_INTERVAL)
+        self._snapshot_ts = time.time() if self._snapshot_path else 0.0
+        # Restored by the first batch, once the profile and subclasses are set up
+        self._restore_pending = bool(self._snapshot_path) and os.path.exists(self._snapshot_path)
+        if self._snapshot_path:
+            # elastalert resumes from its last query, the windows since the last snapshot are needed
+            at_exit(self.close)
+
+    def _replaced(self):
+        """ Called by the first batch once the rule this one replaces was closed. """
+
+    def close(self):
+        """ Stop watching the profile and release it and save a last snapshot, once
+        elastalert replaced the rule or at exit. """
+        if self._snapshot_path:
+            cancel_at_exit(self.close)
+            # Not before the windows of the snapshot were restored
+            if not self._restore_pending:
+                self.save_snapshot()
+        if self._watcher is not None:
+            self._watcher.stop()
+        if self.rules.get('profile'):
+            PROFILES.release(os.path.abspath(self.rules['profile']), self)
 
     def timeframe(self, key):
-        return self.profile.get(key, self.rules['timeframe'])
+        return self._timeframes.get(key, self._default_timeframe)
+
+    def num_events_of(self, key):
+        return self._num_events.get(key, self._default_num_events)
+
+    def threshold_of(self, key):
+        return self._thresholds.get(key, self._default_threshold)
+
+    def _limits(self, key):
+        return self.timeframe(key), self.threshold_of(key), self.num_events_of(key)
+
+    def _use_profile(self, profile):
+        """ Look limits up in profile, a dict of timeframes or a Profile, from now on.
+        Only the keys whose limits changed have their deadlines rescheduled. """
+        before = []
+        if self._profile_in_use is not None:
+            # Only the keys the profiles set differently can have other limits
+            keys = changed_keys(self._profile_in_use, profile)
+            occurrences = self.occurrences
+            if keys is None:
+                keys = occurrences
+            before = [(key, self._limits(key)) for key in keys if key in occurrences]
+        self._profile_in_use = profile
+        default = Limits(self.rules['timeframe'], self.rules.get('threshold'), self.rules.get('num_events'))
+        if isinstance(profile, dict):
+            self._timeframes = profile
+            self._thresholds = self._num_events = {}
+        else:
+            self._timeframes = profile.timeframes
+            self._thresholds = profile.thresholds
+            self._num_events = profile.num_events
+            default = default.merge(profile.default)
+        self._default_timeframe, self._default_threshold, self._default_num_events = default
+        self._expiry.schedule_all_now([key for key, limits in before if self._limits(key) != limits])
+
+    def _instrument(self):
+        """ Time the rule methods and profile reloads, and export the window sizes. """
+        labels = {'rule': self.rules.get('name')}
+        REGISTRY.instrument(self, RULE_METHODS, 'elastalert_rule_call_seconds', labels)
+        self._load_profile = timed(REGISTRY.histogram('elastalert_profile_reload_seconds', labels),
+                                   load_profile)
+        REGISTRY.register(self, ProfiledFrequencyRule._gauges)
+        start_exporters(self.rules)
+
+    def _gauges(self):
+        labels = {'rule': self.rules.get('name')}
+        # Copied at once, the rule may be changing it
+        sizes = [len(window) for window in list(self.occurrences.values())]
+        return [('elastalert_rule_tracked_keys', labels, len(sizes)),
+                ('elastalert_rule_window_entries', labels, sum(sizes)),
+                ('elastalert_rule_window_entries_max', labels, max(sizes) if sizes else 0)]
+
+    def _shared_profile(self, profile_path, mtime=None, max_age=None, now=None):
+        """ The profile at profile_path as of mtime, loaded once for every rule using it,
+        and again if loaded over max_age seconds ago. """
+        if mtime is None:
+            mtime = os.path.getmtime(profile_path)
+        return PROFILES.load(os.path.abspath(profile_path), mtime,
+                             functools.partial(self._load_profile, profile_path), self, max_age=max_age, now=now)
+
+    def _swap_profile(self, profile):
+        # Called from the watcher thread, a single assignment is atomic
+        self._profile = profile
+        self._profile_ts = time.time()
+
+    def _begin_batch(self):
+        """ Resolve the profile once, timeframe() uses it until the next batch. """
+        if replace('rule', self.rules, self):
+            self._replaced()
+        profile = self._profile if self._watcher else self.profile
+        if profile is not self._profile_in_use:
+            self._use_profile(profile)
+        if self._restore_pending:
+            self._restore_pending = False
+            self.restore_snapshot()
 
     @property
     def profile(self):
         profile_path = self.rules.get('profile')
         if profile_path is None:
-            return {}
+            return self._profile
         now = time.time()
 
         try:
             if not (self._update_ts <= now < self._update_ts + UPDATE_INTERVAL):
                 # Check if updated
-                ts = os.path.getmtime(profile_path)
+                ts = mtime = os.path.getmtime(profile_path)
                 self._update_ts = now
             else:
                 # Skip
                 ts = self._profile_ts
+                mtime = None
 
-            if ts > self._profile_ts or ts > now or now > self._profile_ts + FORCE_UPDATE_INTERVAL:
+            if ts > self._profile_ts or ts > now:
                 elastalert_logger.info('Reloading profile %s', profile_path)
-                with open(profile_path, 'r') as profile_file:
-                    profile = json.load(profile_file)
-                    self._profile = {k: timedelta(seconds=profile[k])
-                                     for k in profile}
-                    self._profile_ts = now
+                self._profile = self._shared_profile(profile_path, mtime, now=now)
+                self._profile_ts = now
+            elif now > self._profile_ts + FORCE_UPDATE_INTERVAL:
+                # Reloaded by the first of the rules using it, the others get that one
+                self._profile = self._shared_profile(profile_path, max_age=FORCE_UPDATE_INTERVAL, now=now)
+                self._profile_ts = now
         except (OSError, IOError, ValueError) as e:
             elastalert_logger.error('Cannot load profile %s: %s', profile_path, e)
         return self._profile
@@ -153,62 +503,199 @@ class ProfiledFrequencyRule(FrequencyRule):
 
         (ts, count), = data.items()
 
-        event = ({self.ts_field: ts}, count)
-        self.occurrences.setdefault(
-            'all',
-            EventWindow(self.timeframe('all'), getTimestamp=self.get_ts)
-        ).append(event)
+        self._begin_batch()
+        self._append('all', ts, count)
         self.check_for_match('all')
+        self._end_batch()
 
     def add_terms_data(self, terms):
-        for timestamp, buckets in terms.iteritems():
-            for bucket in buckets:
-                event = ({self.ts_field: timestamp,
-                          self.rules['query_key']: bucket['key']}, bucket['doc_count'])
-                self.occurrences.setdefault(
-                    bucket['key'],
-                    EventWindow(self.timeframe(bucket['key']), getTimestamp=self.get_ts)
-                ).append(event)
-                self.check_for_match(bucket['key'])
+        self._begin_batch()
+        if self._batch_terms:
+            self._add_terms_batch(terms)
+        else:
+            for timestamp, buckets in terms.iteritems():
+                for bucket in buckets:
+                    event = {self.ts_field: timestamp,
+                             self.rules['query_key']: bucket['key']}
+                    self._append(bucket['key'], timestamp, bucket['doc_count'], event)
+                    self.check_for_match(bucket['key'])
+        self._end_batch()
+
+    def _add_terms_batch(self, terms):
+        """ Same as the per-bucket loop of add_terms_data, but only runs check_for_match
+        on the buckets where it can have an effect. """
+        batch = columnarize_terms(terms)
+        keys, key_index, timestamps, counts = batch
+        ts_field, qk = self.ts_field, self.rules['query_key']
+        repeated = batch.repeated()
+        skip = set(repeated)
+        # The buckets share a few timestamps, convert each once for the windows
+        us_of = dict((ts, dt_to_us(ts)) for ts in set(timestamps))
+
+        # A key with a single bucket gives the same result whether it is checked right
+        # after its bucket is added or after the whole batch, since keys do not interact
+        occurrences = self.occurrences
+        single = []
+        single_keys = []
+        windows = []
+        for pos, (idx, ts, count) in enumerate(zip(key_index, timestamps, counts)):
+            if skip and pos in skip:
+                continue
+            key = keys[idx]
+            window = occurrences.get(key)
+            if window is None:
+                window = self._window(key)
+            window.add(ts, count, {ts_field: ts, qk: key}, us_of[ts])
+            single.append(pos)
+            single_keys.append(key)
+            windows.append(window)
+        self._track(single_keys, [timestamps[pos] for pos in single])
+        candidates = [single[idx] for idx in self._match_candidates(single_keys, windows)]
+
+        # Keys with several buckets are replayed bucket by bucket, in the original order
+        for pos in sorted(candidates + repeated) if repeated else candidates:
+            key = keys[key_index[pos]]
+            if pos in skip:
+                ts = timestamps[pos]
+                self._append(key, ts, counts[pos], {ts_field: ts, qk: key})
+            self.check_for_match(key)
+
+    def _match_candidates(self, keys, windows):
+        """ Indexes of the keys whose windows may produce a match in check_for_match. """
+        window_counts = [window.count() for window in windows]
+        if self._num_events:
+            return at_least(window_counts, [self.num_events_of(key) for key in keys])
+        return at_least(window_counts, self._default_num_events)
 
     def add_data(self, data):
-        if 'query_key' in self.rules:
-            qk = self.rules['query_key']
-        else:
-            qk = None
+        """ Add the events of data, any iterable of them such as a generator over scroll
+        pages, consumed one event at a time. """
+        self._begin_batch()
+        touched = self._add_events(data)
 
-        for event in data:
-            if qk:
-                key = hashable(lookup_es_key(event, qk))
+        # We call this multiple times with the 'end' parameter because subclasses
+        # may or may not want to check while only partial data has been added
+        self._check_end(touched)
+        self._end_batch()
+
+    def _add_events(self, data):
+        """ Add and check the events of add_data. Returns the keys touched, with the
+        position of the last event of each. """
+        get_key = self.get_key
+        get_event_ts = self.get_event_ts
+        touched = {}
+        for position, event in enumerate(data):
+            if get_key:
+                key = hashable(get_key(event))
             else:
                 # If no query_key, we use the key 'all' for all events
                 key = 'all'
 
             # Store the timestamps of recent occurrences, per key
-            self.occurrences.setdefault(
-                key, EventWindow(self.timeframe(key), getTimestamp=self.get_ts)).append((event, 1))
+            self._append(key, get_event_ts(event), 1, event)
             self.check_for_match(key, end=False)
-
-        # We call this multiple times with the 'end' parameter because subclasses
-        # may or may not want to check while only partial data has been added
-        if key in self.occurrences:  # could have been emptied by previous check
-            self.check_for_match(key, end=True)
+            touched[key] = position
+        return touched
+
+    def _check_end(self, touched):
+        """ Check every key touched by a batch once it is all added, in the order of
+        their last events. """
+        occurrences = self.occurrences
+        for key in sorted(touched, key=touched.get):
+            if key in occurrences:  # could have been emptied by previous check
+                self.check_for_match(key, end=True)
+
+    def _end_batch(self):
+        """ Called once the data of a batch is added and checked. """
+        if self._snapshot_path and time.time() >= self._snapshot_ts + self._snapshot_interval:
+            self.save_snapshot()
+
+    def save_snapshot(self):
+        """ Write the timestamps and counts of every window to snapshot_path. """
+        self._snapshot_ts = time.time()
+        entries = ((key, self._first_event_us(key), dt_to_us(window.last_ts())) + tuple(window.entries())
+                   for key, window in self.occurrences.items())
+        try:
+            write_snapshot(self._snapshot_path, entries)
+        except (IOError, OSError) as e:
+            elastalert_logger.error('Cannot save snapshot %s: %s', self._snapshot_path, e)
+
+    def restore_snapshot(self):
+        """ Refill the windows from snapshot_path. Only the timestamps and counts are
+        kept, so the last event of a window has just its timestamp and query key. """
+        qk = self.rules.get('query_key')
+        restored = 0
+        try:
+            for key, first_event_us, last_us, timestamps, counts in read_snapshot(self._snapshot_path):
+                last_ts = us_to_dt(last_us, tzutc())
+                last_event = {self.ts_field: last_ts}
+                if qk:
+                    last_event[qk] = key
+                self._window(key).restore(timestamps, counts, last_ts, last_event)
+                self._restore_first_event(key, first_event_us)
+                self._track([key], [last_ts])
+                restored += 1
+        except (IOError, OSError, ValueError) as e:
+            elastalert_logger.error('Cannot restore snapshot %s: %s', self._snapshot_path, e)
+        elastalert_logger.info('Restored %d windows from %s', restored, self._snapshot_path)
+
+    def _first_event_us(self, key):
+        return None
+
+    def _restore_first_event(self, key, first_event_us):
+        pass
 
     def garbage_collect(self, timestamp):
         """ Remove all occurrence data that is beyond the timeframe away """
-        stale_keys = []
-        for key, window in self.occurrences.iteritems():
-            if timestamp - lookup_es_key(window.data[-1][0], self.ts_field) > self.timeframe(key):
-                stale_keys.append(key)
-        map(self.occurrences.pop, stale_keys)
+        self._begin_batch()
+        for key in self._expiry.expired(timestamp):
+            window = self.occurrences.get(key)
+            if window is None:
+                # Popped by a match
+                continue
+            deadline = window.last_ts() + self.timeframe(key)
+            if timestamp > deadline:
+                self.occurrences.pop(key)
+            else:
+                self._expiry.schedule(key, deadline)
+        self._end_batch()
+
+    def check_for_match(self, key, end=False):
+        window = self.occurrences[key]
+        if window.count() >= self.num_events_of(key):
+            event = window.last_event()
+            if self.attach_related:
+                event['related_events'] = window.related_events()
+            self.add_match(event)
+            self.occurrences.pop(key)
+
+    def _window(self, key):
+        window = self.occurrences.get(key)
+        if window is None:
+            window = self.occurrences[key] = self._window_class(
+                self.timeframe(key), self.ts_field, keep_events=self.attach_related)
+        return window
+
+    def _append(self, key, ts, count, event=None):
+        self._window(key).add(ts, count, event)
+        self._track([key], [ts])
+
+    def _track(self, keys, timestamps):
+        """ Let garbage_collect know that events were added to keys. """
+        expiry = self._expiry
+        for key, ts in zip(keys, timestamps):
+            if key not in expiry:
+                # The deadline is only a lower bound, garbage_collect moves it forward
+                # to the latest event when it fires
+                expiry.schedule(key, ts + self.timeframe(key))
 
     def get_match_str(self, match):
         lt = self.rules.get('use_local_time')
-        match_ts = lookup_es_key(match, self.ts_field)
+        match_ts = self.get_event_ts(match)
         key = match.get('key', 'all')
         starttime = pretty_ts(dt_to_ts(ts_to_dt(match_ts) - self.timeframe(key)), lt)
         endtime = pretty_ts(match_ts, lt)
-        message = 'At least %d events occurred between %s and %s\n\n' % (self.rules['num_events'],
+        message = 'At least %d events occurred between %s and %s\n\n' % (self.num_events_of(key),
                                                                          starttime,
                                                                          endtime)
         message = json.dumps(match)
@@ -216,19 +703,62 @@ class ProfiledFrequencyRule(FrequencyRule):
 
 
 class ProfiledThresholdRule(ProfiledFrequencyRule):
-    """ A rule that matches when there is a low number of events given a timeframe. """
+    """ A rule that matches when there is a low number of events given a timeframe.
+
+    With coalesce_transitions, the status changes of a batch, e.g. of a garbage_collect
+    pass, make one match whose transitions list the key, count, status and timestamp of
+    each, without related events.
+    """
     required_options = frozenset(['threshold', 'timeframe'])
+    # Most of the per-bucket checks are skipped
+    batch_events_windows = True
 
     def __init__(self, *args):
         super(ProfiledThresholdRule, self).__init__(*args)
         self.threshold = self.rules['threshold']
         self.above = self.rules.get('above_name', 'above')
         self.below = self.rules.get('below_name', 'below')
-        self._cache_path = self.rules.get('cache_path')
 
         # Dictionary mapping query keys to the first events
         self.first_event = {}
-        self._last_status = self._load_status()
+        self._status = StatusStore(
+            self.rules.get('cache_path'),
+            flush_interval=self.rules.get('cache_flush_interval', 0.0),
+            journal=self.rules.get('cache_journal', False),
+            compact_entries=self.rules.get('cache_compact_entries', 10000))
+        self.coalesce = self.rules.get('coalesce_transitions', False)
+        self._transitions = []
+
+    def _replaced(self):
+        # The previous rule flushed its status on close, after this one loaded it
+        self._status.load()
+
+    def close(self):
+        super(ProfiledThresholdRule, self).close()
+        self._status.close()
+
+    def _end_batch(self):
+        if self._transitions:
+            self._add_coalesced_match()
+        super(ProfiledThresholdRule, self)._end_batch()
+        self._status.flush()
+
+    def _add_coalesced_match(self):
+        transitions = self._transitions
+        self._transitions = []
+        ts = max(transition[self.ts_field] for transition in transitions)
+        for transition in transitions:
+            transition[self.ts_field] = dt_to_ts(transition[self.ts_field])
+        self.add_match({self.ts_field: ts, 'key': 'all', 'count': len(transitions),
+                        'status': 'transitions', 'transitions': transitions})
+
+    def _first_event_us(self, key):
+        first_event = self.first_event.get(key)
+        return None if first_event is None else dt_to_us(first_event)
+
+    def _restore_first_event(self, key, first_event_us):
+        if first_event_us is not None:
+            self.first_event[key] = us_to_dt(first_event_us, tzutc())
 
     def check_for_match(self, key, end=True):
         # This function gets called between every added document with end=True after the last
@@ -236,13 +766,14 @@ class ProfiledThresholdRule(ProfiledFrequencyRule):
         if not end:
             return
 
-        most_recent_ts = self.get_ts(self.occurrences[key].data[-1])
+        window = self.occurrences[key]
+        most_recent_ts = window.last_ts()
         if self.first_event.get(key) is None:
             self.first_event[key] = most_recent_ts
 
         # Match if, after removing old events, we hit num_events
-        count = self.occurrences[key].count()
-        status = self.below if count < self.rules['threshold'] else self.above
+        count = window.count()
+        status = self.below if count < self.threshold_of(key) else self.above
 
         # Don't set to `below` until timeframe has elapsedq
         # This is copied from FlatlineRule, so only applies to below
@@ -251,22 +782,27 @@ class ProfiledThresholdRule(ProfiledFrequencyRule):
             return
 
         if status != self._get_status(key):
-            # Do a deep-copy, otherwise we lose the datetime type
-            # in the timestamp field of the last event
-            event = copy.deepcopy(self.occurrences[key].data[-1][0])
-            event.update(key=key, count=count, status=status)
-            if (status == self.below):
-                event.update({self.ts_field: event[self.ts_field] - self.timeframe(key)})
-            if self.attach_related:
-                event['related_events'] = [data[0] for data in self.occurrences[key].data[:-1]]
-            self.add_match(event)
+            timeframe = self.timeframe(key)
+            last_event = window.last_event()
+            ts = last_event[self.ts_field]
+            if status == self.below:
+                ts -= timeframe
+            if self.coalesce:
+                self._transitions.append({self.ts_field: ts, 'key': key, 'count': count, 'status': status})
+            else:
+                # add_match turns the timestamp into a string in place, so the match must
+                # not be the event in the window. Nested values are shared with it.
+                event = dict(last_event)
+                event.update(key=key, count=count, status=status)
+                event[self.ts_field] = ts
+                if self.attach_related:
+                    event['related_events'] = window.related_events()
+                self.add_match(event)
 
             # After adding this match, leave the occurrences windows alone since it will
             # be pruned in the next add_data or garbage_collect, but reset the first_event
             # so that alerts continue to fire until the threshold is passed again.
-            least_recent_ts = self.get_ts(self.occurrences[key].data[0])
-            timeframe_ago = most_recent_ts - self.timeframe(key)
-            self.first_event[key] = min(least_recent_ts, timeframe_ago)
+            self.first_event[key] = min(window.first_ts(), most_recent_ts - timeframe)
 
             self._set_status(key, status)
 
@@ -278,48 +814,84 @@ class ProfiledThresholdRule(ProfiledFrequencyRule):
         message += 'Between %s and %s, there were less than %s events.\n\n' % (
             pretty_ts(dt_to_ts(ts_to_dt(ts) - self.timeframe(key)), lt),
             pretty_ts(ts, lt),
-            self.rules['threshold']
+            self.threshold_of(key)
         )
         message = json.dumps(match)
         return message
 
     def garbage_collect(self, ts):
-        # We add an event with a count of zero to the EventWindow for each key.
+        # We add an event with a count of zero to the EventWindow for each due key.
         # This will cause the EventWindow to remove events that occurred
         # more than one `timeframe` ago, and call onRemoved on them.
-        default = ['all'] if 'query_key' not in self.rules else []
-        for key in self.occurrences.keys() or default:
-            self.occurrences.setdefault(
-                key,
-                EventWindow(self.timeframe(key), getTimestamp=self.get_ts)
-            ).append(
-                ({self.ts_field: ts}, 0)
-            )
+        # Keys whose status cannot change before their deadline are left alone.
+        self._begin_batch()
+        keys = self._expiry.expired(ts)
+        if not self.occurrences and 'query_key' not in self.rules:
+            keys = ['all']
+        for key in keys:
+            self._window(key).add(ts, 0)
             self.first_event.setdefault(key, ts)
             self.check_for_match(key)
-        super(ProfiledThresholdRule, self).garbage_collect(ts)
+            self._schedule_check(key)
+        self._end_batch()
+
+    def _match_candidates(self, keys, windows):
+        window_counts = [window.count() for window in windows]
+        if self._thresholds:
+            above = at_least_mask(window_counts, [self.threshold_of(key) for key in keys])
+        else:
+            above = at_least_mask(window_counts, self._default_threshold)
+        get_status = self._status.get
+        get_first_event = self.first_event.get
+        candidates = []
+        for idx, (key, window, is_above) in enumerate(zip(keys, windows, above)):
+            # check_for_match has no effect unless it sets first_event or changes the status
+            first_event = get_first_event(key)
+            status = get_status(key)
+            if first_event is None or (status != self.above if is_above else (
+                    status != self.below and
+                    window.last_ts() - first_event >= self.timeframe(key))):
+                candidates.append(idx)
+        return candidates
+
+    def _track(self, keys, timestamps):
+        # New data may change the status, check it on the next garbage_collect
+        self._expiry.schedule_all_now(keys)
+
+    def _schedule_check(self, key):
+        """ Schedule the earliest time at which the status of key may change without new data. """
+        window = self.occurrences[key]
+        timeframe = self.timeframe(key)
+        gate = self.first_event[key] + timeframe
+        threshold = self.threshold_of(key)
+        if window.count() < threshold:
+            if self._get_status(key) == self.below:
+                # Only new data can change the status
+                self._expiry.discard(key)
+            else:
+                self._expiry.schedule(key, gate)
+            return
+
+        # Find the event that keeps the count at the threshold,
+        # the status turns below once it leaves the window
+        reaching = window.ts_reaching(threshold)
+        self._expiry.schedule(key, max(reaching + timeframe, gate))
 
     def _get_status(self, key):
-        return self._last_status.get(key)
+        return self._status.get(key)
 
     def _set_status(self, key, value):
-        self._last_status[key] = value
-        self._save_status()
+        # Persisted by the flush at the end of the current pass
+        self._status.set(key, value)
 
-    def _load_status(self):
-        if not self._cache_path:
-            return {}
-        try:
-            with open(self._cache_path, 'r') as jsonf:
-                return json.load(jsonf)
-        except IOError:
-            return {}
 
-    def _save_status(self):
-        if not self._cache_path:
-            return
-        try:
-            with open(self._cache_path, 'w') as jsonf:
-                return json.dump(self._last_status, jsonf)
-        except IOError:
-            pass
+class ShardedProfiledFrequencyRule(ShardedRule):
+    """ ProfiledFrequencyRule with its query keys spread over `shards` processes. """
+    required_options = ProfiledFrequencyRule.required_options
+    shard_class = ProfiledFrequencyRule
+
+
+class ShardedProfiledThresholdRule(ShardedRule):
+    """ ProfiledThresholdRule with its query keys spread over `shards` processes. """
+    required_options = ProfiledThresholdRule.required_options
+    shard_class = ProfiledThresholdRule
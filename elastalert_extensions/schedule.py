@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from datetime import date, datetime, time
+import re
+
+from dateutil import parser
+from elastalert.util import EAException
+from pytz import timezone
+
+from elastalert_extensions.blacklist import string_types
+from elastalert_extensions.windows import dt_to_us
+from elastalert_extensions.windows import td_to_us
+from elastalert_extensions.windows import us_to_dt
+
+
+HOUR_US = 3600 * 1000000
+DAY_US = 24 * HOUR_US
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+# 1970-01-01 was a Thursday
+EPOCH_WEEKDAY = 3
+DAY_NAMES = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+MAX_CACHED = 10000
+# Out of range times do not match and go to dateutil, which rejects them
+ISO_TS = re.compile(r'(\d{4}-\d{2}-\d{2})[T ]([01]\d|2[0-3]):([0-5]\d):([0-5]\d)(?:[.,](\d+))?'
+                    r'(Z|[+-](?:[01]\d|2[0-3])(?::?[0-5]\d)?)?$')
+
+_epoch_days = {}
+
+
+def parse_time(s):
+    if not s:
+        return None
+    return time(*tuple(map(int, s.split(':'))))
+
+
+def time_to_us(t):
+    return ((t.hour * 60 + t.minute) * 60 + t.second) * 1000000 + t.microsecond
+
+
+def _days_since_epoch(day):
+    days = _epoch_days.get(day)
+    if days is None:
+        if len(_epoch_days) >= MAX_CACHED:
+            _epoch_days.clear()
+        year, month, mday = day.split('-')
+        days = _epoch_days[day] = date(int(year), int(month), int(mday)).toordinal() - EPOCH_ORDINAL
+    return days
+
+
+def ts_to_us(value):
+    """ Microseconds since the epoch of a datetime or timestamp string, naive ones being UTC.
+
+    ISO 8601 strings as written by Elasticsearch and elastalert are parsed directly,
+    anything else by dateutil.
+    """
+    if isinstance(value, datetime):
+        return dt_to_us(value)
+    match = ISO_TS.match(value)
+    if match is None:
+        return dt_to_us(parser.parse(value))
+    day, hour, minute, second, fraction, offset = match.groups()
+    try:
+        us = ((_days_since_epoch(day) * 24 + int(hour)) * 60 + int(minute)) * 60 + int(second)
+    except ValueError:
+        return dt_to_us(parser.parse(value))
+    if offset and offset != 'Z':
+        offset_minutes = int(offset[1:3]) * 60 + int(offset[-2:] if len(offset) > 3 else 0)
+        us += -60 * offset_minutes if offset[0] == '+' else 60 * offset_minutes
+    us *= 1000000
+    if fraction:
+        us += int((fraction + '00000')[:6])
+    return us
+
+
+class UtcOffsets(object):
+    """ The UTC offset of tz at a time, cached per hour.
+
+    Hours with a transition in them, e.g. half past the hour in Newfoundland, are
+    not cached and looked up each time.
+    """
+
+    def __init__(self, tz):
+        self.tz = tz
+        self._hours = {}
+
+    def _lookup(self, us):
+        return td_to_us(us_to_dt(us, self.tz).utcoffset())
+
+    def __call__(self, us):
+        hour = us // HOUR_US
+        offset = self._hours.get(hour)
+        if offset is None:
+            if hour in self._hours:
+                return self._lookup(us)
+            if len(self._hours) >= MAX_CACHED:
+                self._hours.clear()
+            start = hour * HOUR_US
+            offset = self._lookup(start)
+            if offset != self._lookup(start + HOUR_US - 1):
+                self._hours[hour] = None
+                return self._lookup(us)
+            self._hours[hour] = offset
+        return offset
+
+
+def parse_days(days):
+    """ Weekday numbers, Monday being 0, from a list or comma separated string of day
+    names, numbers and ranges like mon-fri. """
+    if days is None:
+        return list(range(7))
+    if isinstance(days, string_types):
+        days = days.split(',')
+
+    def weekday(day):
+        name = day.strip().lower()[:3] if isinstance(day, string_types) else day
+        if name in DAY_NAMES:
+            return DAY_NAMES.index(name)
+        if str(name).isdigit() and 0 <= int(name) < 7:
+            return int(name)
+        raise EAException('Unknown day of week %s in schedule' % day)
+
+    weekdays = set()
+    for day in days:
+        if isinstance(day, string_types) and '-' in day:
+            first, last = map(weekday, day.split('-', 1))
+            weekdays.update((first + i) % 7 for i in range((last - first) % 7 + 1))
+        else:
+            weekdays.add(weekday(day))
+    return sorted(weekdays)
+
+
+class Schedule(object):
+    """ Time of day windows on days of the week in a timezone.
+
+    The schedule is a list of windows, each with optional from and to times, to
+    being inclusive, and days, all days by default. Given no list of windows, the
+    schedule itself is the one window. A window from later than it is to wraps past
+    midnight, the days then being those of the timestamps.
+    """
+
+    def __init__(self, schedule):
+        self.tz = timezone(schedule.get('timezone', 'UTC'))
+        self.offsets = UtcOffsets(self.tz)
+        # Intervals of microseconds since midnight per weekday
+        self.intervals = [[] for _ in range(7)]
+        for window in schedule.get('windows') or [schedule]:
+            from_ = parse_time(window.get('from'))
+            to = parse_time(window.get('to'))
+            start = time_to_us(from_) if from_ else 0
+            end = time_to_us(to) if to else DAY_US - 1
+            if start <= end:
+                intervals = [(start, end)]
+            else:
+                intervals = [(start, DAY_US - 1), (0, end)]
+            for weekday in parse_days(window.get('days')):
+                self.intervals[weekday].extend(intervals)
+        self.always = all((0, DAY_US - 1) in intervals for intervals in self.intervals)
+
+    def __contains__(self, us):
+        """ Whether the time in microseconds since the epoch is in one of the windows. """
+        if self.always:
+            return True
+        days, time_of_day = divmod(us + self.offsets(us), DAY_US)
+        for start, end in self.intervals[(days + EPOCH_WEEKDAY) % 7]:
+            if start <= time_of_day <= end:
+                return True
+        return False
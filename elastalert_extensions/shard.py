@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from collections import defaultdict, deque, OrderedDict
+import json
+import multiprocessing
+import os.path
+import time
+import traceback
+import zlib
+
+from elastalert.ruletypes import RuleType
+from elastalert.util import EAException, elastalert_logger, hashable
+
+from elastalert_extensions.blacklist import text_type
+from elastalert_extensions.fields import field_getter
+from elastalert_extensions import lifecycle
+from elastalert_extensions.metrics import REGISTRY
+from elastalert_extensions.metrics import RULE_METHODS
+from elastalert_extensions.metrics import start_exporters
+from elastalert_extensions.status import StatusStore
+
+
+CLOSE_TIMEOUT = 10.0
+
+
+def shard_of(key, shards):
+    """ The shard owning key, stable across processes and the same for a key and its
+    string form as found in the status cache. """
+    key = key.encode('utf-8') if isinstance(key, text_type) else str(key)
+    return zlib.crc32(key) % shards
+
+
+def _positioned(rule_class):
+    """ A subclass of rule_class recording, for every match, the position in the input
+    of the data that triggered it.
+
+    positions maps keys to the positions of their data, in order. A check_for_match
+    of a key takes the next one, or once they ran out end plus the last one taken, so
+    end of batch checks sort after the data and in the order of its last position.
+    """
+    class PositionedRule(rule_class):
+
+        def __init__(self, *args):
+            super(PositionedRule, self).__init__(*args)
+            self.positions = {}
+            self.end = 0
+            self.match_positions = []
+            self.last_positions = {}
+            self._position = 0
+
+        def check_for_match(self, key, *args, **kwargs):
+            positions = self.positions.get(key)
+            if positions:
+                self._position = self.last_positions[key] = positions.popleft()
+            else:
+                self._position = self.end + self.last_positions.get(key, 0)
+            super(PositionedRule, self).check_for_match(key, *args, **kwargs)
+
+        def add_match(self, match):
+            super(PositionedRule, self).add_match(match)
+            self.match_positions.append(self._position)
+
+        def take_matches(self):
+            matches = zip(self.match_positions, self.matches)
+            self.matches = []
+            self.match_positions = []
+            return matches
+
+    return PositionedRule
+
+
+class ShardWorker(object):
+    """ Runs one shard of a rule, in a process of a ShardPool. """
+
+    def __init__(self, rule_class, rules, index, shards):
+        rules = dict(rules)
+        # Metrics are exported by the ShardedRule, with the gauges of every shard
+        for option in ('metrics', 'metrics_port', 'metrics_path'):
+            rules.pop(option, None)
+        self.index = index
+        cache_path = rules.get('cache_path')
+        for option in ('cache_path', 'snapshot_path'):
+            if rules.get(option):
+                rules[option] = '%s.shard%dof%d' % (rules[option], index, shards)
+        self.rule = _positioned(rule_class)(rules)
+        if (cache_path and hasattr(self.rule, '_status') and os.path.exists(cache_path) and
+                not os.path.exists(rules['cache_path'])):
+            # Carry over the status of our keys from an unsharded run
+            unsharded = StatusStore(cache_path)
+            for key, value in unsharded.items():
+                if shard_of(key, shards) == index:
+                    self.rule._status.set(key, value)
+            unsharded.close()
+
+    def _set_positions(self, keys_positions, end):
+        positions = defaultdict(deque)
+        for key, position in keys_positions:
+            positions[key].append(position)
+        self.rule.positions = positions
+        self.rule.end = end
+        self.rule.last_positions = {}
+
+    def add_data(self, items, end):
+        """ items are (position, key, event). """
+        self._set_positions(((key, position) for position, key, _ in items), end)
+        self.rule.add_data(event for _, _, event in items)
+        return self.rule.take_matches()
+
+    def add_terms_data(self, items, end):
+        """ items are (position, timestamp, bucket). """
+        self._set_positions(((bucket['key'], position) for position, _, bucket in items), end)
+        terms = OrderedDict()
+        for _, timestamp, bucket in items:
+            terms.setdefault(timestamp, []).append(bucket)
+        self.rule.add_terms_data(terms)
+        return self.rule.take_matches()
+
+    def add_count_data(self, data):
+        self._set_positions((), 0)
+        self.rule.add_count_data(data)
+        return self.rule.take_matches()
+
+    def garbage_collect(self, timestamp):
+        self._set_positions((), 0)
+        self.rule.garbage_collect(timestamp)
+        return self.rule.take_matches()
+
+    def replaced(self):
+        self.rule._replaced()
+
+    def close(self):
+        """ Flush what the rule keeps, its process ending without running the exit hooks. """
+        self.rule.close()
+
+    def gauges(self):
+        return [(name, dict(labels, shard=self.index), value) for name, labels, value in self.rule._gauges()]
+
+
+def _serve(rule_class, rules, index, shards, conn):
+    # The hooks and rules inherited from the parent are its own
+    lifecycle.forget()
+    try:
+        worker = ShardWorker(rule_class, rules, index, shards)
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+        return
+    conn.send(('ok', None))
+    try:
+        while True:
+            try:
+                request = conn.recv()
+            except (EOFError, KeyboardInterrupt):
+                return
+            if request is None:
+                return
+            method, args = request
+            try:
+                conn.send(('ok', getattr(worker, method)(*args)))
+            except Exception:
+                conn.send(('error', traceback.format_exc()))
+    finally:
+        try:
+            worker.close()
+        except Exception as e:
+            elastalert_logger.error('Error closing shard %d of %s: %s', index, rules.get('name'), e)
+
+
+class ShardPool(object):
+    """ Processes each running the keys of one shard of a rule. close() lets each
+    close its rule, waiting up to close_timeout seconds for it. """
+
+    def __init__(self, rule_class, rules, shards, close_timeout=CLOSE_TIMEOUT):
+        self.close_timeout = close_timeout
+        self.shards = shards
+        self._conns = []
+        self._procs = []
+        for index in range(shards):
+            conn, child_conn = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=_serve, name='%s shard %d' % (rules.get('name'), index),
+                                           args=(rule_class, rules, index, shards, child_conn))
+            proc.daemon = True
+            proc.start()
+            child_conn.close()
+            self._conns.append(conn)
+            self._procs.append(proc)
+        self._receive(range(shards))
+        lifecycle.at_exit(self.close)
+
+    def call(self, requests):
+        """ Send {shard: (method, args)} and wait for all the results, run in parallel. """
+        for index, request in requests.items():
+            self._conns[index].send(request)
+        return self._receive(requests)
+
+    def _receive(self, indexes):
+        results = {}
+        errors = []
+        for index in indexes:
+            status, result = self._conns[index].recv()
+            if status == 'error':
+                errors.append('shard %d: %s' % (index, result))
+            results[index] = result
+        if errors:
+            raise EAException('Error in rule shards\n' + '\n'.join(errors))
+        return results
+
+    def close(self):
+        lifecycle.cancel_at_exit(self.close)
+        for conn, proc in zip(self._conns, self._procs):
+            if proc.is_alive():
+                try:
+                    conn.send(None)
+                except (IOError, OSError):
+                    pass
+        deadline = time.time() + self.close_timeout
+        for proc in self._procs:
+            proc.join(max(0.0, deadline - time.time()))
+        self._conns = []
+        self._procs = []
+
+
+class ShardedRule(RuleType):
+    """ Runs shard_class in shards processes, each owning the query keys hashing to it.
+
+    The matches are the same, in the same order, as those of a single shard_class,
+    save for garbage_collect where they come shard by shard. Each shard has its own
+    `<cache_path>.shard<i>of<shards>`, initialized from cache_path, and snapshot.
+    With metrics, the calls are timed and exported here, along with the gauges of the
+    shards, labelled with their shard and refreshed by garbage_collect.
+    """
+    shard_class = None
+
+    def __init__(self, rules, args=None):
+        super(ShardedRule, self).__init__(rules, args)
+        if 'query_key' not in self.rules:
+            raise EAException('Sharding requires a query_key')
+        self.shards = self.rules.get('shards') or multiprocessing.cpu_count()
+        self.get_key = field_getter(self.rules['query_key'])
+        elastalert_logger.info('Starting %d shards of %s', self.shards, self.rules.get('name'))
+        self._pool = ShardPool(self.shard_class, self.rules, self.shards)
+        self._shard_gauges = []
+        if self.rules.get('metrics'):
+            labels = {'rule': self.rules.get('name')}
+            REGISTRY.instrument(self, RULE_METHODS, 'elastalert_rule_call_seconds', labels)
+            # Read by the exporters, the pipes being only used from the rule's thread
+            REGISTRY.register(self, lambda rule: rule._shard_gauges)
+            start_exporters(self.rules)
+
+    def close(self):
+        """ Stop the shards, once elastalert replaced the rule. """
+        self._pool.close()
+
+    def _begin_batch(self):
+        if lifecycle.replace('rule', self.rules, self):
+            # The shards of the previous rule flushed their state on close, after ours loaded it
+            self._pool.call(dict((index, ('replaced', ())) for index in range(self.shards)))
+
+    def _collect(self, results):
+        positioned = []
+        for index in sorted(results):
+            positioned.extend(results[index])
+        # Stable, so ties stay in shard order
+        positioned.sort(key=lambda position_match: position_match[0])
+        self.matches.extend(match for _, match in positioned)
+
+    def add_data(self, data):
+        self._begin_batch()
+        items = defaultdict(list)
+        get_key = self.get_key
+        position = -1
+        for position, event in enumerate(data):
+            key = hashable(get_key(event))
+            items[shard_of(key, self.shards)].append((position, key, event))
+        if not items:
+            return
+        self._collect(self._pool.call(dict(
+            (index, ('add_data', (shard_items, position + 1)))
+            for index, shard_items in items.items())))
+
+    def add_terms_data(self, terms):
+        self._begin_batch()
+        items = defaultdict(list)
+        position = 0
+        for timestamp, buckets in terms.iteritems():
+            for bucket in buckets:
+                items[shard_of(bucket['key'], self.shards)].append((position, timestamp, bucket))
+                position += 1
+        self._collect(self._pool.call(dict(
+            (index, ('add_terms_data', (shard_items, position)))
+            for index, shard_items in items.items())))
+
+    def add_count_data(self, data):
+        self._begin_batch()
+        self._collect(self._pool.call({shard_of('all', self.shards): ('add_count_data', (data,))}))
+
+    def garbage_collect(self, timestamp):
+        self._begin_batch()
+        self._collect(self._pool.call(dict(
+            (index, ('garbage_collect', (timestamp,))) for index in range(self.shards))))
+        if self.rules.get('metrics'):
+            gauges = self._pool.call(dict((index, ('gauges', ())) for index in range(self.shards)))
+            self._shard_gauges = [gauge for index in sorted(gauges) for gauge in gauges[index]]
+
+    def get_match_str(self, match):
+        return json.dumps(match)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+""" Values shared process-wide by the rules using them, like the blacklists and
+profiles many rules point at. A value is kept while one of its subscribers is alive
+and evicted with the last one, and loaded once for all of them. """
+from __future__ import absolute_import
+import functools
+import threading
+import time
+import weakref
+
+
+class _Entry(object):
+    __slots__ = ('lock', 'loaded', 'loaded_ts', 'version', 'value', 'subscribers')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.loaded_ts = 0.0
+        self.version = None
+        self.value = None
+        # id of the subscriber to a weak reference to it
+        self.subscribers = {}
+
+
+class SharedCache(object):
+    """ Values by key, each loaded once for all the objects subscribed to it. A new
+    version replaces a value as a whole, subscribers holding the previous one keep it.
+    A value updating itself, like a BlacklistMatcher, does so for all its subscribers
+    and must be safe to read meanwhile. """
+
+    def __init__(self):
+        # Reentrant, a weak reference callback may run while it is held
+        self._lock = threading.RLock()
+        self._entries = {}
+
+    def get(self, key, factory, owner):
+        """ The value of key, made with factory() by its first subscriber. owner is
+        subscribed to key until it is released or garbage collected. """
+        return self.load(key, None, factory, owner)
+
+    def load(self, key, version, loader, owner, max_age=None, now=None):
+        """ The value of key as of version, such as the mtime of a file, loaded with
+        loader() unless a subscriber already loaded that version. With max_age, a value
+        loaded more than max_age seconds ago is loaded again whatever the version, once
+        for all the subscribers, now defaulting to time.time(). owner is subscribed to
+        key like with get. """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry()
+            if id(owner) not in entry.subscribers:
+                entry.subscribers[id(owner)] = weakref.ref(
+                    owner, functools.partial(self._unsubscribe, key, entry, id(owner)))
+        with entry.lock:
+            if now is None:
+                now = time.time()
+            if (not entry.loaded or entry.version != version or
+                    (max_age is not None and now > entry.loaded_ts + max_age)):
+                # Swapped in as a whole, subscribers holding the previous value keep it
+                entry.value = loader()
+                entry.version = version
+                entry.loaded = True
+                entry.loaded_ts = now
+            return entry.value
+
+    def release(self, key, owner):
+        """ Unsubscribe owner from key, evicting its value if owner was the last subscriber. """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._unsubscribe(key, entry, id(owner))
+
+    def _unsubscribe(self, key, entry, owner_id, ref=None):
+        with self._lock:
+            entry.subscribers.pop(owner_id, None)
+            if not entry.subscribers and self._entries.get(key) is entry:
+                del self._entries[key]
+
+    def subscribers(self, key):
+        """ The number of live subscribers to key. """
+        with self._lock:
+            entry = self._entries.get(key)
+            return len(entry.subscribers) if entry is not None else 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+BLACKLISTS = SharedCache()
+PROFILES = SharedCache()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from array import array
+import json
+import mmap
+import struct
+import sys
+
+from elastalert_extensions.status import atomic_write
+
+
+MAGIC = b'EAWS'
+VERSION = 1
+# magic, version, byte order, offset and length of the index
+HEADER = struct.Struct('<4sHcQQ')
+BYTEORDER = b'l' if sys.byteorder == 'little' else b'b'
+ITEMSIZE = array('d').itemsize
+
+
+def write_snapshot(path, entries):
+    """ Atomically write the windows of entries, an iterable of
+    (key, first_event_us, last_us, timestamps, counts), to path.
+
+    The timestamps and counts arrays of every key follow the header back to back,
+    then a JSON index of [key, first_event_us, last_us, offset, length] lists.
+    """
+    def writer(f):
+        f.write(HEADER.pack(MAGIC, VERSION, BYTEORDER, 0, 0))
+        offset = HEADER.size
+        index = []
+        for key, first_event_us, last_us, timestamps, counts in entries:
+            timestamps.tofile(f)
+            counts.tofile(f)
+            index.append([key, first_event_us, last_us, offset, len(timestamps)])
+            offset += 2 * ITEMSIZE * len(timestamps)
+        index = json.dumps(index).encode('utf-8')
+        f.write(index)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, BYTEORDER, offset, len(index)))
+    atomic_write(path, writer, mode='wb')
+
+
+def read_snapshot(path):
+    """ Yield the (key, first_event_us, last_us, timestamps, counts) written by
+    write_snapshot. The file is memory-mapped and the arrays are copied straight out
+    of it. Raises ValueError if it is not a snapshot. """
+    with open(path, 'rb') as f:
+        # Raises ValueError on an empty file
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if len(mapped) < HEADER.size:
+            raise ValueError('Truncated snapshot')
+        magic, version, byteorder, index_offset, index_length = HEADER.unpack_from(mapped)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a version %d window snapshot' % VERSION)
+        index = json.loads(mapped[index_offset:index_offset + index_length].decode('utf-8'))
+        for key, first_event_us, last_us, offset, length in index:
+            end = offset + ITEMSIZE * length
+            timestamps = array('d')
+            timestamps.fromstring(mapped[offset:end])
+            counts = array('d')
+            counts.fromstring(mapped[end:end + ITEMSIZE * length])
+            if byteorder != BYTEORDER:
+                timestamps.byteswap()
+                counts.byteswap()
+            if isinstance(key, list):
+                key = tuple(key)
+            yield key, first_event_us, last_us, timestamps, counts
+    finally:
+        mapped.close()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from collections import OrderedDict
+import json
+import os
+
+from elastalert.util import elastalert_logger
+from kombu.utils import json as kombu_json
+
+from elastalert_extensions.status import atomic_write, truncate_torn_line
+
+
+SPOOL_SIZE = 1000
+
+
+class _Unkeyed(object):
+    """ Stands in for the key of a match without one, equal only to itself. """
+    __slots__ = ()
+
+
+class Spool(object):
+    """ Matches held back for later, in an append-only file that survives restarts.
+
+    A match replaces the spooled match with the same key, matches added with key None
+    are all kept. At most max_entries matches are kept, the oldest being dropped. The
+    file is rewritten with only the live entries once it has twice max_entries lines.
+
+    :param path: The spool file.
+    :param max_entries: The maximum number of spooled matches.
+    """
+
+    def __init__(self, path, max_entries=SPOOL_SIZE):
+        self.path = path
+        self.max_entries = max_entries
+        self.dropped = 0
+        self._entries = OrderedDict()
+        self._lines = 0
+        self._file = None
+        self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def matches(self):
+        return list(self._entries.values())
+
+    def load(self):
+        self._entries = OrderedDict()
+        self._lines = 0
+        self._close()
+        if truncate_torn_line(self.path):
+            elastalert_logger.warning('Dropped a torn last line of spool %s', self.path)
+        try:
+            with open(self.path, 'r') as spool:
+                for line in spool:
+                    try:
+                        key, match = json.loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(key, list):
+                        # A compound query key
+                        key = tuple(key)
+                    self._put(key, match)
+                    self._lines += 1
+        except (IOError, OSError) as e:
+            if os.path.exists(self.path):
+                elastalert_logger.error('Cannot load spool %s: %s', self.path, e)
+
+    def add(self, key, match):
+        self._put(key, match)
+        try:
+            if self._lines >= 2 * self.max_entries:
+                self._compact()
+            else:
+                if self._file is None:
+                    self._file = open(self.path, 'a')
+                self._file.write(kombu_json.dumps([key, match]) + '\n')
+                self._file.flush()
+                self._lines += 1
+        except (IOError, OSError) as e:
+            elastalert_logger.error('Cannot append to spool %s: %s', self.path, e)
+
+    def clear(self):
+        self._entries.clear()
+        self._close()
+        try:
+            open(self.path, 'w').close()
+        except (IOError, OSError) as e:
+            elastalert_logger.error('Cannot truncate spool %s: %s', self.path, e)
+        self._lines = 0
+
+    def close(self):
+        self._close()
+
+    def _put(self, key, match):
+        entry_key = _Unkeyed() if key is None else key
+        self._entries.pop(entry_key, None)
+        self._entries[entry_key] = match
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.dropped += 1
+
+    def _compact(self):
+        self._close()
+        lines = [kombu_json.dumps([None if isinstance(key, _Unkeyed) else key, match]) + '\n'
+                 for key, match in self._entries.items()]
+        atomic_write(self.path, lambda f: f.writelines(lines))
+        self._lines = len(lines)
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import tempfile
+import time
+
+from elastalert.util import elastalert_logger
+
+from elastalert_extensions.lifecycle import at_exit
+from elastalert_extensions.lifecycle import cancel_at_exit
+
+
+def atomic_write(file_path, writer, mode='w'):
+    """ Write a file by calling writer(f) on a temporary file in the same directory
+    and renaming it over file_path, so readers never observe a partial file. """
+    dirname = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(file_path))
+    try:
+        with os.fdopen(fd, mode) as tmp_file:
+            writer(tmp_file)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.rename(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def truncate_torn_line(path):
+    """ Cut a last line left without its newline by a crash off the append-only file at
+    path, so the next append starts on a line of its own. Returns whether one was cut. """
+    try:
+        with open(path, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            position = end
+            while position > 0:
+                start = max(0, position - 4096)
+                f.seek(start)
+                chunk = f.read(position - start)
+                if position == end and chunk.endswith(b'\n'):
+                    return False
+                newline = chunk.rfind(b'\n')
+                if newline >= 0:
+                    position = start + newline + 1
+                    break
+                position = start
+            if position == end:
+                return False
+            f.truncate(position)
+            return True
+    except (IOError, OSError):
+        return False
+
+
+class StatusStore(object):
+    """ A write-behind store for per-key alert status.
+
+    Changes are kept in memory and written out by flush() in a single atomic write.
+    With journal enabled, every change is also appended to `<path>.journal`, which is
+    replayed on load and folded into the snapshot once it grows past compact_entries.
+    Pending changes are flushed by close(), which runs at exit unless called before.
+
+    :param path: The snapshot file, or None to keep the status in memory only.
+    :param flush_interval: Minimum number of seconds between two flushes.
+    :param journal: Whether to append every change to a journal file.
+    :param compact_entries: Number of journal entries that triggers a compaction.
+    """
+
+    def __init__(self, path, flush_interval=0.0, journal=False, compact_entries=10000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.journal_path = path + '.journal' if path and journal else None
+        self.compact_entries = compact_entries
+        self._status = {}
+        self._dirty = set()
+        self._flush_ts = 0.0
+        self._journal_file = None
+        self._journal_entries = 0
+        self.load()
+        if self.path:
+            at_exit(self.close)
+
+    def get(self, key, default=None):
+        return self._status.get(key, default)
+
+    def set(self, key, value):
+        if self._status.get(key) == value:
+            return
+        self._status[key] = value
+        self._dirty.add(key)
+        if self.journal_path:
+            self._append_journal(key, value)
+
+    def items(self):
+        return self._status.items()
+
+    def __len__(self):
+        return len(self._status)
+
+    @property
+    def dirty(self):
+        return bool(self._dirty)
+
+    def load(self):
+        self._status = {}
+        self._dirty = set()
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'r') as jsonf:
+                self._status = json.load(jsonf)
+        except (IOError, OSError, ValueError) as e:
+            if os.path.exists(self.path):
+                elastalert_logger.error('Cannot load status %s: %s', self.path, e)
+        if self.journal_path:
+            self._replay_journal()
+
+    def flush(self, force=False):
+        """ Persist pending changes unless the last flush is less than flush_interval ago. """
+        if not self.path or not self._dirty:
+            return False
+        now = time.time()
+        if not force and now < self._flush_ts + self.flush_interval:
+            return False
+
+        if self.journal_path and not force and self._journal_entries < self.compact_entries:
+            # Every change is already in the journal, just make sure it hit the disk
+            written = self._sync_journal()
+        else:
+            written = self._write_snapshot()
+        if not written:
+            # Kept dirty for the next flush to try again
+            return False
+        self._dirty.clear()
+        self._flush_ts = now
+        return True
+
+    def close(self):
+        cancel_at_exit(self.close)
+        self.flush(force=True)
+        if self._journal_file:
+            self._journal_file.close()
+            self._journal_file = None
+
+    def _write_snapshot(self):
+        try:
+            atomic_write(self.path, lambda f: json.dump(self._status, f))
+        except (IOError, OSError) as e:
+            elastalert_logger.error('Cannot save status %s: %s', self.path, e)
+            return False
+        if self.journal_path:
+            self._truncate_journal()
+        return True
+
+    def _replay_journal(self):
+        if truncate_torn_line(self.journal_path):
+            elastalert_logger.warning('Dropped a torn last line of journal %s', self.journal_path)
+        try:
+            with open(self.journal_path, 'r') as journal:
+                for line in journal:
+                    try:
+                        key, value = json.loads(line)
+                    except ValueError:
+                        # Written onto a torn line before torn lines were cut on load
+                        elastalert_logger.warning('Skipping a bad line of journal %s', self.journal_path)
+                        continue
+                    self._status[key] = value
+                    self._journal_entries += 1
+        except (IOError, OSError):
+            pass
+
+    def _append_journal(self, key, value):
+        try:
+            if self._journal_file is None:
+                self._journal_file = open(self.journal_path, 'a')
+            self._journal_file.write(json.dumps([key, value]) + '\n')
+            self._journal_entries += 1
+        except (IOError, OSError) as e:
+            elastalert_logger.error('Cannot append to journal %s: %s', self.journal_path, e)
+
+    def _sync_journal(self):
+        if self._journal_file is None:
+            return True
+        try:
+            self._journal_file.flush()
+            os.fsync(self._journal_file.fileno())
+        except (IOError, OSError) as e:
+            elastalert_logger.error('Cannot sync journal %s: %s', self.journal_path, e)
+            return False
+        return True
+
+    def _truncate_journal(self):
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+        try:
+            open(self.journal_path, 'w').close()
+        except (IOError, OSError) as e:
+            elastalert_logger.error('Cannot truncate journal %s: %s', self.journal_path, e)
+        self._journal_entries = 0
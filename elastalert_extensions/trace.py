@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from elastalert.util import elastalert_logger
+
+
+class _Fields(object):
+    """ Formats trace fields only if a handler actually emits the record. """
+    __slots__ = ('fields',)
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join('%s=%r' % (name, self.fields[name]) for name in sorted(self.fields))
+
+
+class Tracer(object):
+    """ Structured tracing of per-key rule decisions.
+
+    Tracing is off unless the logger is enabled for level, which is only looked up by
+    refresh(), so a disabled tracer costs one attribute test per call site. With keys,
+    only those query keys are traced, and with sample, only one in sample of their
+    trace points is logged. Fields are formatted lazily.
+
+    :param name: The rule name, included in every record.
+    :param keys: The query keys to trace, or None for all of them.
+    :param sample: Log one in sample trace points.
+    :param level: The logging level of the records.
+    """
+
+    def __init__(self, name, keys=None, sample=1, level=logging.DEBUG, logger=elastalert_logger):
+        self.name = name
+        self.keys = frozenset(keys) if keys else None
+        self.sample = max(1, int(sample))
+        self.level = logging.getLevelName(level) if not isinstance(level, int) else level
+        self.logger = logger
+        self.active = False
+        self._seen = 0
+        self.refresh()
+
+    @classmethod
+    def from_rules(cls, rules):
+        return cls(rules.get('name', ''),
+                   keys=rules.get('trace_keys'),
+                   sample=rules.get('trace_sample', 1),
+                   level=rules.get('trace_level', logging.DEBUG))
+
+    def refresh(self):
+        """ Look up whether the logger is enabled for our level, call once per batch. """
+        self.active = self.logger.isEnabledFor(self.level)
+        return self.active
+
+    def wants(self, key):
+        """ Whether the next trace point of key should be logged. """
+        if not self.active or (self.keys is not None and key not in self.keys):
+            return False
+        self._seen += 1
+        return self._seen % self.sample == 0
+
+    def trace(self, key, point, **fields):
+        self.logger.log(self.level, '[%s] %s key=%r %s', self.name, point, key, _Fields(fields))
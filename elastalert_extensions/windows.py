@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+from array import array
+from bisect import bisect_right
+from datetime import datetime
+from datetime import timedelta
+
+from dateutil.tz import tzutc
+from elastalert.ruletypes import EventWindow
+from elastalert.util import new_get_event_ts
+
+
+EPOCH = datetime(1970, 1, 1)
+EPOCH_UTC = datetime(1970, 1, 1, tzinfo=tzutc())
+
+
+def td_to_us(td):
+    return (td.days * 86400 + td.seconds) * 1000000 + td.microseconds
+
+
+def dt_to_us(dt):
+    """ Convert a datetime to microseconds since the epoch, naive datetimes are taken as UTC. """
+    return td_to_us(dt - (EPOCH if dt.tzinfo is None else EPOCH_UTC))
+
+
+def us_to_dt(us, tzinfo=None):
+    """ Convert microseconds since the epoch back to a datetime in tzinfo. """
+    if tzinfo is None:
+        return EPOCH + timedelta(microseconds=us)
+    return (EPOCH_UTC + timedelta(microseconds=us)).astimezone(tzinfo)
+
+
+class DocumentWindow(EventWindow):
+    """ elastalert's EventWindow, keeping every (document, count) pair.
+
+    This and CountWindow share the interface used by the profiled rules.
+    """
+
+    def __init__(self, timeframe, ts_field, keep_events=True):
+        super(DocumentWindow, self).__init__(timeframe, getTimestamp=new_get_event_ts(ts_field))
+        self.ts_field = ts_field
+
+    def add(self, ts, count, event=None, us=None):
+        if event is None:
+            event = {self.ts_field: ts}
+        self.append((event, count))
+
+    def __len__(self):
+        return len(self.data)
+
+    def last_event(self):
+        return self.data[-1][0]
+
+    def last_ts(self):
+        return self.get_ts(self.data[-1])
+
+    def first_ts(self):
+        return self.get_ts(self.data[0])
+
+    def related_events(self):
+        return [data[0] for data in self.data[:-1]]
+
+    def ts_reaching(self, count):
+        """ Timestamp of the newest event such that it and the events after it add up to count. """
+        total = 0
+        data = self.data
+        for idx in range(len(data) - 1, -1, -1):
+            total += data[idx][1]
+            if total >= count:
+                return self.get_ts(data[idx])
+        return None
+
+    def entries(self):
+        """ The timestamps, in microseconds since the epoch, and counts in the window. """
+        return (array('d', [dt_to_us(self.get_ts(data)) for data in self.data]),
+                array('d', [data[1] for data in self.data]))
+
+    def restore(self, timestamps, counts, last_ts, last_event=None):
+        """ Refill an empty window from entries(), the documents are not restored. """
+        tzinfo = last_ts.tzinfo
+        for us, count in zip(timestamps[:-1], counts[:-1]):
+            self.add(us_to_dt(us, tzinfo), count)
+        if timestamps:
+            self.add(last_ts, counts[-1], last_event)
+
+
+class CountWindow(object):
+    """ A sliding window keeping parallel arrays of timestamps and counts.
+
+    Timestamps are stored as microseconds since the epoch in doubles, which is exact
+    for any realistic date, and count() is a running sum. Only the newest document is
+    kept, unless keep_events is set for rules that attach related events.
+    """
+    __slots__ = ('timeframe', 'ts_field', 'keep_events', 'running_count', 'timestamps', 'counts',
+                 'events', 'tzinfo', '_timeframe_us', '_last_event', '_last_ts')
+
+    def __init__(self, timeframe, ts_field, keep_events=False):
+        self.timeframe = timeframe
+        self.ts_field = ts_field
+        self.keep_events = keep_events
+        self.running_count = 0
+        self.timestamps = array('d')
+        self.counts = array('d')
+        self.events = [] if keep_events else None
+        self.tzinfo = None
+        self._timeframe_us = td_to_us(timeframe)
+        self._last_event = None
+        self._last_ts = None
+
+    def add(self, ts, count, event=None, us=None):
+        """ Add count events at ts, then drop the events more than timeframe older than the newest.
+        us is ts in microseconds since the epoch, if the caller already converted it. """
+        if us is None:
+            us = dt_to_us(ts)
+        timestamps = self.timestamps
+        self.tzinfo = ts.tzinfo
+        if not timestamps or us >= timestamps[-1]:
+            timestamps.append(us)
+            self.counts.append(count)
+            if self.keep_events:
+                self.events.append(event)
+            self._last_event = event
+            self._last_ts = ts
+        else:
+            idx = bisect_right(timestamps, us)
+            timestamps.insert(idx, us)
+            self.counts.insert(idx, count)
+            if self.keep_events:
+                self.events.insert(idx, event)
+        self.running_count += count
+
+        cut = bisect_right(timestamps, timestamps[-1] - self._timeframe_us)
+        if cut:
+            self.running_count -= sum(self.counts[:cut])
+            del timestamps[:cut]
+            del self.counts[:cut]
+            if self.keep_events:
+                del self.events[:cut]
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def count(self):
+        return int(self.running_count)
+
+    def _event(self, event, us):
+        if event is None:
+            return {self.ts_field: us_to_dt(us, self.tzinfo)}
+        return event
+
+    def last_event(self):
+        if self._last_event is None:
+            return {self.ts_field: self._last_ts}
+        return self._last_event
+
+    def last_ts(self):
+        return self._last_ts
+
+    def first_ts(self):
+        return us_to_dt(self.timestamps[0], self.tzinfo)
+
+    def related_events(self):
+        if not self.keep_events:
+            return []
+        return [self._event(event, us) for event, us in zip(self.events[:-1], self.timestamps[:-1])]
+
+    def ts_reaching(self, count):
+        """ Timestamp of the newest event such that it and the events after it add up to count. """
+        total = 0
+        counts = self.counts
+        for idx in range(len(counts) - 1, -1, -1):
+            total += counts[idx]
+            if total >= count:
+                return us_to_dt(self.timestamps[idx], self.tzinfo)
+        return None
+
+    def entries(self):
+        """ The timestamps, in microseconds since the epoch, and counts in the window. """
+        return self.timestamps, self.counts
+
+    def restore(self, timestamps, counts, last_ts, last_event=None):
+        """ Refill an empty window from entries(), the documents are not restored. """
+        self.timestamps = array('d', timestamps)
+        self.counts = array('d', counts)
+        self.running_count = sum(self.counts)
+        if self.keep_events:
+            self.events = [None] * (len(self.timestamps) - 1) + [last_event]
+        self.tzinfo = last_ts.tzinfo
+        self._last_event = last_event
+        self._last_ts = last_ts
+
+
+class BucketWindow(object):
+    """ A sliding window of per-interval counts kept in a ring buffer.
+
+    The ring has enough buckets to cover timeframe, the count is maintained incrementally
+    as buckets enter and leave it. Events are only placed to the interval, so a bucket
+    leaves the window once the newest bucket is timeframe (rounded up to whole buckets)
+    past it. Related events are not kept.
+    """
+    __slots__ = ('timeframe', 'ts_field', 'interval', 'running_count', 'buckets', 'head', 'tzinfo',
+                 '_interval_us', '_timeframe_us', '_last_event', '_last_ts')
+
+    def __init__(self, timeframe, ts_field, keep_events=False, interval=timedelta(minutes=1)):
+        self.timeframe = timeframe
+        self.ts_field = ts_field
+        self.interval = interval
+        self.running_count = 0
+        self._interval_us = td_to_us(interval)
+        self._timeframe_us = td_to_us(timeframe)
+        size = max(1, -(-self._timeframe_us // self._interval_us))
+        self.buckets = array('d', [0.0]) * size
+        self.head = None
+        self.tzinfo = None
+        self._last_event = None
+        self._last_ts = None
+
+    def add(self, ts, count, event=None, us=None):
+        bucket = (dt_to_us(ts) if us is None else us) // self._interval_us
+        buckets = self.buckets
+        size = len(buckets)
+        self.tzinfo = ts.tzinfo
+        if self.head is None:
+            self.head = bucket
+        if bucket > self.head:
+            self._advance(bucket)
+        if self._last_ts is None or ts >= self._last_ts:
+            self._last_event = event
+            self._last_ts = ts
+        if bucket > self.head - size:
+            buckets[bucket % size] += count
+            self.running_count += count
+
+    def _advance(self, bucket):
+        buckets = self.buckets
+        size = len(buckets)
+        if bucket - self.head >= size:
+            for idx in range(size):
+                buckets[idx] = 0.0
+            self.running_count = 0
+        else:
+            for b in range(self.head + 1, bucket + 1):
+                idx = b % size
+                self.running_count -= buckets[idx]
+                buckets[idx] = 0.0
+        self.head = bucket
+
+    def __len__(self):
+        return sum(1 for count in self.buckets if count)
+
+    def count(self):
+        return int(self.running_count)
+
+    def last_event(self):
+        if self._last_event is None:
+            return {self.ts_field: self._last_ts}
+        return self._last_event
+
+    def last_ts(self):
+        return self._last_ts
+
+    def first_ts(self):
+        """ The start of the oldest bucket in the window. """
+        return us_to_dt((self.head - len(self.buckets) + 1) * self._interval_us, self.tzinfo)
+
+    def related_events(self):
+        return []
+
+    def ts_reaching(self, count):
+        """ The time such that adding timeframe gives when the newest buckets adding
+        up to count start to leave the window. """
+        total = 0
+        buckets = self.buckets
+        size = len(buckets)
+        for bucket in range(self.head, self.head - size, -1):
+            total += buckets[bucket % size]
+            if total >= count:
+                return us_to_dt((bucket + size) * self._interval_us - self._timeframe_us, self.tzinfo)
+        return None
+
+    def entries(self):
+        """ The start times, in microseconds since the epoch, and counts of the buckets. """
+        timestamps = array('d')
+        counts = array('d')
+        if self.head is not None:
+            size = len(self.buckets)
+            for bucket in range(self.head - size + 1, self.head + 1):
+                count = self.buckets[bucket % size]
+                if count:
+                    timestamps.append(bucket * self._interval_us)
+                    counts.append(count)
+        return timestamps, counts
+
+    def restore(self, timestamps, counts, last_ts, last_event=None):
+        """ Refill an empty window from entries(). """
+        tzinfo = last_ts.tzinfo
+        for us, count in zip(timestamps, counts):
+            self.add(us_to_dt(us, tzinfo), count)
+        self.add(last_ts, 0, last_event)
+
+
+WINDOW_TYPES = {
+    'events': DocumentWindow,
+    'compact': CountWindow,
+    'buckets': BucketWindow,
+}
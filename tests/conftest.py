@@ -6,6 +6,7 @@ import time
 import pytest
 
 from elastalert_extensions import ruletypes
+from elastalert_extensions import shared
 
 
 @pytest.fixture
@@ -34,3 +35,11 @@ def mock_ruletypes_open(monkeypatch):
     mocker = MagicMock(name='open')
     monkeypatch.setattr(ruletypes, 'open', mocker, raising=False)
     return mocker
+
+
+@pytest.fixture(autouse=True)
+def clear_shared():
+    # The rules of a test do not share values with those of the next one
+    yield
+    shared.BLACKLISTS.clear()
+    shared.PROFILES.clear()
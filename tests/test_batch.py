@@ -0,0 +1,21 @@
+from elastalert_extensions import batch
+
+
+def test_columnarize_terms():
+    terms = {1: [{'key': 'device1', 'doc_count': 3}, {'key': 'device2', 'doc_count': 0}]}
+    columns = batch.columnarize_terms(terms)
+
+    assert columns.keys == ['device1', 'device2']
+    assert columns.key_index == [0, 1]
+    assert columns.timestamps == [1, 1]
+    assert columns.counts == [3, 0]
+
+
+def test_repeated(monkeypatch):
+    columns = batch.TermsBatch(['device1', 'device2', 'device3'], [0, 1, 0, 2], [1, 1, 2, 2], [1, 1, 1, 1])
+    assert columns.repeated() == [0, 2]
+
+    monkeypatch.setattr(batch, 'numpy', None)
+    assert columns.repeated() == [0, 2]
+    assert batch.at_least([1, 5, 3], 3) == [1, 2]
+    assert batch.at_least_mask([1, 5, 3], 3) == [False, True, True]
@@ -0,0 +1,48 @@
+from elastalert_extensions.blacklist import BlacklistMatcher
+
+
+def test_exact_entries():
+    matcher = BlacklistMatcher(['offline', 'fault*', 42])
+
+    assert 'offline' in matcher
+    assert 42 in matcher
+    assert 'fault*' in matcher
+    assert 'fault1' not in matcher
+    assert None not in matcher
+
+
+def test_wildcards():
+    matcher = BlacklistMatcher(['offline', 'fault*', 'err?r', '*timeout*'], wildcards=True)
+
+    assert 'offline' in matcher
+    assert 'fault' in matcher
+    assert 'fault.inverter' in matcher
+    assert 'faul' not in matcher
+    assert 'error' in matcher
+    assert 'errors' not in matcher
+    assert 'gateway timeout' in matcher
+    assert 'online' not in matcher
+    assert 1 not in matcher
+
+
+def test_file_entries_reloaded_on_change(tmpdir, mock_time):
+    blacklist = tmpdir.join('blacklist.txt')
+    blacklist.write('offline\nfault\n')
+    mock_time.return_value = 1514764800.0
+    matcher = BlacklistMatcher(['!file %s' % blacklist, 'error'])
+    assert 'fault' in matcher
+    assert 'error' in matcher
+
+    mock_time.return_value += 10.0
+    blacklist.write('offline\n')
+    blacklist.setmtime(blacklist.mtime() + 10)
+    assert not matcher.refresh()
+    assert 'fault' in matcher
+
+    mock_time.return_value += 60.0
+    assert matcher.refresh()
+    assert 'fault' not in matcher
+    assert 'offline' in matcher
+
+    mock_time.return_value += 60.0
+    assert not matcher.refresh()
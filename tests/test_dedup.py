@@ -0,0 +1,60 @@
+from elastalert_extensions.dedup import AlertLimiter
+from elastalert_extensions.dedup import SketchLimiter
+from elastalert_extensions.dedup import TokenBuckets
+
+
+def test_token_buckets_refill():
+    buckets = TokenBuckets(2, 60.0)
+    assert [buckets.admit('device1', 0.0) for _ in range(3)] == [True, True, False]
+    assert buckets.admit('device2', 0.0)
+    # One token back every 30 seconds
+    assert not buckets.admit('device1', 20.0)
+    assert buckets.admit('device1', 35.0)
+    assert not buckets.admit('device1', 36.0)
+
+
+def test_token_buckets_bounded():
+    buckets = TokenBuckets(1, 60.0, max_keys=3)
+    for n in range(10):
+        assert buckets.admit('device%d' % n, 0.0)
+    assert len(buckets) == 3
+    assert not buckets.admit('device9', 1.0)
+    # Full again, dropped
+    assert buckets.admit('device0', 1.0)
+    assert buckets.admit('device1', 120.0)
+    assert len(buckets) == 1
+
+
+def test_sketch_sliding_window():
+    sketch = SketchLimiter(2, 60.0, width=64, depth=3)
+    assert [sketch.admit(('device1', 'above'), 0.0) for _ in range(3)] == [True, True, False]
+    assert sketch.admit(('device2', 'above'), 0.0)
+    # Most of the previous period still counts
+    assert sketch.admit(('device1', 'above'), 61.0)
+    assert not sketch.admit(('device1', 'above'), 62.0)
+    assert sketch.admit(('device1', 'above'), 110.0)
+    # Nothing left of it two periods later
+    assert sketch.admit(('device1', 'above'), 300.0)
+    assert len(sketch) == 192
+
+
+def test_limiter_digest():
+    limiter = AlertLimiter(['device', 'status'], 1, 60.0)
+    matches = [{'@timestamp': 't%d' % n, 'device': 'device%d' % (n % 2), 'status': 'above'} for n in range(5)]
+
+    assert limiter.filter(matches, 0.0) == matches[:2]
+    assert limiter.pop_digest() == {
+        'suppressed': 3,
+        'other': 0,
+        'keys': [{'device': 'device0', 'status': 'above', 'count': 2, 'first': 't2', 'last': 't4'},
+                 {'device': 'device1', 'status': 'above', 'count': 1, 'first': 't3', 'last': 't3'}],
+    }
+    assert limiter.pop_digest() is None
+    assert limiter.stats == {'admitted': 2, 'suppressed': 3, 'digests': 1}
+
+
+def test_limiter_digest_bounded():
+    limiter = AlertLimiter(['device'], 1, 60.0, sketch=True, digest_keys=2)
+    limiter.filter([{'device': 'device%d' % n} for n in range(5)] * 2, 0.0)
+    digest = limiter.pop_digest()
+    assert (digest['suppressed'], len(digest['keys']), digest['other']) == (5, 2, 3)
@@ -0,0 +1,145 @@
+import threading
+
+from mock import MagicMock
+import pytest
+
+from elastalert_extensions.dispatch import Dispatcher
+
+
+class FakePublisher(object):
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.published = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.heartbeat_check = MagicMock()
+
+    def publish(self, bodies):
+        self.gate.wait()
+        if self.failures:
+            self.failures -= 1
+            raise IOError('broker down')
+        self.published.append(bodies)
+
+
+def test_publishes_in_order():
+    publisher = FakePublisher()
+    dispatcher = Dispatcher(publisher)
+    dispatcher.start()
+    for n in range(5):
+        dispatcher.put([{'n': n}])
+    dispatcher.stop()
+
+    assert publisher.published == [[{'n': n}] for n in range(5)]
+    metrics = dispatcher.metrics()
+    assert metrics['enqueued'] == metrics['published'] == 5
+    assert metrics['depth'] == 0
+
+
+def test_drop_oldest():
+    publisher = FakePublisher()
+    dispatcher = Dispatcher(publisher, maxsize=2, backpressure='drop_oldest')
+    for n in range(5):
+        dispatcher.put([{'n': n}])
+    dispatcher.start()
+    dispatcher.stop()
+
+    assert publisher.published == [[{'n': 3}], [{'n': 4}]]
+    assert dispatcher.metrics()['dropped'] == 3
+
+
+def test_block_waits_for_worker():
+    publisher = FakePublisher()
+    publisher.gate.clear()
+    dispatcher = Dispatcher(publisher, maxsize=1)
+    dispatcher.start()
+    dispatcher.put([{'n': 0}])
+    dispatcher.put([{'n': 1}])
+    putter = threading.Thread(target=dispatcher.put, args=([{'n': 2}],))
+    putter.start()
+    putter.join(0.1)
+    assert putter.is_alive()
+
+    publisher.gate.set()
+    putter.join(1)
+    dispatcher.stop()
+    assert publisher.published == [[{'n': n}] for n in range(3)]
+
+
+def test_retry_with_backoff(monkeypatch):
+    publisher = FakePublisher(failures=2)
+    dispatcher = Dispatcher(publisher, backoff=0.01)
+    dispatcher.start()
+    dispatcher.put([{'n': 0}])
+    dispatcher.stop()
+
+    assert publisher.published == [[{'n': 0}]]
+    assert dispatcher.metrics()['retries'] == 2
+
+
+def test_give_up_after_max_retries():
+    publisher = FakePublisher(failures=3)
+    dispatcher = Dispatcher(publisher, max_retries=2, backoff=0.01)
+    dispatcher.start()
+    dispatcher.put([{'n': 0}])
+    dispatcher.put([{'n': 1}])
+    dispatcher.stop()
+
+    assert publisher.published == [[{'n': 1}]]
+    assert dispatcher.metrics()['failed'] == 1
+
+
+def test_spill_and_replay(tmpdir):
+    spill_path = str(tmpdir.join('spill'))
+    publisher = FakePublisher()
+    dispatcher = Dispatcher(publisher, maxsize=1, backpressure='spill', spill_path=spill_path)
+    for n in range(4):
+        dispatcher.put([{'n': n}])
+    assert dispatcher.metrics()['spilled'] == 3
+    # Not started, so the queue is spilled too
+    dispatcher.stop(0)
+    assert not publisher.published
+
+    # The next process picks up the spill file
+    dispatcher = Dispatcher(publisher, maxsize=1, backpressure='spill', spill_path=spill_path)
+    dispatcher.start()
+    dispatcher.put([{'n': 4}])
+    dispatcher.stop()
+
+    assert publisher.published == [[{'n': n}] for n in range(5)]
+    assert not tmpdir.listdir()
+
+
+def test_batch_in_flight_spilled_on_stop(tmpdir):
+    spill_path = str(tmpdir.join('spill'))
+    publisher = FakePublisher()
+    publisher.gate.clear()
+    dispatcher = Dispatcher(publisher, spill_path=spill_path, idle_interval=0.01)
+    dispatcher.start()
+    dispatcher.put([{'n': 0}])
+    dispatcher.put([{'n': 1}])
+    # Stuck publishing the first batch
+    dispatcher.stop(0.05)
+    publisher.gate.set()
+    dispatcher.join()
+
+    replayed = FakePublisher()
+    dispatcher = Dispatcher(replayed, spill_path=spill_path)
+    dispatcher.start()
+    dispatcher.stop()
+    assert replayed.published == [[{'n': 0}], [{'n': 1}]]
+
+
+def test_heartbeats_while_idle():
+    publisher = FakePublisher()
+    dispatcher = Dispatcher(publisher, idle_interval=0.01)
+    dispatcher.start()
+    threading.Event().wait(0.1)
+    dispatcher.stop()
+
+    assert publisher.heartbeat_check.called
+
+
+def test_spill_requires_path():
+    with pytest.raises(Exception):
+        Dispatcher(FakePublisher(), backpressure='spill')
@@ -0,0 +1,34 @@
+from elastalert_extensions.expiry import ExpiryIndex
+
+
+def test_expired_in_deadline_order():
+    index = ExpiryIndex()
+    index.schedule('device1', 30)
+    index.schedule('device2', 10)
+    index.schedule('device3', 20)
+
+    assert index.expired(20) == ['device2', 'device3']
+    assert index.expired(25) == []
+    assert index.expired(30) == ['device1']
+    assert len(index) == 0
+
+
+def test_postponed_deadline():
+    index = ExpiryIndex()
+    index.schedule('device1', 10)
+    index.schedule('device1', 40)
+
+    assert index.expired(20) == []
+    assert 'device1' in index
+    assert index.expired(40) == ['device1']
+
+
+def test_schedule_now_and_discard():
+    index = ExpiryIndex()
+    index.schedule('device1', 100)
+    index.schedule('device2', 100)
+    index.schedule_now('device1')
+    index.discard('device2')
+
+    assert index.expired(0) == ['device1']
+    assert index.expired(100) == []
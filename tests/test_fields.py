@@ -0,0 +1,40 @@
+from elastalert.util import lookup_es_key
+import pytest
+
+from elastalert_extensions.fields import field_getter
+from elastalert_extensions.fields import fields_getter
+
+
+DOCS = [
+    {},
+    {'device': 'inverter1'},
+    {'a': {'b': {'c': 1}}},
+    {'a.b.c': 2, 'a': {'b': {'c': 1}}},
+    {'a.b': {'c': 3}},
+    {'a': {'b.c': 4}},
+    {'a': {'b': {}}},
+    {'a': {'b': 'bc'}},
+    {'a': ['b', 'c']},
+    {'a': None},
+]
+
+
+@pytest.mark.parametrize('doc', DOCS)
+@pytest.mark.parametrize('term', ['device', 'a', 'a.b', 'a.b.c', 'a.c'])
+def test_same_as_lookup_es_key(doc, term):
+    def outcome(get):
+        try:
+            return get(doc, term)
+        except TypeError as e:
+            # lookup_es_key cannot index into lists and strings either
+            return type(e)
+
+    assert outcome(lambda doc, term: field_getter(term)(doc)) == outcome(lookup_es_key)
+
+
+def test_fields_getter():
+    doc = {'device': 'inverter1', 'status': {'code': 3, 'text': 'fault'}}
+
+    assert fields_getter(['device'])(doc) == ('inverter1',)
+    assert fields_getter(['device', 'status.code'])(doc) == ('inverter1', 3)
+    assert fields_getter(['status.code', 'status.text', 'site'])(doc) == (3, 'fault', None)
@@ -0,0 +1,35 @@
+from mock import MagicMock
+
+from elastalert_extensions import lifecycle
+
+
+def test_replace_closes_objects_of_previous_rules():
+    rules = {'name': 'test_replace_closes_objects_of_previous_rules'}
+    first, second = MagicMock(), MagicMock()
+    lifecycle.replace('alerter', rules, first)
+    lifecycle.replace('alerter', rules, second)
+    lifecycle.replace('alerter', rules, second)
+    assert not first.close.called and not second.close.called
+
+    reloaded = MagicMock()
+    assert lifecycle.replace('alerter', dict(rules), reloaded)
+    assert first.close.call_count == second.close.call_count == 1
+    assert not reloaded.close.called
+
+
+def test_replace_skips_unnamed_rules():
+    first = MagicMock()
+    lifecycle.replace('alerter', {}, first)
+    lifecycle.replace('alerter', {}, MagicMock())
+    assert not first.close.called
+
+
+def test_exit_hooks_cancelled():
+    hook, cancelled = MagicMock(), MagicMock()
+    lifecycle.at_exit(hook)
+    lifecycle.at_exit(cancelled)
+    lifecycle.cancel_at_exit(cancelled)
+    lifecycle.run_exit_hooks()
+
+    hook.assert_called_once_with()
+    assert not cancelled.called
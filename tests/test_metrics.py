@@ -0,0 +1,123 @@
+from datetime import datetime, timedelta
+import gc
+import json
+import urllib2
+
+from dateutil.tz import tzutc
+
+from elastalert_extensions import ruletypes
+from elastalert_extensions.metrics import Histogram
+from elastalert_extensions.metrics import MetricsDumper
+from elastalert_extensions.metrics import MetricsServer
+from elastalert_extensions.metrics import REGISTRY
+from elastalert_extensions.metrics import Registry
+from tests.test_publisher import broker, drain, make_alerter  # noqa: F401
+
+
+T0 = datetime(2018, 1, 1, tzinfo=tzutc())
+
+
+class Thing(object):
+    def work(self, x):
+        return x * 2
+
+
+def test_histogram():
+    histogram = Histogram((1.0, 2.0))
+    for value in (0.5, 1.0, 1.5, 3.0):
+        histogram.observe(value)
+    assert histogram.cumulative() == [(1.0, 2), (2.0, 3), (float('inf'), 4)]
+    assert histogram.count == 4
+    assert histogram.sum == 6.0
+
+
+def test_instrument_and_prometheus():
+    registry = Registry()
+    thing = Thing()
+    registry.instrument(thing, ['work', 'missing'], 'thing_seconds', {'name': 'a"b'})
+    assert thing.work(2) == 4
+    registry.register(thing, lambda thing: [('thing_size', {'name': 'a'}, 3)])
+
+    text = registry.to_prometheus()
+    assert '# TYPE thing_seconds histogram\n' in text
+    assert 'thing_seconds_bucket{method="work",name="a\\"b",le="+Inf"} 1\n' in text
+    assert 'thing_seconds_count{method="work",name="a\\"b"} 1\n' in text
+    assert text.endswith('# TYPE thing_size gauge\nthing_size{name="a"} 3\n')
+
+
+def test_collectors_dropped_with_their_object():
+    registry = Registry()
+    thing = Thing()
+    registry.register(thing, lambda thing: [('thing_size', {}, 1)])
+    assert len(registry.gauges()) == 1
+    del thing
+    gc.collect()
+    assert registry.gauges() == []
+
+
+def test_rule_not_instrumented_by_default():
+    rule = ruletypes.ProfiledThresholdRule({
+        'threshold': 1,
+        'timeframe': timedelta(minutes=10),
+        'timestamp_field': '@timestamp',
+    })
+    assert 'check_for_match' not in vars(rule)
+
+
+def test_rule_metrics(tmpdir):
+    profile = tmpdir.join('profile.json')
+    profile.write(json.dumps({'device0': 60}))
+    rule = ruletypes.ProfiledThresholdRule({
+        'name': 'test_rule_metrics',
+        'threshold': 1,
+        'timeframe': timedelta(minutes=10),
+        'query_key': 'device',
+        'timestamp_field': '@timestamp',
+        'profile': str(profile),
+        'metrics': True,
+    })
+    rule.add_terms_data({T0: [{'key': 'device%d' % i, 'doc_count': i + 1} for i in range(3)]})
+    rule.garbage_collect(T0 + timedelta(minutes=1))
+
+    metrics = REGISTRY.to_json()
+    calls = dict((h['labels']['method'], h['count']) for h in metrics['histograms']
+                 if h['labels'].get('rule') == 'test_rule_metrics' and h['name'] == 'elastalert_rule_call_seconds')
+    assert calls == {'add_data': 0, 'add_terms_data': 1, 'add_count_data': 0,
+                     'check_for_match': 6, 'garbage_collect': 1}
+    assert [h['count'] for h in metrics['histograms']
+            if h['labels'].get('rule') == 'test_rule_metrics' and h['name'] == 'elastalert_profile_reload_seconds'] == [1]
+    gauges = dict((g['name'], g['value']) for g in metrics['gauges']
+                  if g['labels'].get('rule') == 'test_rule_metrics')
+    assert gauges == {'elastalert_rule_tracked_keys': 3,
+                      'elastalert_rule_window_entries': 5,
+                      'elastalert_rule_window_entries_max': 2}
+
+
+def test_amqp_publish_metrics(broker):  # noqa: F811
+    alerter = make_alerter(name='test_amqp_publish_metrics', metrics=True)
+    alerter.alert([{'n': 1}, {'n': 2}])
+    assert len(drain(broker[1])) == 2
+    assert [h['count'] for h in REGISTRY.to_json()['histograms']
+            if h['labels'].get('rule') == 'test_amqp_publish_metrics'] == [1]
+
+
+def test_dumper(tmpdir):
+    registry = Registry()
+    registry.histogram('thing_seconds', {}).observe(0.2)
+    path = tmpdir.join('metrics.json')
+    MetricsDumper(str(path), registry=registry).dump()
+    histogram, = json.loads(path.read())['histograms']
+    assert histogram['count'] == 1
+    assert histogram['buckets'][-1] == [None, 1]
+
+
+def test_server():
+    registry = Registry()
+    registry.histogram('thing_seconds', {}).observe(0.2)
+    server = MetricsServer(0, host='127.0.0.1', registry=registry)
+    server.start()
+    try:
+        response = urllib2.urlopen('http://127.0.0.1:%d/metrics' % server.server.server_address[1])
+        assert response.read() == registry.to_prometheus()
+    finally:
+        server.stop()
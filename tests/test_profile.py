@@ -0,0 +1,148 @@
+from datetime import datetime, timedelta
+import json
+
+from dateutil.tz import tzutc
+from elastalert.util import EAException
+from mock import MagicMock
+import pytest
+
+from elastalert_extensions import ruletypes
+from elastalert_extensions.profile import BinaryProfile
+from elastalert_extensions.profile import changed_keys
+from elastalert_extensions.profile import Limits
+from elastalert_extensions.profile import load_profile_lines
+from elastalert_extensions.profile import Profile
+from elastalert_extensions.profile import write_binary_profile
+
+
+T0 = datetime(2018, 1, 1, tzinfo=tzutc())
+EXTENDED = {
+    'default': {'threshold': 3},
+    'groups': {'rooftop': {'timeframe': 1800, 'num_events': 20}},
+    'keys': {
+        'device1': 660,
+        'device2': {'group': 'rooftop', 'threshold': 5},
+        'device3': {'group': 'rooftop', 'timeframe': 60},
+    },
+}
+LINES = [
+    {'default': {'threshold': 3}},
+    {'group': 'rooftop', 'timeframe': 1800, 'num_events': 20},
+    {'key': 'device1', 'timeframe': 660},
+    {'key': 'device2', 'group': 'rooftop', 'threshold': 5},
+    {'key': 'device3', 'group': 'rooftop', 'timeframe': 60},
+]
+EXPECTED = {
+    'device0': Limits(None, 3, None),
+    'device1': Limits(timedelta(seconds=660), 3, None),
+    'device2': Limits(timedelta(seconds=1800), 5, 20),
+    'device3': Limits(timedelta(seconds=60), 3, 20),
+}
+
+
+def assert_limits(profile):
+    assert dict((key, profile.limits(key)) for key in EXPECTED) == EXPECTED
+    assert profile.timeframes.get('device0', 'rule') == 'rule'
+    assert profile.thresholds.get('device2') == 5
+    assert profile.num_events.get('device1') is None
+
+
+def test_extended_json():
+    profile = Profile.from_json(EXTENDED)
+    assert_limits(profile)
+    # Equal limits are shared
+    assert profile.limits('device1').timeframe is not None
+    assert profile.limits('device2').num_events is profile.limits('device3').num_events
+
+
+def test_json_lines(tmpdir):
+    path = tmpdir.join('profile.jsonl')
+    path.write('\n'.join(json.dumps(line) for line in LINES) + '\n\n')
+    assert_limits(load_profile_lines(str(path)))
+
+
+@pytest.mark.parametrize('profile, error', [
+    ({'keys': {'device1': {'group': 'missing'}}}, EAException),
+    ({'keys': {'device1': {'timefrmae': 60}}}, EAException),
+])
+def test_invalid_profile(profile, error):
+    with pytest.raises(error):
+        Profile.from_json(profile)
+
+
+def test_binary_profile(tmpdir):
+    path = str(tmpdir.join('profile.bin'))
+    write_binary_profile(path, Profile.from_json(EXTENDED))
+    profile = BinaryProfile(path)
+    assert len(profile) == 3
+    assert_limits(profile)
+    assert profile.limits(u'device2') == EXPECTED['device2']
+    assert profile.limits(('device', 1)) == profile.default
+
+
+def test_not_a_binary_profile(tmpdir):
+    path = tmpdir.join('profile.bin')
+    path.write(b'NOPE' + b'\0' * 20, mode='wb')
+    with pytest.raises(ValueError):
+        BinaryProfile(str(path))
+
+
+@pytest.mark.parametrize('suffix', ['.json', '.jsonl', '.bin'])
+def test_rule_limits_per_key(tmpdir, suffix):
+    path = str(tmpdir.join('profile' + suffix))
+    if suffix == '.json':
+        with open(path, 'w') as f:
+            json.dump(EXTENDED, f)
+    elif suffix == '.jsonl':
+        with open(path, 'w') as f:
+            f.write('\n'.join(json.dumps(line) for line in LINES))
+    else:
+        write_binary_profile(path, Profile.from_json(EXTENDED))
+    rule = ruletypes.ProfiledFrequencyRule({
+        'num_events': 4,
+        'timeframe': timedelta(minutes=10),
+        'query_key': 'device',
+        'timestamp_field': '@timestamp',
+        'profile': path,
+        'batch_terms': True,
+    })
+    rule.add_terms_data({T0: [{'key': 'device%d' % i, 'doc_count': 10} for i in range(4)]})
+
+    assert sorted(m['device'] for m in rule.matches) == ['device0', 'device1']
+    assert rule.timeframe('device3') == timedelta(seconds=60)
+    assert rule.threshold_of('device2') == 5
+    assert rule.num_events_of('device0') == 4
+
+
+def test_reload_reschedules_changed_keys():
+    rule = ruletypes.ProfiledThresholdRule({
+        'threshold': 3,
+        'timeframe': timedelta(minutes=10),
+        'query_key': 'device',
+        'timestamp_field': '@timestamp',
+    })
+    rule.add_terms_data({T0: [{'key': 'device%d' % i, 'doc_count': 1} for i in range(3)]})
+    rule.garbage_collect(T0 + timedelta(minutes=1))
+    rule.check_for_match = MagicMock(wraps=rule.check_for_match)
+
+    rule._profile = Profile.from_json({'keys': {'device0': 600, 'device1': {'threshold': 1}}})
+    rule.garbage_collect(T0 + timedelta(minutes=2))
+    assert [args[0][0] for args in rule.check_for_match.call_args_list] == ['device1']
+    assert [(m['key'], m['status']) for m in rule.matches if m['status'] == 'above'] == [('device1', 'above')]
+
+    # Between two Profiles, only the keys they set differently are looked at
+    rule.check_for_match.reset_mock()
+    rule._limits = MagicMock(wraps=rule._limits)
+    rule._profile = Profile.from_json({'keys': {'device0': 600, 'device1': {'threshold': 2}}})
+    rule.garbage_collect(T0 + timedelta(minutes=3))
+    assert set(args[0][0] for args in rule._limits.call_args_list) == {'device1'}
+    assert [args[0][0] for args in rule.check_for_match.call_args_list] == ['device1']
+
+
+def test_changed_keys():
+    old = Profile.from_json({'keys': {'device0': 600, 'device1': 600, 'device2': {'threshold': 1}}})
+    new = Profile.from_json({'keys': {'device0': 600, 'device1': 660, 'device3': 600}})
+    assert sorted(changed_keys(old, new)) == ['device1', 'device2', 'device3']
+    assert changed_keys({'device0': 600, 'device1': 600}, {'device0': 600}) == ['device1']
+    assert changed_keys(old, Profile.from_json({'default': {'threshold': 2}, 'keys': {}})) is None
+    assert changed_keys({}, new) is None
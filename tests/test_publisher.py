@@ -0,0 +1,214 @@
+from datetime import datetime
+import json
+import time
+
+from elastalert.util import EAException
+from kombu import Connection, Exchange, Queue
+from mock import MagicMock
+import msgpack
+import pytest
+
+from elastalert_extensions.alerts import AmqpAlerter
+from elastalert_extensions.publisher import chunks, Publisher
+
+
+@pytest.fixture
+def broker():
+    conn = Connection('memory://')
+    exchange = Exchange('alert', type='fanout')
+    queue = Queue('alerts', exchange=exchange)(conn.channel())
+    queue.declare()
+    yield exchange, queue
+    conn.release()
+
+
+def drain(queue):
+    messages = []
+    while True:
+        message = queue.get(no_ack=True)
+        if message is None:
+            return messages
+        messages.append(message)
+
+
+def make_alerter(**options):
+    rule = {'name': 'rule', 'amqp_url': 'memory://', 'amqp_password': 'secret'}
+    rule.update(options)
+    return AmqpAlerter(rule)
+
+
+def test_chunks():
+    assert list(chunks([1, 2, 3, 4, 5], 2)) == [[1, 2], [3, 4], [5]]
+    assert list(chunks([], 2)) == []
+
+
+def test_alert_message_per_match(broker):
+    exchange, queue = broker
+    alerter = make_alerter(amqp_batch_size=2)
+    alerter.alert([{'n': 1}, {'n': 2}, {'n': 3}])
+
+    bodies = [json.loads(m.body) for m in drain(queue)]
+    assert bodies == [{'rule': 'rule', 'match': {'n': n}} for n in (1, 2, 3)]
+
+
+def test_alert_batched_messages(broker):
+    exchange, queue = broker
+    alerter = make_alerter(amqp_batch_mode='message', amqp_batch_size=2)
+    alerter.alert([{'n': 1}, {'n': 2}, {'n': 3}])
+
+    bodies = [json.loads(m.body) for m in drain(queue)]
+    assert bodies == [{'rule': 'rule', 'matches': [{'n': 1}, {'n': 2}]},
+                      {'rule': 'rule', 'matches': [{'n': 3}]}]
+
+
+def test_connection_kept_across_alerts(broker):
+    exchange, queue = broker
+    alerter = make_alerter()
+    alerter.alert([{'n': 1}])
+    connection = alerter._publisher.connection
+    alerter.alert([{'n': 2}])
+
+    assert alerter._publisher.connection is connection
+    assert len(drain(queue)) == 2
+
+
+def test_msgpack_serializer(broker):
+    exchange, queue = broker
+    publisher = Publisher('memory://', exchange, 'alert', serializer='msgpack')
+    publisher.publish([{'ts': datetime(2018, 1, 1)}])
+
+    message, = drain(queue)
+    assert message.content_type == 'application/x-msgpack'
+    assert msgpack.unpackb(message.body, raw=False) == {'ts': '2018-01-01T00:00:00'}
+
+
+def test_reconnect_on_connection_error(broker):
+    exchange, queue = broker
+    publisher = Publisher('memory://', exchange, 'alert')
+    producer = publisher.connect()
+    error = publisher.connection.connection_errors[0]
+    producer.publish = MagicMock(side_effect=error('gone'))
+    publisher.publish([{'n': 1}])
+
+    assert publisher._producer is not producer
+    assert [json.loads(m.body) for m in drain(queue)] == [{'n': 1}]
+
+
+def test_confirms_awaited_once_per_batch():
+    publisher = Publisher('memory://', Exchange('alert'), 'alert', confirm=True)
+    publisher._confirms = True
+    publisher._producer = producer = MagicMock()
+    publisher.connection = MagicMock(connection_errors=(), channel_errors=())
+
+    def ack(method, timeout=None):
+        publisher._on_ack(publisher._published, True)
+    producer.channel.wait.side_effect = ack
+    publisher.publish([{'n': 1}, {'n': 2}, {'n': 3}])
+
+    assert producer.publish.call_count == 3
+    assert producer.channel.wait.call_count == 1
+
+
+def test_nacked_batch_retried():
+    publisher = Publisher('memory://', Exchange('alert'), 'alert', confirm=True)
+    producer = MagicMock()
+    connections = []
+
+    def connect():
+        publisher._confirms = True
+        publisher._published = publisher._acked = 0
+        publisher._nacked = False
+        publisher._producer = producer
+        publisher.connection = MagicMock(connection_errors=(), channel_errors=())
+        connections.append(publisher.connection)
+        return producer
+    publisher.connect = connect
+    replies = [publisher._on_nack, publisher._on_ack]
+    producer.channel.wait.side_effect = lambda methods, timeout=None: replies.pop(0)(publisher._published, True)
+    publisher.publish([{'n': 1}, {'n': 2}])
+
+    assert producer.publish.call_count == 4
+    assert len(connections) == 2
+
+
+def test_alert_async(broker):
+    exchange, queue = broker
+    alerter = make_alerter(amqp_async=True)
+    alerter.alert([{'n': 1}, {'n': 2}])
+    alerter._dispatcher.stop()
+
+    assert [json.loads(m.body)['match'] for m in drain(queue)] == [{'n': 1}, {'n': 2}]
+    assert alerter.get_metrics()['published'] == 1
+
+
+def test_replaced_alerter_closed(broker):
+    exchange, queue = broker
+    previous = make_alerter(name='test_replaced_alerter_closed', amqp_async=True)
+    previous.alert([{'n': 1}])
+    # Not closed by a new alerter elastalert did not take, e.g. of a rule reusing the name
+    make_alerter(name='test_replaced_alerter_closed', amqp_async=True)
+    assert previous._dispatcher.is_alive()
+    alerter = make_alerter(name='test_replaced_alerter_closed', amqp_async=True)
+    try:
+        alerter.alert([{'n': 2}])
+        assert not previous._dispatcher.is_alive()
+        assert previous._publisher.connection is None
+        alerter._dispatcher.stop()
+        assert sorted(json.loads(m.body)['match']['n'] for m in drain(queue)) == [1, 2]
+        with pytest.raises(EAException):
+            previous._dispatcher.put([{'n': 3}])
+    finally:
+        alerter.close()
+
+
+def test_alert_rate_limited(broker, monkeypatch):
+    exchange, queue = broker
+    monkeypatch.setattr(time, 'time', MagicMock(return_value=1514764800.0))
+    alerter = make_alerter(query_key='device', amqp_rate_limit=1, amqp_rate_period=600)
+    alerter._digest_flusher.stop()
+    alerter.alert([{'device': 'device1', 'status': 'above'},
+                   {'device': 'device1', 'status': 'above'},
+                   {'device': 'device1', 'status': 'below'}])
+    alerter.alert([{'device': 'device1', 'status': 'above'}])
+    alerter.flush_digest()
+    alerter.flush_digest()
+
+    bodies = [json.loads(m.body) for m in drain(queue)]
+    assert [body['match']['status'] for body in bodies[:-1]] == ['above', 'below']
+    assert bodies[-1]['digest']['suppressed'] == 2
+    assert bodies[-1]['digest']['keys'][0]['count'] == 2
+    assert alerter.get_limiter_stats() == {'admitted': 2, 'suppressed': 2, 'digests': 1}
+
+
+def test_digest_published_under_lock(broker, monkeypatch):
+    exchange, queue = broker
+    monkeypatch.setattr(time, 'time', MagicMock(return_value=1514764800.0))
+    alerter = make_alerter(query_key='device', amqp_rate_limit=1)
+    alerter._digest_flusher.stop()
+    alerter.alert([{'device': 'device1', 'status': 'above'}] * 2)
+    publish = alerter._publisher.publish
+    locked = []
+
+    def checked_publish(bodies):
+        locked.append(alerter._publish_lock.locked())
+        publish(bodies)
+    alerter._publisher.publish = checked_publish
+    alerter.alert([{'device': 'device2', 'status': 'above'}])
+    alerter.flush_digest()
+
+    assert locked == [True, True]
+    assert len(drain(queue)) == 3
+
+
+def test_digest_sent_by_replaced_alerter(broker, monkeypatch):
+    exchange, queue = broker
+    monkeypatch.setattr(time, 'time', MagicMock(return_value=1514764800.0))
+    previous = make_alerter(name='test_digest_sent_by_replaced_alerter', query_key='device', amqp_rate_limit=1)
+    previous.alert([{'device': 'device1', 'status': 'above'}] * 2)
+    alerter = make_alerter(name='test_digest_sent_by_replaced_alerter', query_key='device', amqp_rate_limit=1)
+    alerter.alert([])
+    try:
+        assert previous._digest_flusher._stopped.is_set()
+        assert json.loads(drain(queue)[-1].body)['digest']['suppressed'] == 1
+    finally:
+        alerter.close()
@@ -1,6 +1,15 @@
-from datetime import timedelta
+from datetime import datetime, timedelta
+import gc
+import json
+import random
+
+from dateutil.tz import tzutc
+from elastalert.elastalert import ElastAlerter
+from mock import MagicMock
+import pytest
 
 from elastalert_extensions import ruletypes
+from elastalert_extensions import shared
 
 
 def test_update_profile(mock_time, mock_getmtime, mock_json_load, mock_ruletypes_open):
@@ -107,3 +116,447 @@ def test_force_reload_everyday(mock_time, mock_getmtime, mock_json_load, mock_ru
     rule.profile
     mock_getmtime.assert_called_with('/etc/profile.json')
     mock_ruletypes_open.assert_called_with('/etc/profile.json', 'r')
+
+
+def test_threshold_status_flushed_per_pass(tmpdir):
+    cache = tmpdir.join('status.json')
+    rule = ruletypes.ProfiledThresholdRule({
+        'threshold': 2,
+        'timeframe': timedelta(minutes=10),
+        'query_key': 'device',
+        'timestamp_field': '@timestamp',
+        'cache_path': str(cache),
+    })
+    t0 = datetime(2018, 1, 1, tzinfo=tzutc())
+    rule.add_data([{'@timestamp': t0 + timedelta(minutes=i), 'device': 'device1'}
+                   for i in range(3)])
+
+    assert [m['status'] for m in rule.matches] == ['above']
+    assert json.loads(cache.read()) == {'device1': 'above'}
+
+
+def test_threshold_gc_only_checks_due_keys():
+    rule = ruletypes.ProfiledThresholdRule({
+        'threshold': 1,
+        'timeframe': timedelta(minutes=10),
+        'query_key': 'device',
+        'timestamp_field': '@timestamp',
+    })
+    t0 = datetime(2018, 1, 1, tzinfo=tzutc())
+    rule.add_data([{'@timestamp': t0, 'device': 'device%d' % i} for i in range(100)])
+    rule.add_data([{'@timestamp': t0 + timedelta(minutes=5), 'device': 'device0'}])
+    rule.garbage_collect(t0 + timedelta(minutes=6))
+    assert [m['status'] for m in rule.matches].count('above') == 100
+
+    rule.check_for_match = MagicMock(wraps=rule.check_for_match)
+    rule.garbage_collect(t0 + timedelta(minutes=8))
+    assert rule.check_for_match.call_count == 0
+
+    rule.matches = []
+    rule.garbage_collect(t0 + timedelta(minutes=10))
+    assert rule.check_for_match.call_count == 99
+    assert sorted(m['key'] for m in rule.matches) == sorted('device%d' % i for i in range(1, 100))
+    assert all(m['status'] == 'below' for m in rule.matches)
+
+
+def test_threshold_match_does_not_alias_window_event():
+    rule = ruletypes.ProfiledThresholdRule({
+        'threshold': 1,
+        'timeframe': timedelta(minutes=10),
+        'query_key': 'device',
+        'timestamp_field': '@timestamp',
+    })
+    t0 = datetime(2018, 1, 1, tzinfo=tzutc())
+    rule.add_data([{'@timestamp': t0, 'device': 'device0'}])
+
+    assert rule.matches == [{'@timestamp': '2018-01-01T00:00:00Z', 'device': 'device0',
+                             'key': 'device0', 'count': 1, 'status': 'above'}]
+    assert rule.occurrences['device0'].last_event() == {'@timestamp': t0, 'device': 'device0'}
+
+
+def test_threshold_add_data_checks_every_key_once():
+    rule = ruletypes.ProfiledThresholdRule({
+        'threshold': 2,
+        'timeframe': timedelta(minutes=10),
+        'query_key': 'device',
+        'timestamp_field': '@timestamp',
+    })
+    rule.check_for_match = MagicMock(wraps=rule.check_for_match)
+    t0 = datetime(2018, 1, 1, tzinfo=tzutc())
+    devices = ['device1', 'device2', 'device1', 'device2', 'device3']
+    # Any iterable, consumed as it goes
+    rule.add_data({'@timestamp': t0 + timedelta(seconds=i), 'device': device} for i, device in enumerate(devices))
+
+    end_checks = [args[0][0] for args in rule.check_for_match.call_args_list if args[1].get('end', True)]
+    assert end_checks == ['device1', 'device2', 'device3']
+    assert [(m['key'], m['status']) for m in rule.matches] == [('device1', 'above'), ('device2', 'above')]
+
+    rule.add_data([])
+    rule.add_data(iter([]))
+
+
+def test_threshold_coalesce_transitions():
+    rule = ruletypes.ProfiledThresholdRule({
+        'threshold': 1,
+        'timeframe': timedelta(minutes=10),
+        'query_key': 'device',
+        'timestamp_field': '@timestamp',
+        'coalesce_transitions': True,
+    })
+    t0 = datetime(2018, 1, 1, tzinfo=tzutc())
+    rule.add_terms_data({t0: [{'key': 'device%d' % i, 'doc_count': 1} for i in range(3)]})
+    rule.garbage_collect(t0 + timedelta(minutes=20))
+
+    above, below = rule.matches
+    assert above['count'] == 3
+    assert above['@timestamp'] == '2018-01-01T00:00:00Z'
+    assert sorted(t['key'] for t in above['transitions']) == ['device0', 'device1', 'device2']
+    assert below['status'] == 'transitions'
+    assert below['@timestamp'] == '2018-01-01T00:10:00Z'
+    assert [(t['status'], t['@timestamp']) for t in below['transitions']] == [
+        ('below', '2018-01-01T00:10:00Z')] * 3
+
+    rule.matches = []
+    rule.garbage_collect(t0 + timedelta(minutes=30))
+    assert rule.matches == []
+
+
+def test_frequency_gc_drops_stale_keys():
+    rule = ruletypes.ProfiledFrequencyRule({
+        'num_events': 10,
+        'timeframe': timedelta(minutes=10),
+        'query_key': 'device',
+        'timestamp_field': '@timestamp',
+    })
+    t0 = datetime(2018, 1, 1, tzinfo=tzutc())
+    rule.add_data([{'@timestamp': t0, 'device': 'device1'},
+                   {'@timestamp': t0, 'device': 'device2'},
+                   {'@timestamp': t0 + timedelta(minutes=8), 'device': 'device2'}])
+
+    rule.garbage_collect(t0 + timedelta(minutes=11))
+    assert sorted(rule.occurrences) == ['device2']
+    rule.garbage_collect(t0 + timedelta(minutes=19))
+    assert rule.occurrences == {}
+
+
+def test_profile_resolved_once_per_batch(mock_time, mock_getmtime, mock_json_load, mock_ruletypes_open):
+    mock_time.return_value = 1514764800 + 3600
+    mock_getmtime.return_value = 1514764800
+    mock_json_load.return_value = {'device1': 660}
+
+    rule = ruletypes.ProfiledFrequencyRule({
+        'num_events': 100,
+        'timeframe': timedelta(seconds=1800),
+        'query_key': 'device',
+        'timestamp_field': '@timestamp',
+        'profile': '/etc/profile.json',
+    })
+    t0 = datetime(2018, 1, 1, tzinfo=tzutc())
+    rule.add_data([{'@timestamp': t0 + timedelta(seconds=i), 'device': 'device%d' % (i % 2)}
+                   for i in range(10)])
+
+    assert mock_time.call_count == 1
+    assert mock_getmtime.call_count == 1
+    assert rule.timeframe('device1') == timedelta(seconds=660)
+    assert rule.timeframe('device0') == timedelta(seconds=1800)
+    assert mock_time.call_count == 1
+
+
+def test_profile_watcher(tmpdir):
+    profile = tmpdir.join('profile.json')
+    profile.write(json.dumps({'device1': 660}))
+    callback = MagicMock()
+    watcher = ruletypes.ProfileWatcher(str(profile), callback)
+
+    watcher.poll()
+    callback.assert_called_once_with({'device1': timedelta(seconds=660)})
+    watcher.poll()
+    assert callback.call_count == 1
+
+    profile.write(json.dumps({'device1': 60}))
+    profile.setmtime(profile.mtime() + 10)
+    watcher.poll()
+    callback.assert_called_with({'device1': timedelta(seconds=60)})
+
+
+def test_profile_watch_interval(tmpdir):
+    profile = tmpdir.join('profile.json')
+    profile.write(json.dumps({'device1': 660}))
+    rule = ruletypes.ProfiledFrequencyRule({
+        'num_events': 1,
+        'timeframe': timedelta(seconds=1800),
+        'profile': str(profile),
+        'profile_watch_interval': 3600,
+    })
+    rule._watcher.stop()
+
+    rule._begin_batch()
+    assert rule.timeframe('device1') == timedelta(seconds=660)
+
+
+def test_replaced_rule_closed(tmpdir):
+    profile = tmpdir.join('profile.json')
+    profile.write(json.dumps({'device1': 660}))
+    options = {
+        'name': 'test_replaced_rule_closed',
+        'threshold': 1,
+        'timeframe': timedelta(seconds=1800),
+        'profile': str(profile),
+        'profile_watch_interval': 3600,
+        'cache_path': str(tmpdir.join('status.json')),
+    }
+    previous = ruletypes.ProfiledThresholdRule(options)
+    previous.add_count_data({datetime(2018, 1, 1, tzinfo=tzutc()): 1})
+    previous._status.set('device1', 'above')
+    # Reloaded from its file as a new rules dict, closing the previous rule once used
+    rule = ruletypes.ProfiledThresholdRule(dict(options))
+    try:
+        assert not previous._watcher._stopped.is_set()
+        rule.add_count_data({datetime(2018, 1, 1, tzinfo=tzutc()): 1})
+        assert previous._watcher._stopped.is_set()
+        assert not rule._watcher._stopped.is_set()
+        # Flushed by the previous rule after the new rule loaded it
+        assert rule._status.get('device1') == 'above'
+        assert shared.PROFILES.subscribers(str(profile)) == 1
+    finally:
+        rule.close()
+
+
+def test_profile_shared_by_rules(tmpdir):
+    profile = tmpdir.join('profile.json')
+    profile.write(json.dumps({'device1': 660}))
+    load = MagicMock(wraps=ruletypes.load_profile)
+    rules = [ruletypes.ProfiledFrequencyRule({
+        'num_events': 1,
+        'timeframe': timedelta(seconds=1800),
+        'profile': str(profile),
+    }) for _ in range(3)]
+    for rule in rules:
+        rule._load_profile = load
+    assert rules[0].profile is rules[1].profile is rules[2].profile
+    assert load.call_count == 1
+    assert shared.PROFILES.subscribers(str(profile)) == 3
+
+
+def test_threshold_compact_window():
+    rule = ruletypes.ProfiledThresholdRule({
+        'threshold': 10,
+        'timeframe': timedelta(minutes=10),
+        'timestamp_field': '@timestamp',
+        'window_type': 'compact',
+    })
+    t0 = datetime(2018, 1, 1, tzinfo=tzutc())
+    rule.add_count_data({t0: 12})
+    rule.add_count_data({t0 + timedelta(minutes=5): 3})
+    rule.garbage_collect(t0 + timedelta(minutes=10))
+
+    assert [(m['status'], m['count']) for m in rule.matches] == [('above', 12), ('below', 3)]
+    assert rule.matches[1]['@timestamp'] == '2018-01-01T00:00:00Z'
+
+
+def test_threshold_buckets_terms_data():
+    rule = ruletypes.ProfiledThresholdRule({
+        'threshold': 10,
+        'timeframe': timedelta(minutes=10),
+        'query_key': 'device',
+        'timestamp_field': '@timestamp',
+        'window_type': 'buckets',
+        'bucket_interval': 60,
+    })
+    t0 = datetime(2018, 1, 1, tzinfo=tzutc())
+    rule.add_terms_data({t0: [{'key': 'device1', 'doc_count': 6}, {'key': 'device2', 'doc_count': 4}],
+                         t0 + timedelta(minutes=3): [{'key': 'device1', 'doc_count': 6}]})
+    rule.garbage_collect(t0 + timedelta(minutes=4))
+    assert [(m['key'], m['status']) for m in rule.matches] == [('device1', 'above')]
+
+    rule.matches = []
+    rule.garbage_collect(t0 + timedelta(minutes=10))
+    assert sorted((m['key'], m['status'], m['count']) for m in rule.matches) == [
+        ('device1', 'below', 6), ('device2', 'below', 0)]
+
+
+@pytest.mark.parametrize('window_type', ['events', 'compact', 'buckets'])
+@pytest.mark.parametrize('rule_class', [ruletypes.ProfiledFrequencyRule, ruletypes.ProfiledThresholdRule])
+def test_batch_terms_same_as_per_bucket(rule_class, window_type):
+    def run(batch_terms):
+        rnd = random.Random(42)
+        rule = rule_class({
+            'num_events': 8,
+            'threshold': 5,
+            'timeframe': timedelta(minutes=10),
+            'query_key': 'device',
+            'timestamp_field': '@timestamp',
+            'window_type': window_type,
+            'batch_terms': batch_terms,
+        })
+        ts = datetime(2018, 1, 1, tzinfo=tzutc())
+        for _ in range(50):
+            terms = {}
+            for _ in range(rnd.randint(1, 2)):
+                ts += timedelta(minutes=rnd.randint(0, 3))
+                terms[ts] = [{'key': 'device%d' % rnd.randint(0, 20), 'doc_count': rnd.randint(0, 4)}
+                             for _ in range(rnd.randint(0, 15))]
+            rule.add_terms_data(terms)
+            rule.garbage_collect(ts)
+        return rule.matches
+
+    matches = run(False)
+    assert matches
+    assert run(True) == matches
+
+
+def test_compound_blacklist_rule(tmpdir):
+    blacklist = tmpdir.join('blacklist.txt')
+    blacklist.write('fault\n')
+    rule = ruletypes.CompoundBlacklistRule({
+        'compare_key': 'status',
+        'blacklist': ['!file %s' % blacklist, 'offline.*'],
+        'blacklist_wildcards': True,
+        'timestamp_field': '@timestamp',
+    })
+    rule.add_data([{'@timestamp': '2018-01-01T00:00:00Z', 'status': ['ok', 'fault']},
+                   {'@timestamp': '2018-01-01T00:01:00Z', 'status': 'ok'},
+                   {'@timestamp': '2018-01-01T00:02:00Z', 'status': 'offline.gateway'}])
+
+    assert [m['@timestamp'] for m in rule.matches] == ['2018-01-01T00:00:00Z', '2018-01-01T00:02:00Z']
+
+
+def test_blacklist_shared_and_reloaded_once(tmpdir, mock_time):
+    blacklist = tmpdir.join('blacklist.txt')
+    blacklist.write('fault\n')
+    mock_time.return_value = 1514764800.0
+    options = {'blacklist': ['!file %s' % blacklist], 'timestamp_field': '@timestamp'}
+    compound = ruletypes.CompoundBlacklistRule(dict(options, compare_key='status'))
+    duration = ruletypes.BlacklistDurationRule(dict(
+        options, query_key='device', compound_compare_key=['status'], ignore_null=True, timeframe=timedelta(hours=1)))
+    assert duration.blacklist is compound.blacklist
+    assert duration.blacklisted(('fault',)) == (True,)
+
+    mock_time.return_value += 3600.0
+    blacklist.write('offline\n')
+    blacklist.setmtime(blacklist.mtime() + 10)
+    compound.add_data([])
+    duration.add_data([])
+    assert duration.blacklist.version == 2
+    assert duration.blacklisted(('fault',)) == (False,)
+
+    del compound, duration
+    gc.collect()
+    assert len(shared.BLACKLISTS) == 0
+
+
+def test_file_blacklist_in_filter(tmpdir):
+    blacklist = tmpdir.join('blacklist.txt')
+    blacklist.write('bad1\nbad2\n')
+    rules = {'blacklist': ['!file %s' % blacklist, 'bad3'], 'compare_key': 'host',
+             'timestamp_field': '@timestamp', 'filter': []}
+    ruletypes.CompoundBlacklistRule(rules)
+    ElastAlerter.enhance_filter.im_func(MagicMock(is_atleastfive=lambda: True), rules)
+
+    query, = [f['query_string']['query'] for f in rules['filter']]
+    assert sorted(query.split(' OR ')) == ['host:"bad1"', 'host:"bad2"', 'host:"bad3"']
+
+
+def test_blacklist_released_by_replaced_rule():
+    options = {'name': 'test_blacklist_released_by_replaced_rule', 'blacklist': ['fault'],
+               'compare_key': 'status', 'timestamp_field': '@timestamp'}
+    previous = ruletypes.CompoundBlacklistRule(options)
+    previous.add_data([])
+    rule = ruletypes.CompoundBlacklistRule(dict(options))
+    rule.add_data([])
+
+    assert previous.blacklist is rule.blacklist
+    assert shared.BLACKLISTS.subscribers((('fault',), False, ruletypes.UPDATE_INTERVAL)) == 1
+
+
+def test_blacklist_duration_trace_keys(monkeypatch):
+    log = MagicMock()
+    monkeypatch.setattr(ruletypes.elastalert_logger, 'log', log)
+    rule = ruletypes.BlacklistDurationRule({
+        'name': 'inverters',
+        'query_key': 'device',
+        'compound_compare_key': ['status'],
+        'ignore_null': True,
+        'blacklist': ['fault'],
+        'timeframe': timedelta(hours=1),
+        'timestamp_field': '@timestamp',
+        'trace_keys': ['device1'],
+        'trace_level': 'WARNING',
+    })
+    t0 = datetime(2018, 1, 1, tzinfo=tzutc())
+    rule.add_data([{'@timestamp': t0, 'device': 'device%d' % (i % 3), 'status': 'ok'} for i in range(9)])
+
+    assert log.call_count == 3
+    assert all(call[0][4] == 'device1' for call in log.call_args_list)
+
+
+def blacklist_duration_rule(**options):
+    rules = {
+        'name': 'inverters',
+        'query_key': 'device',
+        'compound_compare_key': ['status'],
+        'ignore_null': True,
+        'blacklist': ['fault'],
+        'timeframe': timedelta(hours=1),
+        'timestamp_field': '@timestamp',
+    }
+    rules.update(options)
+    return ruletypes.BlacklistDurationRule(rules)
+
+
+def test_blacklist_duration_state_per_instance():
+    t0 = datetime(2018, 1, 1, tzinfo=tzutc())
+    first = blacklist_duration_rule()
+    second = blacklist_duration_rule()
+    first.add_data([{'@timestamp': t0, 'device': 'device1', 'status': 'fault'},
+                    {'@timestamp': t0 + timedelta(minutes=10), 'device': 'device1', 'status': 'ok'}])
+
+    assert len(first.matches) == 1
+    assert first.matches[0]['duration'] == 600
+    assert not second.occurrences and not second.occurrence_time and not second.change_map
+
+
+def test_blacklist_duration_state_ttl():
+    t0 = datetime(2018, 1, 1, tzinfo=tzutc())
+    rule = blacklist_duration_rule(state_ttl_timeframes=2)
+    rule.add_data([{'@timestamp': t0, 'device': 'device1', 'status': 'fault'},
+                   {'@timestamp': t0 + timedelta(hours=1), 'device': 'device2', 'status': 'fault'}])
+    rule.garbage_collect(t0 + timedelta(hours=2, minutes=30))
+
+    assert list(rule.occurrences) == ['device2']
+    assert rule.get_state_stats() == {'tracked_keys': 1, 'evicted_ttl': 1, 'evicted_lru': 0}
+
+    # An evicted key starts over
+    rule.add_data([{'@timestamp': t0 + timedelta(hours=3), 'device': 'device1', 'status': 'ok'}])
+    assert rule.occurrences['device1'] == ('ok',)
+    assert not rule.matches
+
+
+def test_blacklist_duration_max_tracked_keys():
+    t0 = datetime(2018, 1, 1, tzinfo=tzutc())
+    rule = blacklist_duration_rule(max_tracked_keys=2)
+    rule.add_data([{'@timestamp': t0, 'device': 'device%d' % i, 'status': 'ok'} for i in range(4)])
+    rule.add_data([{'@timestamp': t0, 'device': 'device0', 'status': 'ok'}])
+    rule.garbage_collect(t0)
+
+    assert sorted(rule.occurrences) == ['device0', 'device3']
+    assert rule.get_state_stats() == {'tracked_keys': 2, 'evicted_ttl': 0, 'evicted_lru': 2}
+
+
+def test_blacklist_duration_transitions_since_last_match():
+    t0 = datetime(2018, 1, 1, tzinfo=tzutc())
+    rule = blacklist_duration_rule(compound_compare_key=['status', 'mode'], max_transitions=2)
+    statuses = [(0, 'fault'), (10, 'ok'), (20, 'fault'), (100, 'ok'), (110, 'fault'), (115, 'ok'),
+                (120, 'fault'), (200, 'ok'), (210, 'fault'), (300, 'ok'), (310, 'fault'), (320, 'ok')]
+    rule.add_data([{'@timestamp': t0 + timedelta(minutes=minutes), 'device': 'device1', 'status': status,
+                    'mode': 'auto'} for minutes, status in statuses])
+
+    first, second, third = rule.matches
+    assert [t['duration'] for t in first['transitions']] == [600]
+    # Stays longer than timeframe do not match but are reported with the next match
+    assert [(t['start_time'], t['duration']) for t in second['transitions']] == [
+        (t0 + timedelta(minutes=20), 4800), (t0 + timedelta(minutes=110), 300)]
+    assert (second['value'], second['duration']) == (['fault', 'auto'], 300)
+    # At most max_transitions are kept
+    assert [t['duration'] for t in third['transitions']] == [5400, 600]
+    assert rule.change_map == {}
@@ -0,0 +1,122 @@
+from datetime import datetime, timedelta
+import random
+
+from dateutil import parser
+from dateutil.tz import tzoffset, tzutc
+import pytest
+from pytz import timezone
+
+from elastalert_extensions.alerts import InTimeframe
+from elastalert_extensions.schedule import parse_days
+from elastalert_extensions.schedule import Schedule
+from elastalert_extensions.schedule import ts_to_us
+from elastalert_extensions.schedule import UtcOffsets
+from elastalert_extensions.windows import dt_to_us
+
+
+utc = timezone('UTC')
+
+
+def old_in_timeframe(schedule, ts):
+    """ InTimeframe before the fast path. """
+    dt = parser.parse(ts)
+    if not dt.tzinfo:
+        dt = utc.localize(dt)
+    t = dt.astimezone(timezone(schedule.get('timezone', 'UTC'))).time()
+    from_ = schedule.get('from') and datetime.strptime(schedule['from'], '%H:%M').time()
+    to = schedule.get('to') and datetime.strptime(schedule['to'], '%H:%M').time()
+    return not (from_ and t < from_) and not (to and t > to)
+
+
+@pytest.mark.parametrize('ts', [
+    '2018-03-11T10:00:00Z',
+    '2018-03-11T10:00:00.123Z',
+    '2018-03-11T10:00:00.123456789Z',
+    '2018-03-11 10:00:00',
+    '2018-03-11T10:00:00+08:00',
+    '2018-03-11T10:00:00-0330',
+    '2018-03-11T10:00:00+08',
+    '2018-03-11T10:00:00,5+01:00',
+    'Sun Mar 11 10:00:00 2018',
+    '2018-03-11',
+])
+def test_ts_to_us(ts):
+    dt = parser.parse(ts)
+    if not dt.tzinfo:
+        dt = dt.replace(tzinfo=tzutc())
+    assert ts_to_us(ts) == dt_to_us(dt)
+
+
+@pytest.mark.parametrize('ts', [
+    '2018-03-11T25:00:00Z',
+    '2018-03-11T10:61:00Z',
+    '2018-03-11T10:00:61Z',
+])
+def test_ts_to_us_out_of_range(ts):
+    with pytest.raises(ValueError):
+        ts_to_us(ts)
+
+
+def test_ts_to_us_datetime():
+    dt = datetime(2018, 3, 11, 10, tzinfo=tzoffset(None, 3600))
+    assert ts_to_us(dt) == ts_to_us('2018-03-11T09:00:00Z')
+    assert ts_to_us(datetime(2018, 3, 11, 9)) == ts_to_us('2018-03-11T09:00:00Z')
+
+
+@pytest.mark.parametrize('zone', ['Europe/Berlin', 'America/St_Johns', 'Asia/Taipei', 'Australia/Lord_Howe'])
+def test_utc_offsets_across_transitions(zone):
+    tz = timezone(zone)
+    offsets = UtcOffsets(tz)
+    start = datetime(2018, 3, 9, tzinfo=tzutc())
+    for minutes in range(0, 60 * 24 * 60, 7):
+        dt = start + timedelta(minutes=minutes)
+        expected = dt.astimezone(tz).utcoffset()
+        assert offsets(dt_to_us(dt)) == expected.total_seconds() * 1000000
+
+
+def test_parse_days():
+    assert parse_days(None) == list(range(7))
+    assert parse_days('mon-fri') == [0, 1, 2, 3, 4]
+    assert parse_days(['Saturday', 'sun']) == [5, 6]
+    assert parse_days('fri-mon, 2') == [0, 2, 4, 5, 6]
+    with pytest.raises(Exception):
+        parse_days(['someday'])
+
+
+@pytest.mark.parametrize('schedule', [
+    {},
+    {'timezone': 'Asia/Taipei', 'from': '08:00', 'to': '18:00'},
+    {'timezone': 'America/New_York', 'from': '09:30'},
+    {'to': '17:15'},
+])
+def test_same_as_before(schedule):
+    in_timeframe = InTimeframe('@timestamp', schedule)
+    random.seed(13)
+    start = datetime(2018, 3, 1)
+    for _ in range(500):
+        ts = (start + timedelta(seconds=random.randint(0, 86400 * 60))).isoformat() + 'Z'
+        assert in_timeframe({'@timestamp': ts}) == old_in_timeframe(schedule, ts), ts
+
+
+def test_windows_and_days():
+    schedule = Schedule({
+        'timezone': 'Asia/Taipei',
+        'windows': [
+            {'from': '08:00', 'to': '12:00', 'days': 'mon-fri'},
+            {'from': '13:00', 'to': '17:00', 'days': 'mon-fri'},
+            {'from': '22:00', 'to': '02:00', 'days': ['sat']},
+        ],
+    })
+    # Monday 2018-03-12 in Taipei
+    assert ts_to_us('2018-03-12T09:00:00+08:00') in schedule
+    assert ts_to_us('2018-03-12T12:30:00+08:00') not in schedule
+    assert ts_to_us('2018-03-12T17:00:00+08:00') in schedule
+    assert ts_to_us('2018-03-12T17:00:01+08:00') not in schedule
+    assert ts_to_us('2018-03-12T23:00:00+08:00') not in schedule
+    # Saturday 2018-03-10
+    assert ts_to_us('2018-03-10T09:00:00+08:00') not in schedule
+    assert ts_to_us('2018-03-10T01:00:00+08:00') in schedule
+    assert ts_to_us('2018-03-10T23:00:00+08:00') in schedule
+    assert ts_to_us('2018-03-10T15:00:00Z') in schedule
+    assert not schedule.always
+    assert Schedule({'timezone': 'Asia/Taipei'}).always
@@ -0,0 +1,148 @@
+from datetime import datetime, timedelta
+import json
+import random
+
+from dateutil.tz import tzutc
+import pytest
+
+from elastalert_extensions import ruletypes
+from elastalert_extensions.metrics import REGISTRY
+from elastalert_extensions.shard import shard_of
+from elastalert_extensions.shard import ShardWorker
+
+
+T0 = datetime(2018, 1, 1, tzinfo=tzutc())
+
+
+def rules(**options):
+    rules = {
+        'name': 'sharded',
+        'num_events': 5,
+        'threshold': 3,
+        'timeframe': timedelta(minutes=10),
+        'query_key': 'device',
+        'timestamp_field': '@timestamp',
+    }
+    rules.update(options)
+    return rules
+
+
+def make_terms(step, num_keys=40):
+    ts = T0 + timedelta(minutes=step)
+    return {ts: [{'key': 'device%d' % key, 'doc_count': random.randint(0, 3)}
+                 for key in range(num_keys) if random.random() < 0.7]}
+
+
+def make_docs(step, num_keys=40):
+    return [{'@timestamp': T0 + timedelta(minutes=step, seconds=i), 'device': 'device%d' % random.randrange(num_keys)}
+            for i in range(random.randint(0, 60))]
+
+
+def run(rule, steps, data, start=0):
+    matches = []
+    for step in range(start, steps):
+        random.seed(step)
+        if data == 'terms':
+            rule.add_terms_data(make_terms(step))
+        else:
+            docs = make_docs(step)
+            if docs:
+                rule.add_data(docs)
+        matches.append(list(rule.matches))
+        rule.matches = []
+        rule.garbage_collect(T0 + timedelta(minutes=step, seconds=59))
+        # Garbage collection has no defined order
+        matches.append(sorted(rule.matches, key=json.dumps))
+        rule.matches = []
+    return matches
+
+
+@pytest.mark.parametrize('single_class, sharded_class', [
+    (ruletypes.ProfiledFrequencyRule, ruletypes.ShardedProfiledFrequencyRule),
+    (ruletypes.ProfiledThresholdRule, ruletypes.ShardedProfiledThresholdRule),
+])
+@pytest.mark.parametrize('data, options', [
+    ('terms', {}),
+    ('terms', {'batch_terms': True}),
+    ('docs', {}),
+])
+def test_same_as_single_process(single_class, sharded_class, data, options):
+    expected = run(single_class(rules(**options)), 30, data)
+    sharded = sharded_class(rules(shards=3, **options))
+    try:
+        assert run(sharded, 30, data) == expected
+    finally:
+        sharded._pool.close()
+    assert any(expected)
+
+
+def test_status_carried_over(tmpdir):
+    cache = tmpdir.join('status.json')
+    cache.write(json.dumps({'device%d' % key: 'below' for key in range(10)}))
+    rule = ruletypes.ShardedProfiledThresholdRule(rules(shards=2, cache_path=str(cache)))
+    rule.add_terms_data({T0: [{'key': 'device%d' % key, 'doc_count': 5} for key in range(10)]})
+    rule.garbage_collect(T0)
+    rule._pool.close()
+
+    assert len(rule.matches) == 10
+    for index in range(2):
+        status = json.loads(tmpdir.join('status.json.shard%dof2' % index).read())
+        assert status == {'device%d' % key: 'above' for key in range(10) if shard_of('device%d' % key, 2) == index}
+
+
+def test_status_flushed_on_close(tmpdir):
+    cache = tmpdir.join('status.json')
+    rule = ruletypes.ShardedProfiledThresholdRule(rules(shards=2, cache_path=str(cache), cache_flush_interval=3600))
+    rule.add_terms_data({T0: [{'key': 'device%d' % key, 'doc_count': 5} for key in range(5)]})
+    rule.garbage_collect(T0)
+    # Within cache_flush_interval of the first flush
+    rule.add_terms_data({T0: [{'key': 'device%d' % key, 'doc_count': 5} for key in range(5, 10)]})
+    rule.garbage_collect(T0)
+    rule._pool.close()
+
+    for index in range(2):
+        status = json.loads(tmpdir.join('status.json.shard%dof2' % index).read())
+        assert status == {'device%d' % key: 'above' for key in range(10) if shard_of('device%d' % key, 2) == index}
+
+
+def test_replaced_rule_closed():
+    options = rules(name='test_replaced_rule_closed', shards=2)
+    previous = ruletypes.ShardedProfiledThresholdRule(options)
+    previous.add_terms_data({})
+    procs = list(previous._pool._procs)
+    rule = ruletypes.ShardedProfiledThresholdRule(dict(options))
+    try:
+        assert all(proc.is_alive() for proc in procs)
+        rule.add_terms_data({})
+        assert not any(proc.is_alive() for proc in procs)
+    finally:
+        rule.close()
+
+
+def test_metrics_exported_by_parent(tmpdir):
+    options = rules(name='test_metrics_exported_by_parent', metrics=True, metrics_path=str(tmpdir.join('metrics.json')))
+    worker = ShardWorker(ruletypes.ProfiledThresholdRule, options, 1, 2)
+    assert not set(worker.rule.rules) & {'metrics', 'metrics_port', 'metrics_path'}
+
+    rule = ruletypes.ShardedProfiledThresholdRule(dict(options, shards=2))
+    try:
+        rule.add_terms_data({T0: [{'key': 'device%d' % key, 'doc_count': 1} for key in range(10)]})
+        rule.garbage_collect(T0)
+    finally:
+        rule._pool.close()
+
+    tracked = dict((g['labels']['shard'], g['value']) for g in REGISTRY.to_json()['gauges']
+                   if g['labels'].get('rule') == 'test_metrics_exported_by_parent' and
+                   g['name'] == 'elastalert_rule_tracked_keys')
+    assert tracked == {index: sum(1 for key in range(10) if shard_of('device%d' % key, 2) == index)
+                       for index in range(2)}
+
+
+def test_shard_of_matches_status_keys():
+    assert shard_of(u'device1', 4) == shard_of('device1', 4)
+    assert shard_of(5, 4) == shard_of(u'5', 4)
+
+
+def test_requires_query_key():
+    with pytest.raises(Exception):
+        ruletypes.ShardedProfiledThresholdRule({'threshold': 1, 'timeframe': timedelta(minutes=1)})
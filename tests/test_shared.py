@@ -0,0 +1,66 @@
+import gc
+
+from mock import MagicMock
+
+from elastalert_extensions.shared import SharedCache
+
+
+class Owner(object):
+    pass
+
+
+def test_loaded_once_per_version():
+    cache = SharedCache()
+    loader = MagicMock(side_effect=lambda: object())
+    first, second = Owner(), Owner()
+
+    value = cache.load('/etc/profile.json', 1.0, loader, first)
+    assert cache.load('/etc/profile.json', 1.0, loader, second) is value
+    assert loader.call_count == 1
+    assert cache.subscribers('/etc/profile.json') == 2
+
+    reloaded = cache.load('/etc/profile.json', 2.0, loader, first)
+    assert reloaded is not value
+    assert cache.load('/etc/profile.json', 2.0, loader, second) is reloaded
+    assert loader.call_count == 2
+
+
+def test_reloaded_once_past_max_age(mock_time):
+    cache = SharedCache()
+    loader = MagicMock(side_effect=lambda: object())
+    owners = [Owner() for _ in range(3)]
+    mock_time.return_value = 1514764800.0
+    value = cache.load('/etc/profile.json', 1.0, loader, owners[0])
+
+    mock_time.return_value += 3600.0
+    assert [cache.load('/etc/profile.json', 1.0, loader, owner, max_age=86400.0) for owner in owners] == [value] * 3
+    mock_time.return_value += 86400.0
+    reloaded = [cache.load('/etc/profile.json', 1.0, loader, owner, max_age=86400.0) for owner in owners]
+    assert reloaded[0] is not value
+    assert reloaded == [reloaded[0]] * 3
+    assert loader.call_count == 2
+
+
+def test_evicted_with_last_subscriber():
+    cache = SharedCache()
+    first, second = Owner(), Owner()
+    cache.get('blacklist', set, first)
+    cache.get('blacklist', set, second)
+
+    cache.release('blacklist', first)
+    assert cache.subscribers('blacklist') == 1
+    del second
+    gc.collect()
+    assert 'blacklist' not in cache
+    assert len(cache) == 0
+
+
+def test_failed_load_not_cached():
+    cache = SharedCache()
+    owner = Owner()
+    loader = MagicMock(side_effect=[IOError('missing'), 'loaded'])
+    try:
+        cache.load('/etc/profile.json', 1.0, loader, owner)
+    except IOError:
+        pass
+    assert cache.load('/etc/profile.json', 1.0, loader, owner) == 'loaded'
@@ -0,0 +1,126 @@
+from array import array
+from datetime import datetime, timedelta
+
+from dateutil.tz import tzutc
+import pytest
+
+from elastalert_extensions import ruletypes
+from elastalert_extensions.snapshot import read_snapshot
+from elastalert_extensions.snapshot import write_snapshot
+from tests.test_shard import run
+
+
+T0 = datetime(2018, 1, 1, tzinfo=tzutc())
+
+
+def rules(**options):
+    rules = {
+        'name': 'snapshot',
+        'num_events': 5,
+        'threshold': 3,
+        'timeframe': timedelta(minutes=10),
+        'query_key': 'device',
+        'timestamp_field': '@timestamp',
+    }
+    rules.update(options)
+    return rules
+
+
+def test_roundtrip(tmpdir):
+    path = str(tmpdir.join('windows.snapshot'))
+    entries = [
+        ('device0', None, 3000000, array('d', [1000000, 2000000]), array('d', [1, 2])),
+        (u'd\xe9vice1', 500000, 4000000, array('d', [4000000]), array('d', [7])),
+        (('a', 'b'), None, 1, array('d'), array('d')),
+    ]
+    write_snapshot(path, iter(entries))
+    assert list(read_snapshot(path)) == entries
+
+
+@pytest.mark.parametrize('content', [b'', b'EAWS', b'NOPE' + b'\0' * 100])
+def test_not_a_snapshot(tmpdir, content):
+    path = tmpdir.join('windows.snapshot')
+    path.write(content, mode='wb')
+    with pytest.raises(ValueError):
+        list(read_snapshot(str(path)))
+
+
+@pytest.mark.parametrize('rule_class', [ruletypes.ProfiledFrequencyRule, ruletypes.ProfiledThresholdRule])
+@pytest.mark.parametrize('data, options', [
+    ('terms', {}),
+    ('terms', {'window_type': 'compact'}),
+    ('terms', {'window_type': 'buckets', 'bucket_interval': 60}),
+    ('docs', {}),
+    ('docs', {'window_type': 'compact'}),
+])
+def test_warm_restart(tmpdir, rule_class, data, options):
+    # The threshold statuses are kept by the status cache, not the snapshot
+    path = str(tmpdir.join('windows.snapshot'))
+    cache = tmpdir.join('status.json')
+    rule = rule_class(rules(snapshot_path=path, cache_path=str(cache), **options))
+    run(rule, 15, data)
+    rule.save_snapshot()
+    if cache.exists():
+        cache.copy(tmpdir.join('restarted.json'))
+
+    # Of another name, not to close the rule it is compared with
+    restarted = rule_class(rules(name='restarted', snapshot_path=path, cache_path=str(tmpdir.join('restarted.json')),
+                                 **options))
+    expected = run(rule, 30, data, start=15)
+    assert run(restarted, 30, data, start=15) == expected
+    assert any(expected)
+
+
+def test_restores_first_event(tmpdir):
+    path = str(tmpdir.join('windows.snapshot'))
+    rule = ruletypes.ProfiledThresholdRule(rules(snapshot_path=path))
+    rule.add_data([{'@timestamp': T0 + timedelta(seconds=i), 'device': 'device0'} for i in range(3)])
+    rule.save_snapshot()
+
+    restarted = ruletypes.ProfiledThresholdRule(rules(name='restarted', snapshot_path=path))
+    restarted._begin_batch()
+    assert restarted.first_event == rule.first_event
+    assert restarted.occurrences['device0'].entries() == rule.occurrences['device0'].entries()
+
+
+def test_snapshot_interval(tmpdir, mock_time):
+    path = tmpdir.join('windows.snapshot')
+    mock_time.return_value = 1000.0
+    rule = ruletypes.ProfiledFrequencyRule(rules(snapshot_path=str(path), snapshot_interval=60))
+    rule.add_data([{'@timestamp': T0, 'device': 'device0'}])
+    assert not path.exists()
+    mock_time.return_value = 1060.0
+    rule.add_data([{'@timestamp': T0, 'device': 'device1'}])
+    assert sorted(key for key, _, _, _, _ in read_snapshot(str(path))) == ['device0', 'device1']
+
+
+def test_snapshot_saved_on_close(tmpdir, mock_time):
+    path = str(tmpdir.join('windows.snapshot'))
+    mock_time.return_value = 1000.0
+    rule = ruletypes.ProfiledFrequencyRule(rules(snapshot_path=path, snapshot_interval=3600))
+    rule.add_data([{'@timestamp': T0, 'device': 'device0'}])
+    rule.garbage_collect(T0 + timedelta(minutes=1))
+    rule.close()
+
+    restarted = ruletypes.ProfiledFrequencyRule(rules(snapshot_path=path, snapshot_interval=3600))
+    restarted.add_data([{'@timestamp': T0 + timedelta(minutes=2), 'device': 'device1'}])
+    assert sorted(restarted.occurrences) == ['device0', 'device1']
+    assert restarted.occurrences['device0'].entries() == rule.occurrences['device0'].entries()
+
+
+def test_snapshot_saved_by_garbage_collect(tmpdir, mock_time):
+    path = tmpdir.join('windows.snapshot')
+    mock_time.return_value = 1000.0
+    rule = ruletypes.ProfiledFrequencyRule(rules(snapshot_path=str(path), snapshot_interval=60))
+    rule.add_data([{'@timestamp': T0, 'device': 'device0'}])
+    mock_time.return_value = 1060.0
+    rule.garbage_collect(T0 + timedelta(minutes=1))
+    assert [key for key, _, _, _, _ in read_snapshot(str(path))] == ['device0']
+
+
+def test_corrupt_snapshot_ignored(tmpdir):
+    path = tmpdir.join('windows.snapshot')
+    path.write('garbage')
+    rule = ruletypes.ProfiledFrequencyRule(rules(snapshot_path=str(path)))
+    rule.add_data([{'@timestamp': T0, 'device': 'device0'}])
+    assert list(rule.occurrences) == ['device0']
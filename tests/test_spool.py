@@ -0,0 +1,147 @@
+from datetime import datetime
+
+from dateutil.tz import tzutc
+from elastalert import alerts
+import pytest
+
+from elastalert_extensions.alerts import ScheduledAlerter
+from elastalert_extensions.spool import Spool
+from elastalert_extensions.windows import dt_to_us
+
+
+class RecordingAlerter(alerts.Alerter):
+    def __init__(self, rule):
+        super(RecordingAlerter, self).__init__(rule)
+        self.sent = []
+
+    def alert(self, matches):
+        self.sent.append(matches)
+
+    def get_info(self):
+        return {'type': 'recording'}
+
+
+class ScheduledRecordingAlerter(ScheduledAlerter, RecordingAlerter):
+    pass
+
+
+def test_spool_dedup_by_key(tmpdir):
+    spool = Spool(str(tmpdir.join('spool')))
+    spool.add('device1', {'n': 1})
+    spool.add(None, {'n': 2})
+    spool.add(None, {'n': 3})
+    spool.add('device1', {'n': 4})
+
+    assert spool.matches() == [{'n': 2}, {'n': 3}, {'n': 4}]
+
+
+def test_spool_survives_restart(tmpdir):
+    path = str(tmpdir.join('spool'))
+    spool = Spool(path)
+    spool.add('device1', {'n': 1})
+    spool.add('device2', {'n': 2})
+    spool.add('device1', {'n': 3})
+    with open(path, 'a') as f:
+        f.write('["device3", {"n"')
+
+    restored = Spool(path)
+    assert restored.matches() == [{'n': 2}, {'n': 3}]
+    # Appends start on a line of their own
+    restored.add('device4', {'n': 4})
+    assert Spool(path).matches() == [{'n': 2}, {'n': 3}, {'n': 4}]
+    spool.clear()
+    assert len(Spool(path)) == 0
+
+
+def test_spool_compound_keys(tmpdir):
+    path = str(tmpdir.join('spool'))
+    spool = Spool(path)
+    spool.add(('device1', 'eth0'), {'n': 1})
+    spool.add(('device1', 'eth1'), {'n': 2})
+
+    restored = Spool(path)
+    restored.add(('device1', 'eth0'), {'n': 3})
+    assert restored.matches() == [{'n': 2}, {'n': 3}]
+
+
+def test_spool_bounded(tmpdir):
+    path = str(tmpdir.join('spool'))
+    spool = Spool(path, max_entries=3)
+    for n in range(10):
+        spool.add('device%d' % n, {'n': n})
+
+    assert spool.matches() == [{'n': 7}, {'n': 8}, {'n': 9}]
+    assert spool.dropped == 7
+    # Compacted along the way
+    assert len(open(path).readlines()) < 10
+    assert Spool(path, max_entries=3).matches() == spool.matches()
+
+
+def make_alerter(tmpdir, **schedule):
+    schedule.update(timezone='UTC', **{'from': '08:00', 'to': '18:00'})
+    return ScheduledRecordingAlerter({
+        'name': 'rule',
+        'timestamp_field': '@timestamp',
+        'query_key': 'device',
+        'schedule': schedule,
+    })
+
+
+def at(hour):
+    return dt_to_us(datetime(2018, 1, 1, hour, tzinfo=tzutc())) / 1e6
+
+
+def test_out_of_schedule_dropped(tmpdir):
+    alerter = make_alerter(tmpdir)
+    alerter.alert([{'@timestamp': '2018-01-01T07:00:00Z'}, {'@timestamp': '2018-01-01T09:00:00Z'}])
+
+    assert alerter.sent == [[{'@timestamp': '2018-01-01T09:00:00Z'}]]
+    assert alerter.get_info() == {'type': 'scheduled_recording'}
+
+
+def test_deferred_until_schedule_opens(tmpdir, mock_time):
+    path = str(tmpdir.join('spool'))
+    alerter = make_alerter(tmpdir, defer=True, spool_path=path, flush_interval=3600)
+    mock_time.return_value = at(7)
+    alerter.alert([{'@timestamp': '2018-01-01T06:00:00Z', 'device': 'device1', 'n': 1},
+                   {'@timestamp': '2018-01-01T06:30:00Z', 'device': 'device2', 'n': 2},
+                   {'@timestamp': '2018-01-01T07:00:00Z', 'device': 'device1', 'n': 3}])
+    alerter.flush_spool()
+    assert alerter.sent == []
+
+    # A restart keeps them
+    alerter = make_alerter(tmpdir, defer=True, spool_path=path, flush_interval=3600)
+    mock_time.return_value = at(8)
+    alerter.flush_spool()
+
+    assert [[m['n'] for m in matches] for matches in alerter.sent] == [[2, 3]]
+    assert len(Spool(path)) == 0
+
+
+def test_deferred_sent_with_new_matches(tmpdir, mock_time):
+    alerter = make_alerter(tmpdir, defer=True, spool_path=str(tmpdir.join('spool')), flush_interval=3600)
+    mock_time.return_value = at(7)
+    alerter.alert([{'@timestamp': '2018-01-01T07:00:00Z', 'device': 'device1', 'n': 1}])
+    mock_time.return_value = at(9)
+    alerter.alert([{'@timestamp': '2018-01-01T09:00:00Z', 'device': 'device2', 'n': 2}])
+
+    assert [[m['n'] for m in matches] for matches in alerter.sent] == [[1, 2]]
+
+
+def test_replaced_alerter_closed(tmpdir):
+    path = str(tmpdir.join('spool'))
+    previous = make_alerter(tmpdir, defer=True, spool_path=path)
+    previous.alert([])
+    alerter = make_alerter(tmpdir, defer=True, spool_path=path)
+    assert not previous._flusher._stopped.is_set()
+    alerter.alert([])
+    try:
+        assert previous._flusher._stopped.is_set()
+        assert not alerter._flusher._stopped.is_set()
+    finally:
+        alerter.close()
+
+
+def test_defer_requires_spool_path(tmpdir):
+    with pytest.raises(Exception):
+        make_alerter(tmpdir, defer=True)
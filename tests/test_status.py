@@ -0,0 +1,130 @@
+import json
+
+from mock import MagicMock
+
+from elastalert_extensions import lifecycle
+from elastalert_extensions import status
+from elastalert_extensions.status import StatusStore
+
+
+def read_json(path):
+    with open(str(path), 'r') as jsonf:
+        return json.load(jsonf)
+
+
+def test_write_behind(tmpdir):
+    cache = tmpdir.join('status.json')
+    store = StatusStore(str(cache))
+
+    store.set('device1', 'below')
+    store.set('device2', 'above')
+    assert not cache.exists()
+
+    assert store.flush()
+    assert read_json(cache) == {'device1': 'below', 'device2': 'above'}
+    assert not store.flush()
+    assert tmpdir.listdir() == [cache]
+
+
+def test_flush_interval(tmpdir, mock_time):
+    cache = tmpdir.join('status.json')
+    store = StatusStore(str(cache), flush_interval=60.0)
+
+    mock_time.return_value = 1514764800.0
+    store.set('device1', 'below')
+    assert store.flush()
+
+    mock_time.return_value = 1514764800.0 + 30.0
+    store.set('device1', 'above')
+    assert not store.flush()
+    assert read_json(cache) == {'device1': 'below'}
+
+    mock_time.return_value = 1514764800.0 + 60.0
+    assert store.flush()
+    assert read_json(cache) == {'device1': 'above'}
+
+
+def test_load_existing(tmpdir):
+    cache = tmpdir.join('status.json')
+    cache.write(json.dumps({'device1': 'below'}))
+
+    store = StatusStore(str(cache))
+    assert store.get('device1') == 'below'
+    assert not store.dirty
+
+
+def test_journal_replay(tmpdir):
+    cache = tmpdir.join('status.json')
+    store = StatusStore(str(cache), journal=True)
+    store.set('device1', 'below')
+    store.set('device1', 'above')
+    store.set('device2', 'below')
+    store.flush()
+    assert not cache.exists()
+
+    restored = StatusStore(str(cache), journal=True)
+    assert dict(restored.items()) == {'device1': 'above', 'device2': 'below'}
+
+
+def test_journal_compaction(tmpdir):
+    cache = tmpdir.join('status.json')
+    journal = tmpdir.join('status.json.journal')
+    store = StatusStore(str(cache), journal=True, compact_entries=2)
+    store.set('device1', 'below')
+    store.flush()
+    assert not cache.exists()
+
+    store.set('device2', 'below')
+    store.flush()
+    assert read_json(cache) == {'device1': 'below', 'device2': 'below'}
+    assert journal.read() == ''
+
+    restored = StatusStore(str(cache), journal=True)
+    assert dict(restored.items()) == {'device1': 'below', 'device2': 'below'}
+
+
+def test_journal_torn_write(tmpdir):
+    cache = tmpdir.join('status.json')
+    tmpdir.join('status.json.journal').write('["device1", "below"]\n["device2", "be')
+
+    store = StatusStore(str(cache), journal=True)
+    assert dict(store.items()) == {'device1': 'below'}
+
+
+def test_journal_appends_after_torn_write(tmpdir):
+    cache = tmpdir.join('status.json')
+    journal = tmpdir.join('status.json.journal')
+    journal.write('["device1", "below"]\n["device2", "be')
+
+    store = StatusStore(str(cache), journal=True)
+    store.set('device3', 'above')
+    store._sync_journal()
+    # Left by an earlier crash, before torn lines were cut
+    journal.write('["device4", "be["device5", "above"]\n["device6", "above"]\n', mode='a')
+
+    restored = StatusStore(str(cache), journal=True)
+    assert dict(restored.items()) == {'device1': 'below', 'device3': 'above', 'device6': 'above'}
+
+
+def test_dirty_kept_when_flush_fails(tmpdir, monkeypatch):
+    cache = tmpdir.join('status.json')
+    store = StatusStore(str(cache))
+    store.set('device1', 'below')
+    monkeypatch.setattr(status, 'atomic_write', MagicMock(side_effect=IOError('disk full')))
+    assert not store.flush()
+    assert store.dirty
+
+    monkeypatch.undo()
+    assert store.flush()
+    assert read_json(cache) == {'device1': 'below'}
+
+
+def test_flushed_at_exit(tmpdir):
+    cache = tmpdir.join('status.json')
+    store = StatusStore(str(cache), flush_interval=3600.0)
+    store.set('device1', 'below')
+    store.flush()
+    store.set('device2', 'above')
+
+    lifecycle.run_exit_hooks()
+    assert read_json(cache) == {'device1': 'below', 'device2': 'above'}
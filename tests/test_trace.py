@@ -0,0 +1,39 @@
+import logging
+
+from mock import MagicMock
+
+from elastalert_extensions.trace import Tracer
+
+
+def make_logger(level):
+    logger = MagicMock(name='logger')
+    logger.isEnabledFor.side_effect = lambda lvl: lvl >= level
+    return logger
+
+
+def test_inactive_below_logger_level():
+    logger = make_logger(logging.INFO)
+    tracer = Tracer('rule', logger=logger)
+
+    assert not tracer.active
+    assert not tracer.wants('device1')
+
+    tracer = Tracer('rule', level='INFO', logger=logger)
+    assert tracer.wants('device1')
+
+
+def test_keys_and_sample():
+    tracer = Tracer('rule', keys=['device1'], sample=2, logger=make_logger(logging.DEBUG))
+
+    assert [tracer.wants(key) for key in ['device1', 'device2', 'device1', 'device1', 'device1']] == \
+        [False, False, True, False, True]
+
+
+def test_trace_is_formatted_lazily():
+    logger = make_logger(logging.DEBUG)
+    tracer = Tracer('rule', logger=logger)
+    tracer.trace('device1', 'compare', values=[1, 2], changed=False)
+
+    (level, fmt, name, point, key, fields), _ = logger.log.call_args
+    assert level == logging.DEBUG
+    assert (fmt % (name, point, key, fields)) == "[rule] compare key='device1' changed=False values=[1, 2]"
@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+
+from dateutil.tz import tzutc
+import pytest
+
+from elastalert_extensions.windows import BucketWindow
+from elastalert_extensions.windows import CountWindow
+from elastalert_extensions.windows import DocumentWindow
+
+
+T0 = datetime(2018, 1, 1, tzinfo=tzutc())
+
+
+@pytest.fixture(params=[CountWindow, DocumentWindow])
+def window_class(request):
+    return request.param
+
+
+def test_prunes_to_timeframe(window_class):
+    window = window_class(timedelta(minutes=10), '@timestamp')
+    for i in range(12):
+        window.add(T0 + timedelta(minutes=i), 2)
+
+    assert window.count() == 20
+    assert len(window) == 10
+    assert window.first_ts() == T0 + timedelta(minutes=2)
+    assert window.last_ts() == T0 + timedelta(minutes=11)
+
+
+def test_out_of_order(window_class):
+    window = window_class(timedelta(minutes=10), '@timestamp')
+    window.add(T0 + timedelta(minutes=5), 1, {'@timestamp': T0 + timedelta(minutes=5), 'n': 1})
+    window.add(T0 + timedelta(minutes=1), 1, {'@timestamp': T0 + timedelta(minutes=1), 'n': 2})
+    window.add(T0 + timedelta(minutes=12), 1, {'@timestamp': T0 + timedelta(minutes=12), 'n': 3})
+
+    assert window.count() == 2
+    assert window.first_ts() == T0 + timedelta(minutes=5)
+    assert window.last_event()['n'] == 3
+
+
+def test_ts_reaching(window_class):
+    window = window_class(timedelta(minutes=10), '@timestamp')
+    window.add(T0, 3)
+    window.add(T0 + timedelta(minutes=1), 1)
+    window.add(T0 + timedelta(minutes=2), 1)
+
+    assert window.ts_reaching(2) == T0 + timedelta(minutes=1)
+    assert window.ts_reaching(4) == T0
+    assert window.ts_reaching(6) is None
+
+
+def test_count_window_keeps_only_last_event():
+    window = CountWindow(timedelta(minutes=10), '@timestamp')
+    window.add(T0, 1, {'@timestamp': T0, 'n': 1})
+    window.add(T0 + timedelta(minutes=1), 0)
+
+    assert window.events is None
+    assert window.last_event() == {'@timestamp': T0 + timedelta(minutes=1)}
+    assert window.related_events() == []
+
+
+def test_count_window_keep_events():
+    window = CountWindow(timedelta(minutes=10), '@timestamp', keep_events=True)
+    window.add(T0, 1, {'@timestamp': T0, 'n': 1})
+    window.add(T0 + timedelta(minutes=1), 1)
+    window.add(T0 + timedelta(minutes=2), 1, {'@timestamp': T0 + timedelta(minutes=2), 'n': 3})
+
+    assert window.related_events() == [{'@timestamp': T0, 'n': 1},
+                                       {'@timestamp': T0 + timedelta(minutes=1)}]
+
+
+def test_bucket_window_ring():
+    window = BucketWindow(timedelta(minutes=10), '@timestamp')
+    assert len(window.buckets) == 10
+    for i in range(12):
+        window.add(T0 + timedelta(minutes=i, seconds=30), 2)
+
+    assert window.count() == 20
+    assert window.first_ts() == T0 + timedelta(minutes=2)
+    assert window.last_ts() == T0 + timedelta(minutes=11, seconds=30)
+
+    # Too old for the window
+    window.add(T0 + timedelta(minutes=1), 5)
+    assert window.count() == 20
+
+    window.add(T0 + timedelta(minutes=15), 0)
+    assert window.count() == 12
+
+    window.add(T0 + timedelta(hours=1), 1)
+    assert window.count() == 1
+    assert len(window) == 1
+
+
+def test_bucket_window_ts_reaching():
+    window = BucketWindow(timedelta(seconds=150), '@timestamp', interval=timedelta(minutes=1))
+    window.add(T0, 3)
+    window.add(T0 + timedelta(minutes=1), 1)
+    window.add(T0 + timedelta(minutes=2), 1)
+
+    # The bucket of minute 1 leaves the window with the bucket of minute 4
+    assert window.ts_reaching(2) + window.timeframe == T0 + timedelta(minutes=4)
+    assert window.ts_reaching(6) is None